@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Time every lazythumbs action end to end through the view (decode, transform,
+encode and store) over a synthetic corpus, and print the results as JSON.
+
+    python benchmarks/render_benchmark.py --output results.json
+    python benchmarks/render_benchmark.py --quick --action thumbnail
+    python benchmarks/render_benchmark.py --setting LAZYTHUMBS_REDUCING_GAP=0
+
+The corpus is generated from a fixed seed, so the same Pillow release always
+produces the same files; it's written to --corpus and reused by later runs.
+Every render is cold: the stored renders are removed between repeats.
+
+Each case runs in a forked process, so the peak RSS reported for it is the
+high water mark of that render alone (plus the baseline_rss_bytes of the
+interpreter it was forked from).
+"""
+import json
+import math
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+ACTIONS = ('resize', 'mresize', 'aresize', 'aresize_no_crop', 'matte', 'thumbnail', 'scale')
+# (width, height) of the renders; thumbnail only gets the width
+GEOMETRIES = ((150, 150), (1200, 800))
+# name -> (PIL format, mode, extension)
+KINDS = (
+    ('jpeg', ('JPEG', 'RGB', 'jpg')),
+    ('png', ('PNG', 'RGB', 'png')),
+    ('palette', ('PNG', 'P', 'png')),
+    ('gif', ('GIF', 'P', 'gif')),
+)
+MEGAPIXELS = (0.3, 2, 12, 50)
+ORIENTATIONS = (('landscape', 4, 3), ('portrait', 3, 4))
+QUICK_MEGAPIXELS = 2
+SEED = 1913
+
+
+def corpus():
+    """
+    :returns: a list of dicts describing every image of the corpus
+    """
+    images = []
+    for kind, (img_format, mode, ext) in KINDS:
+        for megapixels in MEGAPIXELS:
+            for orientation, a, b in ORIENTATIONS:
+                width = int(round(math.sqrt(megapixels * 1e6 * a / b)))
+                height = int(round(width * float(b) / a))
+                images.append({
+                    'path': 'corpus/%s-%s-%smp.%s' % (kind, orientation, megapixels, ext),
+                    'kind': kind,
+                    'format': img_format,
+                    'mode': mode,
+                    'width': width,
+                    'height': height,
+                    'megapixels': width * height / 1e6,
+                })
+    return images
+
+
+def noise(rng, size, mode):
+    from PIL import Image
+    bands = len(mode)
+    data = bytearray(rng.getrandbits(8) for _ in xrange(size[0] * size[1] * bands))
+    return Image.frombytes(mode, size, bytes(data))
+
+
+def synthesize(image, root):
+    """
+    Draw and save one corpus image: smooth colour fields overlaid with finer
+    texture, so that it costs about as much to encode as a photograph.
+    """
+    from PIL import Image
+    path = os.path.join(root, image['path'])
+    if os.path.exists(path):
+        return {}
+    size = (image['width'], image['height'])
+    rng = random.Random('%s %s' % (SEED, image['path']))
+    img = noise(rng, (16, 12), 'RGB').resize(size, Image.BICUBIC)
+    detail = noise(rng, (max(size[0] // 8, 1), max(size[1] // 8, 1)), 'RGB').resize(size, Image.BILINEAR)
+    img = Image.blend(img, detail, 0.35)
+    if image['mode'] == 'P':
+        img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = path + '.tmp'
+    img.save(tmp, format=image['format'], quality=90)
+    os.rename(tmp, path)
+    return {}
+
+
+def render_case(image, action, geometry, repeat, root):
+    """
+    Request one render through the view repeat times.
+
+    :returns: a dict of timings and the outcome of the last request
+    """
+    from django.test.client import RequestFactory
+    from lazythumbs import views
+    from lazythumbs.util import build_geometry
+
+    width, height = geometry
+    if action == 'thumbnail':
+        height = None
+    geometry = build_geometry(action, width, height)
+    url = '/lt_cache/%s/%s/%s' % (action, geometry, image['path'])
+    # every repeat should render; this is a child process, so it's not
+    # disabled for the cases after this one
+    views.memory_cache = None
+    seconds = []
+    stages = {}
+    for _ in range(repeat):
+        shutil.rmtree(os.path.join(root, 'lt_cache'), ignore_errors=True)
+        if views.write_behind is not None:
+            views.write_behind.join()
+        request = RequestFactory().get(url)
+        renderer = views.LazyThumbRenderer()
+        start = time.time()
+        resp = renderer.get(request, action, geometry, image['path'])
+        seconds.append(time.time() - start)
+        for stage, elapsed in renderer.timings.items():
+            stages.setdefault(stage, []).append(elapsed)
+
+    seconds.sort()
+    median = seconds[len(seconds) // 2]
+    return {
+        'image': image['path'],
+        'kind': image['kind'],
+        'source_megapixels': round(image['megapixels'], 3),
+        'action': action,
+        'geometry': geometry,
+        'status': resp.status_code,
+        'cache': renderer.cache_status,
+        'bytes': None if getattr(resp, 'streaming', False) else len(resp.content),
+        'seconds': seconds,
+        'min_seconds': seconds[0],
+        'median_seconds': median,
+        'renders_per_second': 1 / median if median else None,
+        'source_megapixels_per_second': image['megapixels'] / median if median else None,
+        'stage_seconds': dict((stage, sorted(values)[len(values) // 2]) for stage, values in stages.items()),
+    }
+
+
+def peak_rss(usage):
+    # kilobytes on linux, bytes on os x
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def isolated(fun, *args):
+    """
+    Call fun in a child process.
+
+    :returns: fun's (json serializable) result and the child's peak RSS in bytes
+    """
+    import resource
+    if not hasattr(os, 'fork'):
+        return fun(*args), peak_rss(resource.getrusage(resource.RUSAGE_SELF))
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = {'result': fun(*args)}
+        except BaseException:
+            result = {'error': traceback.format_exc()}
+        with os.fdopen(w, 'w') as f:
+            f.write(json.dumps(result))
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        result = json.loads(f.read() or '{"error": "the benchmark process died"}')
+    _, status, usage = os.wait4(pid, 0)
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result['result'], peak_rss(usage)
+
+
+def configure(root, overrides):
+    """
+    Configure django to serve the corpus under root, with the lazythumbs
+    settings given on the command line.
+    """
+    from django.conf import settings
+    options = {
+        'DEBUG': False,
+        'MEDIA_ROOT': root,
+        'MEDIA_URL': '/media/',
+        'STATIC_URL': '/static/',
+        'SECRET_KEY': 'benchmark',
+        'INSTALLED_APPS': ('lazythumbs',),
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        'LAZYTHUMBS_CACHE_TIMEOUT': 60,
+        'LAZYTHUMBS_404_CACHE_TIMEOUT': 60,
+        'LAZYTHUMBS_USE_X_FOR_DIMENSIONS': True,
+    }
+    options.update(overrides)
+    settings.configure(**options)
+
+
+def parse_setting(option, opt_str, value, parser):
+    name, _, value = value.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    parser.values.settings[name] = value
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--corpus', default=os.path.join(tempfile.gettempdir(), 'lazythumbs-benchmark'),
+        help='Directory the corpus is written to and read from. [%default]')
+    parser.add_option('--output', help='Write the results to this file rather than stdout.')
+    parser.add_option('--repeat', type='int', default=3, help='Requests per case. [%default]')
+    parser.add_option('--action', dest='actions', action='append', choices=ACTIONS,
+        help='Only time this action; may be given more than once.')
+    parser.add_option('--kind', dest='kinds', action='append', choices=[k for k, _ in KINDS],
+        help='Only time images of this kind; may be given more than once.')
+    parser.add_option('--quick', action='store_true', default=False,
+        help='Only use images of up to %s megapixels.' % QUICK_MEGAPIXELS)
+    parser.add_option('--setting', action='callback', callback=parse_setting, type='string', metavar='NAME=VALUE',
+        help='Override a django setting; VALUE is parsed as JSON if it can be.')
+    parser.set_defaults(settings={})
+    options, args = parser.parse_args(argv)
+
+    root = os.path.abspath(options.corpus)
+    configure(root, options.settings)
+    import django
+    import lazythumbs
+    from PIL import Image
+
+    images = [image for image in corpus()
+              if (not options.kinds or image['kind'] in options.kinds)
+              and (not options.quick or image['megapixels'] <= QUICK_MEGAPIXELS * 1.01)]
+    actions = options.actions or ACTIONS
+
+    started = time.time()
+    for image in images:
+        isolated(synthesize, image, root)
+    corpus_seconds = time.time() - started
+
+    import resource
+    cases = []
+    for image in images:
+        for action in actions:
+            for geometry in GEOMETRIES:
+                case, rss = isolated(render_case, image, action, geometry, options.repeat, root)
+                case['peak_rss_bytes'] = rss
+                cases.append(case)
+                sys.stderr.write('%-16s %-10s %-40s %8.3fs %6d MB\n' % (
+                    action, case['geometry'], image['path'], case['median_seconds'], rss // 2 ** 20))
+
+    results = {
+        'lazythumbs': lazythumbs.__version__,
+        'django': django.get_version(),
+        'pillow': getattr(Image, 'PILLOW_VERSION', None) or getattr(Image, '__version__', None),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': options.settings,
+        'repeat': options.repeat,
+        'corpus_seed': SEED,
+        'corpus_seconds': corpus_seconds,
+        'total_seconds': time.time() - started,
+        'baseline_rss_bytes': peak_rss(resource.getrusage(resource.RUSAGE_SELF)),
+        'cases': cases,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
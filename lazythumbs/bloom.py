@@ -0,0 +1,158 @@
+"""
+Compact, probabilistic sets used to remember sources that don't exist.
+"""
+import logging
+import math
+import operator
+import struct
+import threading
+import time
+from array import array
+from hashlib import md5
+
+logger = logging.getLogger('lazythumbs')
+
+WORD = array('L').itemsize
+
+
+def filter_bits(capacity, error_rate):
+    """
+    :returns: the number of bits of a Bloom filter for capacity keys at the
+        given false positive rate
+    """
+    return max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+
+
+def union(a, b):
+    """
+    :param a: a string of bytes
+    :param b: a string of bytes as long as a
+    :returns: the bitwise OR of a and b, worked out a machine word at a time
+    """
+    words = len(a) // WORD * WORD
+    head = array('L', map(operator.or_, array('L', a[:words]), array('L', b[:words]))).tostring()
+    return head + ''.join(chr(ord(x) | ord(y)) for x, y in zip(a[words:], b[words:]))
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for capacity keys at the given false positive rate.
+    Keys that were added are always found; keys that were not are found with
+    probability error_rate.
+    """
+    def __init__(self, capacity, error_rate):
+        self.num_bits = filter_bits(capacity, error_rate)
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        # counts adds, so that merge can tell whether it raced one
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # double hashing: two 64 bit halves of an md5 make num_hashes positions
+        h1, h2 = struct.unpack('<QQ', md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.version += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def merge(self, bits):
+        """
+        Add every key of another filter of the same size, given its bits.
+        Lookups and adds carry on while the union is worked out; it is only
+        worked out again if keys were added meanwhile.
+        """
+        if len(bits) != len(self.bits):
+            raise ValueError('can only merge filters of the same size')
+        bits = str(bits)
+        with self._lock:
+            version, own = self.version, str(self.bits)
+        merged = bytearray(union(own, bits))
+        with self._lock:
+            if version != self.version:
+                merged = bytearray(union(str(self.bits), bits))
+            self.bits = merged
+
+
+class RotatingBloomFilter(object):
+    """
+    A Bloom filter whose keys expire. Time is cut into generations of half a
+    window each; keys are added to the current generation and looked up in
+    the current and previous ones, so a key is remembered for between half a
+    window and a whole window. Generations start at the same moments in every
+    process, so processes sharing a filter through a cache agree on them.
+
+    With a cache and a sync_interval the current generation is merged with a
+    copy kept in the cache at most every sync_interval seconds, so keys added
+    by one process reach the others without a cache round trip per lookup.
+    Filters over MAX_SHARED_BYTES, which memcached would refuse to store, are
+    kept to their own process.
+    """
+    MAX_SHARED_BYTES = 1000 * 1000
+
+    def __init__(self, capacity, error_rate, window, cache=None, cache_key='lazythumbs:missing', sync_interval=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.period = max(1, window // 2)
+        self.cache = cache
+        self.cache_key = cache_key
+        self.sync_interval = sync_interval
+        self.generation = None
+        self.current = None
+        self.previous = None
+        self.synced = 0
+        self._lock = threading.Lock()
+        size = (filter_bits(capacity, error_rate) + 7) // 8
+        if cache is not None and sync_interval is not None and size > self.MAX_SHARED_BYTES:
+            logger.warning('a missing source filter of %d bytes is too large to share through the cache' % size)
+            self.sync_interval = None
+
+    def _refresh(self):
+        now = time.time()
+        generation = int(now // self.period)
+        sync = False
+        with self._lock:
+            if generation != self.generation:
+                if generation == (self.generation or 0) + 1:
+                    self.previous = self.current
+                else:
+                    self.previous = None
+                self.current = BloomFilter(self.capacity, self.error_rate)
+                self.generation = generation
+                self.synced = 0
+            if self.cache is not None and self.sync_interval is not None and now - self.synced >= self.sync_interval:
+                # claimed now, so other threads don't sync as well
+                self.synced = now
+                sync = True
+            current = self.current
+        if sync:
+            # outside the lock, lookups don't wait on the cache or the merge
+            self._sync(current, generation)
+
+    def _sync(self, current, generation):
+        key = '%s:%s' % (self.cache_key, generation)
+        try:
+            shared = self.cache.get(key)
+            if shared is not None:
+                current.merge(shared)
+            self.cache.set(key, str(current.bits), self.period * 2)
+        except Exception as e:
+            logger.warning('unable to share missing sources through cache: %s' % e)
+
+    def add(self, key):
+        self._refresh()
+        self.current.add(key)
+
+    def __contains__(self, key):
+        self._refresh()
+        current, previous = self.current, self.previous
+        return key in current or (previous is not None and key in previous)
@@ -0,0 +1,60 @@
+"""
+Estimate how much memory rendering a source takes, so that sources too large
+to render safely are turned away before they are decoded.
+"""
+
+
+class SourceTooLarge(IOError):
+    """
+    Raised instead of decoding a source that is over the pixel or memory
+    budget. An IOError, so it is answered like any other unreadable source.
+    """
+    def __init__(self, source_path, reason):
+        super(SourceTooLarge, self).__init__('%s is too large to render (%s)' % (source_path, reason))
+        self.source_path = source_path
+        self.reason = reason
+
+    def __reduce__(self):
+        # so it survives the trip back from a render process
+        return SourceTooLarge, (self.source_path, self.reason)
+
+
+def image_bytes(mode, size):
+    """
+    :param mode: PIL mode of an image
+    :param size: (width, height) of the image
+    :returns: the bytes Pillow takes to hold it decoded: one per pixel for
+        '1', 'L' and 'P', two for 'I;16' and four for everything else
+    """
+    if mode in ('1', 'L', 'P'):
+        depth = 1
+    elif mode.startswith('I;16'):
+        depth = 2
+    else:
+        depth = 4
+    return size[0] * size[1] * depth
+
+
+def estimate_render_bytes(mode, size, target):
+    """
+    Roughly estimate the peak memory of rendering a source: the decoded
+    source, a full-size RGB copy of palette sources (which are converted
+    before they are resampled), and the output plus a canvas it may be pasted
+    on.
+
+    :param mode: PIL mode the source decodes to
+    :param size: (width, height) the source decodes to
+    :param target: (width, height) of the render; either may be None
+    :returns: the estimate in bytes
+    """
+    source_width, source_height = size
+    width, height = target
+    if not (width or height):
+        width, height = size
+    width = width or max(1, source_width * height // source_height)
+    height = height or max(1, source_height * width // source_width)
+
+    estimate = image_bytes(mode, size)
+    if mode == 'P':
+        estimate += image_bytes('RGB', size)
+    return estimate + 2 * image_bytes('RGB', (width, height))
@@ -0,0 +1,77 @@
+"""
+Choose how rendered images are encoded, by output format and size.
+"""
+import logging
+
+logger = logging.getLogger('lazythumbs')
+
+# what every image was saved with before policies existed
+DEFAULT_OPTIONS = {'quality': 80}
+
+# Image.info keys dropped by strip_metadata. Transparency, palette and
+# animation keys are left alone since they change how the image looks.
+METADATA_KEYS = ('exif', 'icc_profile', 'dpi', 'comment', 'xmp', 'photoshop', 'jfif', 'jfif_version',
+                 'jfif_density', 'jfif_unit', 'adobe', 'adobe_transform', 'gamma', 'srgb', 'chromaticity')
+
+
+class EncoderPolicy(object):
+    """
+    Maps an output format and size to keyword arguments for Image.save.
+
+    rules is a dict of format name (as returned by get_format, eg 'JPEG') to
+    a list of rules, with '*' matching formats that have no rules of their
+    own. Each rule is a dict of Image.save options, plus optionally:
+
+    * max_pixels: the rule only applies to outputs of at most this many
+      pixels (width * height)
+    * strip_metadata: drop EXIF, ICC profiles, comments and the like from
+      the output
+
+    The first rule that applies wins; eg
+
+        {
+            'JPEG': [
+                {'max_pixels': 100 * 100, 'quality': 70, 'strip_metadata': True},
+                {'max_pixels': 500 * 500, 'quality': 80, 'optimize': True},
+                {'quality': 85, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0'},
+            ],
+            'PNG': [{'optimize': True, 'compress_level': 9}],
+        }
+
+    Formats no rule applies to are saved with DEFAULT_OPTIONS.
+    """
+    def __init__(self, rules=None):
+        self.rules = rules or {}
+
+    def rule(self, img_format, size):
+        """
+        :param img_format: the output format, eg 'JPEG'
+        :param size: the output (width, height)
+        :returns: the rule for the output as a dict
+        """
+        pixels = size[0] * size[1]
+        rules = self.rules.get(img_format, self.rules.get('*', ()))
+        for rule in rules:
+            max_pixels = rule.get('max_pixels')
+            if max_pixels is None or pixels <= max_pixels:
+                return rule
+        return DEFAULT_OPTIONS
+
+    def prepare(self, img, img_format):
+        """
+        Decide how to encode img, stripping its metadata if the rule says so.
+
+        :param img: the PIL image about to be saved
+        :param img_format: the format it is saved in
+        :returns: a dict of keyword arguments for img.save, including format
+        """
+        rule = self.rule(img_format, img.size)
+        params = dict((k, v) for k, v in rule.items() if k not in ('max_pixels', 'strip_metadata'))
+        params['format'] = img_format
+        if rule.get('strip_metadata'):
+            for key in METADATA_KEYS:
+                img.info.pop(key, None)
+        logger.debug('encoding %dx%d %s with %r%s' % (
+            img.size[0], img.size[1], img_format, params,
+            ' (metadata stripped)' if rule.get('strip_metadata') else ''))
+        return params
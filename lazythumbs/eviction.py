@@ -0,0 +1,210 @@
+"""
+Keep the render storage within a byte and file budget by removing the least
+recently used renders.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('lazythumbs')
+
+# eviction removes renders until the storage is this far below its budget,
+# so that it doesn't run again for every new render
+LOW_WATERMARK = 0.9
+
+
+class EvictionIndex(object):
+    """
+    A sqlite index of renders with their size and last access time. Accesses
+    are buffered in memory and written in batches every flush_interval
+    seconds, so recording one costs a dict update rather than a write.
+
+    Renders that were never recorded, eg those rendered before the index
+    existed, are added by rebuild, the only operation that walks the tree.
+    """
+    def __init__(self, path, flush_interval=10, max_bytes=None, max_files=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # path -> (size or None, access time)
+        self._buffer = {}
+        self._flushed = time.time()
+        # _lock guards the buffer only and is never held during a write to
+        # the index; _write_lock keeps writes in the order they were buffered
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # a connection per thread, since sqlite connections can't be shared
+        self._local = threading.local()
+        self._thread = None
+        self._thread_pid = None
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('CREATE TABLE IF NOT EXISTS renders (path TEXT PRIMARY KEY, size INTEGER, atime REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS renders_atime ON renders (atime)')
+            db.commit()
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def touch(self, path, size=None):
+        """
+        Record an access to a render. Writes to the index are batched, and
+        left for the next batch while another thread is writing one.
+
+        :param path: the storage path of the render
+        :param size: its size in bytes when it was just written, otherwise None
+        """
+        now = time.time()
+        with self._lock:
+            if size is None and path in self._buffer:
+                size = self._buffer[path][0]
+            self._buffer[path] = (size, now)
+            due = now - self._flushed >= self.flush_interval
+        if due:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """
+        Write buffered accesses to the index. Accesses recorded while the
+        batch is being written go into the next one.
+
+        :param wait: whether to wait for a write by another thread to finish,
+            rather than return at once and leave the buffer for later
+        """
+        if not self._write_lock.acquire(wait):
+            return
+        try:
+            with self._lock:
+                buffered, self._buffer = self._buffer, {}
+                self._flushed = time.time()
+            if not buffered:
+                return
+            try:
+                db = self.db
+                db.executemany('INSERT OR REPLACE INTO renders (path, size, atime) VALUES (?, ?, ?)',
+                               [(path, size, atime) for path, (size, atime) in buffered.items() if size is not None])
+                # an access to a render the index doesn't know yet has no
+                # size to record; rebuild picks those up
+                db.executemany('UPDATE renders SET atime = ? WHERE path = ?',
+                               [(atime, path) for path, (size, atime) in buffered.items() if size is None])
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning('unable to update eviction index %s: %s' % (self.path, e))
+        finally:
+            self._write_lock.release()
+
+    def usage(self):
+        """
+        :returns: (number of renders, total bytes) in the index
+        """
+        count, size = self.db.execute('SELECT COUNT(*), SUM(size) FROM renders').fetchone()
+        return count, size or 0
+
+    def evict(self, delete, max_bytes=None, max_files=None, batch=500):
+        """
+        Delete least recently used renders until the index is LOW_WATERMARK
+        below both budgets, if it is over either of them.
+
+        :param delete: a callable removing a render given its path
+        :param max_bytes: byte budget, defaults to the index's
+        :param max_files: render count budget, defaults to the index's
+        :param batch: renders looked up and deleted per query
+        :returns: (number of renders, bytes) deleted
+        """
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        max_files = max_files if max_files is not None else self.max_files
+        self.flush()
+        count, size = self.usage()
+        if not ((max_bytes is not None and size > max_bytes) or (max_files is not None and count > max_files)):
+            return 0, 0
+
+        target_bytes = max_bytes * LOW_WATERMARK if max_bytes is not None else None
+        target_files = int(max_files * LOW_WATERMARK) if max_files is not None else None
+        evicted = evicted_bytes = 0
+        db = self.db
+        while (target_bytes is not None and size > target_bytes) or (target_files is not None and count > target_files):
+            rows = db.execute('SELECT path, size FROM renders ORDER BY atime LIMIT ?', (batch,)).fetchall()
+            if not rows:
+                break
+            done = []
+            for path, path_size in rows:
+                try:
+                    delete(path)
+                except OSError:
+                    # already gone
+                    pass
+                except Exception as e:
+                    logger.warning('unable to evict %s: %s' % (path, e))
+                    continue
+                done.append((path,))
+                count -= 1
+                size -= path_size or 0
+                evicted += 1
+                evicted_bytes += path_size or 0
+                if not ((target_bytes is not None and size > target_bytes) or
+                        (target_files is not None and count > target_files)):
+                    break
+            if not done:
+                break
+            db.executemany('DELETE FROM renders WHERE path = ?', done)
+            db.commit()
+        logger.info('evicted %d renders, %d bytes' % (evicted, evicted_bytes))
+        return evicted, evicted_bytes
+
+    def rebuild(self, root):
+        """
+        Replace the index with every render found in the lt_cache directories
+        below root, using their last access times from the filesystem.
+
+        :param root: the directory the render storage saves to
+        :returns: the number of renders indexed
+        """
+        rows = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            if 'lt_cache' not in os.path.relpath(dirpath, root).split(os.sep):
+                continue
+            for filename in filenames:
+                if filename.startswith('.'):
+                    # a render still being written
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                rows.append((os.path.relpath(full_path, root).replace(os.sep, '/'), st.st_size, st.st_atime))
+        with self._write_lock:
+            db = self.db
+            db.execute('DELETE FROM renders')
+            db.executemany('INSERT OR REPLACE INTO renders (path, size, atime) VALUES (?, ?, ?)', rows)
+            db.commit()
+        return len(rows)
+
+    def start(self, delete, interval):
+        """
+        Evict every interval seconds on a daemon thread, once per process.
+
+        :param delete: a callable removing a render given its path
+        """
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, args=(delete, interval), name='lazythumbs-evict')
+            self._thread.daemon = True
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+    def _run(self, delete, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict(delete)
+            except Exception:
+                logger.exception('eviction failed')
@@ -0,0 +1,139 @@
+"""
+A bounded pool of render processes, so that a burst of cache misses queues up
+behind a fixed number of renders instead of tying up every WSGI worker.
+"""
+import logging
+import os
+import threading
+from multiprocessing import Pool, TimeoutError
+
+__all__ = ['RenderExecutor', 'QueueFull', 'TimeoutError']
+
+logger = logging.getLogger('lazythumbs')
+
+# renderer class -> instance, per pool process
+_renderers = {}
+
+
+def _render(renderer_class, args):
+    """
+    Runs in a pool process. Exceptions are handed back rather than raised so
+    that the submitting side always gets a result and frees its slot.
+    """
+    renderer = _renderers.get(renderer_class)
+    if renderer is None:
+        renderer = _renderers[renderer_class] = renderer_class()
+    try:
+        return None, renderer.render(*args)
+    except Exception as e:
+        return e, None
+
+
+class QueueFull(Exception):
+    """ Raised when the executor already holds as many renders as it may. """
+
+
+class RenderExecutor(object):
+    """
+    Runs LazyThumbRenderer.render in a pool of worker processes. At most
+    queue_size renders may be running or waiting at once; submitting more
+    raises QueueFull immediately.
+
+    The pool is started on first use, and again in a process forked from one
+    that already had a pool, so an executor can be created at import time.
+    A pool process that dies (eg killed for running out of memory) takes the
+    render it was running with it and Pool never answers for that render, so
+    the pool is replaced as soon as that is noticed.
+    """
+    def __init__(self, processes, queue_size):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_workers = None
+        self._pool_lock = threading.Lock()
+        # (pool, AsyncResult) of renders that outlived their wait; each
+        # holds a slot until it is done, see _reap
+        self._late = []
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                # slots and renders held in the process we were forked from
+                # are not ours
+                self.slots = threading.BoundedSemaphore(self.queue_size)
+                self._pool = None
+                self._late = []
+            self._reap()
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+                self._pool_pid = os.getpid()
+                self._pool_workers = self._workers(self._pool)
+            return self._pool
+
+    def _workers(self, pool):
+        # Pool keeps its worker processes in _pool, replacing those that exit
+        return set(worker.pid for worker in pool._pool)
+
+    def _reap(self):
+        """
+        Free the slots of late renders that are done. If a pool process died,
+        replace the pool and free the slots of all of its late renders, one
+        of which will never be done. Called with _pool_lock held.
+        """
+        pool = self._pool
+        if pool is not None and (self._workers(pool) != self._pool_workers
+                                 or any(worker.exitcode is not None for worker in pool._pool)):
+            logger.warning('a render process died, replacing the render pool')
+            pool.terminate()
+            self._pool = None
+        late = []
+        for late_pool, result in self._late:
+            if late_pool is self._pool and not result.ready():
+                late.append((late_pool, result))
+            else:
+                self.slots.release()
+        self._late = late
+
+    def render(self, renderer, timeout, *args):
+        """
+        Render in a pool process with renderer's class and wait for the result.
+
+        :param renderer: a LazyThumbRenderer; its class must be importable
+        :param timeout: seconds to wait for the render
+        :param args: arguments for LazyThumbRenderer.render
+        :raises QueueFull: if no slot is free
+        :raises TimeoutError: if the render took longer than timeout. It
+            keeps its slot until it finishes, or until its pool is replaced.
+        :returns: the encoded image data as a string
+        """
+        pool = self.pool
+        slots = self.slots
+        if not slots.acquire(False):
+            raise QueueFull('%d renders already queued' % self.queue_size)
+        late = False
+        try:
+            result = pool.apply_async(_render, (type(renderer), args))
+            try:
+                error, raw_data = result.get(timeout)
+            except TimeoutError:
+                with self._pool_lock:
+                    if pool is self._pool:
+                        self._late.append((pool, result))
+                        late = True
+                raise
+        finally:
+            if not late:
+                slots.release()
+        if error is not None:
+            raise error
+        return raw_data
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+                self._pool.join()
+            self._pool = None
@@ -0,0 +1,153 @@
+"""
+Locks used to coalesce concurrent renders of the same image into a single
+render (single-flight).
+"""
+import errno
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger('lazythumbs')
+
+POLL_INTERVAL = 0.05
+
+# key -> [threading.Lock, number of RenderLocks interested in it]
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def _checkout(key):
+    with _local_locks_guard:
+        entry = _local_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _checkin(key):
+    with _local_locks_guard:
+        entry = _local_locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del _local_locks[key]
+
+
+class RenderLock(object):
+    """
+    Exclusive lock on a single key (a rendered path). Threads of this process
+    always coordinate through an in-process lock; when a lock file path is
+    given and fcntl is available, processes coordinate through flock on that
+    file as well. Failing to use the lock file falls back to the in-process
+    lock alone.
+
+    Use as a context manager. `acquired` tells whether the lock was obtained
+    within `timeout` seconds and `waited` whether someone else held it when
+    we first asked, i.e. whether they may have done our work for us.
+    """
+    def __init__(self, key, lock_path=None, timeout=10):
+        self.key = key
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self.acquired = False
+        self.waited = False
+        self._local = None
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        """
+        Block for up to `timeout` seconds trying to take the lock.
+
+        :returns: True if the lock was acquired
+        """
+        deadline = time.time() + (self.timeout or 0)
+        self._local = _checkout(self.key)
+
+        if not self._wait(lambda: self._local.acquire(False), deadline):
+            _checkin(self.key)
+            return False
+
+        if self.lock_path and fcntl is not None:
+            try:
+                locked = self._wait(self._flock, deadline)
+            except (IOError, OSError) as e:
+                logger.warning('unable to use lock file %s, coalescing renders in this process only: %s' % (self.lock_path, e))
+                self._close()
+                locked = True
+            if not locked:
+                self._close()
+                self._local.release()
+                _checkin(self.key)
+                return False
+
+        self.acquired = True
+        return True
+
+    def release(self):
+        if not self.acquired:
+            return
+        if self._fd is not None:
+            # unlink while still holding the lock; see _flock for how waiters
+            # notice they locked a stale file.
+            try:
+                os.unlink(self.lock_path)
+            except OSError:
+                pass
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._close()
+        self._local.release()
+        _checkin(self.key)
+        self.acquired = False
+
+    def _wait(self, attempt, deadline):
+        while not attempt():
+            if time.time() >= deadline:
+                return False
+            self.waited = True
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def _flock(self):
+        if self._fd is None:
+            dirname = os.path.dirname(self.lock_path)
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        # The previous holder unlinks the lock file on release, so the file we
+        # just locked may no longer be the one at lock_path. Only a lock on the
+        # current file counts; otherwise start over with a fresh descriptor.
+        try:
+            current = os.stat(self.lock_path)
+        except OSError:
+            current = None
+        if current is None or current.st_ino != os.fstat(self._fd).st_ino:
+            self._close()
+            return False
+        return True
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,105 @@
+"""
+A small per-process LRU cache of rendered image data, for the handful of
+images that get most of the traffic.
+"""
+import threading
+import time
+from collections import deque
+
+
+class ByteLRU(object):
+    """
+    Least-recently-used cache bounded by the total size of its values rather
+    than their number. Values larger than max_entry_bytes are not cached, and
+    values older than ttl seconds are dropped when next looked up.
+
+    Counts hits, misses and evictions; see stats.
+    """
+    def __init__(self, max_bytes, max_entry_bytes=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes or max_bytes, max_bytes)
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size, expiry timestamp or None, tick of last use)
+        self._entries = {}
+        # (tick, key) in order of use, oldest first; pairs whose tick is no
+        # longer the key's last use are skipped (collections.OrderedDict
+        # needs python 2.7)
+        self._order = deque()
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :returns: the value cached for key, or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._use(key, entry[:3])
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """
+        Cache value under key, evicting the least recently used values until
+        everything fits in max_bytes.
+
+        :param size: size of value in bytes
+        :returns: False if value is too large to be cached
+        """
+        if size > self.max_entry_bytes:
+            return False
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._use(key, (value, size, expires))
+            self.size += size
+            while self.size > self.max_bytes:
+                tick, oldest = self._order.popleft()
+                entry = self._entries.get(oldest)
+                if entry is None or entry[3] != tick:
+                    continue
+                del self._entries[oldest]
+                self.size -= entry[1]
+                self.evictions += 1
+        return True
+
+    def _use(self, key, entry):
+        self._tick += 1
+        self._entries[key] = entry + (self._tick,)
+        self._order.append((self._tick, key))
+        if len(self._order) > 2 * len(self._entries) + 32:
+            self._order = deque(sorted((e[3], k) for k, e in self._entries.items()))
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def stats(self):
+        """
+        :returns: a dict of entries, bytes, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,51 @@
+"""
+Delete the least recently used renders once the render storage is over
+budget.
+
+    manage.py lazythumbs_evict --max-bytes 10000000000
+
+Renders and their last access are tracked in the sqlite index at
+LAZYTHUMBS_EVICTION_INDEX, so a run doesn't walk the tree; --rebuild fills
+the index from the tree first, eg when it is first set up.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lazythumbs import views
+from lazythumbs.views import LazyThumbRenderer
+
+
+class Command(BaseCommand):
+    help = 'Delete least recently used lazythumbs renders until the render storage is within budget.'
+    option_list = BaseCommand.option_list + (
+        make_option('--max-bytes', dest='max_bytes', type='int', default=None,
+            help='Byte budget. Defaults to LAZYTHUMBS_CACHE_MAX_BYTES.'),
+        make_option('--max-files', dest='max_files', type='int', default=None,
+            help='Render count budget. Defaults to LAZYTHUMBS_CACHE_MAX_FILES.'),
+        make_option('--rebuild', dest='rebuild', action='store_true', default=False,
+            help='Rebuild the index from the renders on disk before evicting.'),
+    )
+
+    def handle(self, *args, **options):
+        index = views.eviction_index
+        if index is None:
+            raise CommandError('LAZYTHUMBS_EVICTION_INDEX is not set')
+        renderer = LazyThumbRenderer()
+
+        if options['rebuild']:
+            try:
+                root = renderer.fs.path('')
+            except NotImplementedError:
+                raise CommandError('--rebuild needs a render storage on the local filesystem')
+            self.stdout.write('indexed %d renders\n' % index.rebuild(root))
+
+        max_bytes = options['max_bytes'] if options['max_bytes'] is not None else index.max_bytes
+        max_files = options['max_files'] if options['max_files'] is not None else index.max_files
+        if max_bytes is None and max_files is None:
+            raise CommandError('no budget: use --max-bytes or --max-files, or set LAZYTHUMBS_CACHE_MAX_BYTES')
+
+        evicted, evicted_bytes = index.evict(renderer.fs.delete, max_bytes, max_files)
+        count, size = index.usage()
+        self.stdout.write('evicted %d renders (%.2f MB), %d renders (%.2f MB) left\n' % (
+            evicted, evicted_bytes / 1048576.0, count, size / 1048576.0))
@@ -0,0 +1,106 @@
+"""
+Move renders stored at their url path into the hashed tree used with
+LAZYTHUMBS_SHARD_DEPTH, and renders sharded at another depth (after the
+setting changed) to the configured one.
+
+    manage.py lazythumbs_shard
+
+Renders that haven't been moved yet are rendered again when requested, so
+the command can run while the site serves the new layout.
+"""
+import errno
+import os
+import re
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lazythumbs import views
+from lazythumbs.views import LazyThumbRenderer
+
+# a render stored under its hash, at any depth
+SHARDED = re.compile(r'^(?P<head>(?:.*/)?)lt_cache/(?P<shards>(?:[0-9a-f]{2}/)*)(?P<hashed>[0-9a-f]{32})(?P<ext>\.[^/]*)?$')
+
+
+def reshard(name, depth):
+    """
+    :param name: the name of a render in the render storage
+    :param depth: number of directory levels
+    :returns: the name of a render stored under its hash moved to depth, or
+        None if name isn't stored under its hash; the name is an md5 of
+        the render's url path and the directories are its leading digits
+    """
+    match = SHARDED.match(name)
+    if match is None:
+        return None
+    hashed = match.group('hashed')
+    shards = match.group('shards').split('/')[:-1]
+    if shards != [hashed[i * 2:i * 2 + 2] for i in range(len(shards))]:
+        return None
+    return '%slt_cache/%s%s%s' % (
+        match.group('head'), ''.join(hashed[i * 2:i * 2 + 2] + '/' for i in range(depth)), hashed,
+        match.group('ext') or '')
+
+
+class Command(BaseCommand):
+    help = 'Move lazythumbs renders into the sharded layout of LAZYTHUMBS_SHARD_DEPTH.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Only report what would be moved.'),
+    )
+
+    def handle(self, *args, **options):
+        depth = views.SHARD_DEPTH
+        if not depth:
+            raise CommandError('LAZYTHUMBS_SHARD_DEPTH is not set')
+        renderer = LazyThumbRenderer()
+        try:
+            root = renderer.fs.path('')
+        except NotImplementedError:
+            raise CommandError('the render storage is not on the local filesystem')
+        verbosity = int(options.get('verbosity', 1))
+
+        moves = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            if 'lt_cache' not in os.path.relpath(dirpath, root).split(os.sep):
+                continue
+            for filename in filenames:
+                if filename.startswith('.'):
+                    # a render still being written
+                    continue
+                rendered_path = os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+                name = reshard(rendered_path, depth)
+                if name is None:
+                    moves.append((rendered_path, renderer.storage_name(rendered_path, depth)))
+                elif name != rendered_path:
+                    moves.append((rendered_path, name))
+
+        for rendered_path, name in moves:
+            if verbosity > 1:
+                self.stdout.write('%s -> %s\n' % (rendered_path, name))
+            if options['dry_run']:
+                continue
+            source, destination = os.path.join(root, rendered_path), os.path.join(root, name)
+            try:
+                os.makedirs(os.path.dirname(destination))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if os.path.exists(destination):
+                # rendered again since the new layout went live
+                os.unlink(source)
+            else:
+                os.rename(source, destination)
+
+        if not options['dry_run']:
+            # clear out the directories the renders were moved from
+            for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+                if 'lt_cache' in os.path.relpath(dirpath, root).split(os.sep)[:-1]:
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+            if moves and views.eviction_index is not None:
+                views.eviction_index.rebuild(root)
+
+        self.stdout.write('%s %d renders\n' % ('would move' if options['dry_run'] else 'moved', len(moves)))
@@ -0,0 +1,206 @@
+"""
+Render images ahead of time so that first views don't pay for them.
+
+    manage.py lazythumbs_warm --manifest presets.json 'photos/*.jpg' 'gallery/*'
+
+The manifest is a JSON list of [action, geometry] pairs, eg
+[["thumbnail", "150"], ["resize", "300x200"]]. Without --manifest the
+LAZYTHUMBS_WARM_MANIFEST setting is used. Renders that already exist are
+skipped, so an interrupted run picks up where it left off.
+"""
+import fnmatch
+import json
+import multiprocessing
+import os
+import re
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.core.management.base import BaseCommand, CommandError
+
+from lazythumbs import views
+from lazythumbs.util import geometry_parse, get_rendered_path
+from lazythumbs.views import LazyThumbRenderer
+
+_renderer = None
+
+
+def _init_worker():
+    global _renderer
+    _renderer = LazyThumbRenderer()
+
+
+def _warm(task):
+    """
+    Render every (action, width, height, rendered_path) of a single source,
+    decoding the source only once.
+
+    :returns: a list of (rendered_path, bytes written, error message) tuples
+    """
+    source_path, renders = task
+    try:
+        rendered = _renderer.render_many(source_path, renders)
+    except (IOError, SuspiciousOperation, ValueError) as e:
+        rendered = [e] * len(renders)
+    results = []
+    for (action, width, height, rendered_path), result in zip(renders, rendered):
+        if isinstance(result, Exception):
+            results.append((rendered_path, 0, '%s: %s' % (source_path, result)))
+        else:
+            results.append((rendered_path, len(result), None))
+    if views.write_behind is not None:
+        # the pool may be torn down as soon as we return
+        views.write_behind.join()
+    return results
+
+
+def find_sources(root, patterns):
+    """
+    Walk root for files whose path relative to root matches any of the
+    fnmatch-style patterns. Only the part of the tree below the literal
+    directory prefix of each pattern is walked, and lt_cache is skipped.
+
+    :returns: a sorted list of paths relative to root
+    """
+    found = set()
+    for pattern in patterns:
+        pattern = pattern.lstrip('/')
+        base = []
+        for part in pattern.split('/')[:-1]:
+            if re.search(r'[*?[]', part):
+                break
+            base.append(part)
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, *base)):
+            dirnames[:] = [d for d in dirnames if d != 'lt_cache']
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), root)
+                if fnmatch.fnmatch(path, pattern):
+                    found.add(path)
+    return sorted(found)
+
+
+class Command(BaseCommand):
+    args = '<glob glob ...>'
+    help = 'Render missing lazythumbs for every source matching the globs and every preset in the manifest.'
+    option_list = BaseCommand.option_list + (
+        make_option('--manifest', dest='manifest', default=None,
+            help='JSON file listing [action, geometry] pairs to render. Defaults to LAZYTHUMBS_WARM_MANIFEST.'),
+        make_option('--static', dest='static', action='store_true', default=False,
+            help='Globs are relative to STATIC_ROOT instead of MEDIA_ROOT.'),
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of render processes. 0 renders in this process. Defaults to the number of CPUs.'),
+        make_option('--force', dest='force', action='store_true', default=False,
+            help='Render again even if a render already exists.'),
+        make_option('--progress', dest='progress', type='int', default=100,
+            help='Report progress every this many renders.'),
+    )
+
+    def handle(self, *patterns, **options):
+        if not patterns:
+            raise CommandError('at least one source glob is required')
+
+        renderer = LazyThumbRenderer()
+        presets = self.load_manifest(options['manifest'], renderer.allowed_actions)
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['static']:
+            root = settings.STATIC_ROOT
+            prefix = settings.STATIC_URL.lstrip('/')
+        else:
+            root = settings.MEDIA_ROOT
+            prefix = ''
+
+        tasks = []
+        total = skipped = 0
+        for path in find_sources(root, patterns):
+            source_path = prefix + path
+            renders = []
+            for action, width, height in presets:
+                rendered_path = get_rendered_path(source_path, action, width, height)
+                name = renderer.storage_name(rendered_path)
+                if renderer.fs.exists(name):
+                    if not options['force']:
+                        skipped += 1
+                        continue
+                    renderer.fs.delete(name)
+                renders.append((action, width, height, rendered_path))
+            if renders:
+                tasks.append((source_path, renders))
+                total += len(renders)
+
+        self.stdout.write('%d renders to do, %d already rendered\n' % (total, skipped))
+
+        processes = options['processes']
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes:
+            pool = multiprocessing.Pool(processes, initializer=_init_worker)
+            results = pool.imap_unordered(_warm, tasks)
+        else:
+            pool = None
+            _init_worker()
+            results = (_warm(task) for task in tasks)
+
+        started = time.time()
+        done = failed = written = 0
+        try:
+            for task_results in results:
+                for rendered_path, size, error in task_results:
+                    done += 1
+                    written += size
+                    if error:
+                        failed += 1
+                        if verbosity:
+                            self.stderr.write('failed %s: %s\n' % (rendered_path, error))
+                    elif verbosity > 1:
+                        self.stdout.write('rendered %s\n' % rendered_path)
+                    if options['progress'] and not done % options['progress']:
+                        elapsed = time.time() - started
+                        self.stdout.write('%d/%d (%d%%) %.1f renders/s\n' % (
+                            done, total, 100 * done / total, done / elapsed if elapsed else 0))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = time.time() - started
+        self.stdout.write(
+            'rendered %d, skipped %d, failed %d in %.1fs (%.1f renders/s, %.2f MB written, %.2f MB/s)\n' % (
+                done - failed, skipped, failed, elapsed,
+                done / elapsed if elapsed else 0,
+                written / 1048576.0,
+                written / 1048576.0 / elapsed if elapsed else 0,
+            ))
+
+    def load_manifest(self, manifest, allowed_actions):
+        """
+        Read (action, geometry) pairs from a JSON file or the
+        LAZYTHUMBS_WARM_MANIFEST setting.
+
+        :param manifest: path to a JSON manifest or None
+        :param allowed_actions: the actions a preset may use
+        :returns: a list of (action, width, height) tuples
+        """
+        if manifest:
+            try:
+                with open(manifest) as f:
+                    pairs = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CommandError('unable to read manifest %s: %s' % (manifest, e))
+        else:
+            pairs = getattr(settings, 'LAZYTHUMBS_WARM_MANIFEST', None)
+        if not pairs:
+            raise CommandError('no presets: use --manifest or set LAZYTHUMBS_WARM_MANIFEST')
+
+        presets = []
+        for action, geometry in pairs:
+            if action not in allowed_actions:
+                raise CommandError('unknown action %s' % action)
+            try:
+                width, height = geometry_parse(action, geometry, ValueError)
+            except ValueError:
+                raise CommandError('bad geometry %s for action %s' % (geometry, action))
+            presets.append((action, width, height))
+        return presets
@@ -0,0 +1,128 @@
+"""
+Time the stages of handling a request and count outcomes, reported through
+a pluggable sink.
+"""
+import threading
+import time
+from contextlib import contextmanager
+try:
+    from importlib import import_module
+except ImportError:  # python 2.6
+    from django.utils.importlib import import_module
+
+
+class Timings(object):
+    """
+    Durations of the stages of one request, in seconds. Time spent in a
+    stage nested in another counts towards the inner stage only, so eg
+    decoding a source inside an action isn't counted as transforming it.
+    """
+    def __init__(self):
+        # stage name -> seconds, in the order the stages first ran
+        self.stages = {}
+        self.order = []
+        self._children = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+            if name not in self.stages:
+                self.order.append(name)
+                self.stages[name] = 0.0
+            self.stages[name] += elapsed - children
+
+    def items(self):
+        return [(name, self.stages[name]) for name in self.order]
+
+
+class NullSink(object):
+    """ Discards everything. """
+    def observe(self, name, value, **labels):
+        pass
+
+    def increment(self, name, **labels):
+        pass
+
+
+class PrometheusSink(object):
+    """
+    Keeps histograms and counters in memory and renders them in the
+    Prometheus text format. Each process keeps its own, so with several
+    worker processes each scrape sees the process that answered it.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix='lazythumbs', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        # name -> sorted label items -> [bucket counts..., sum, count]
+        self.histograms = {}
+        # name -> sorted label items -> count
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def increment(self, name, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + 1
+
+    def render(self):
+        """
+        :returns: every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.histograms.items()):
+                name = '%s_%s' % (self.prefix, name)
+                lines.append('# TYPE %s histogram' % name)
+                for key, values in sorted(series.items()):
+                    for bound, count in zip(self.buckets, values):
+                        lines.append('%s_bucket%s %d' % (name, _labels(key + (('le', repr(bound)),)), count))
+                    lines.append('%s_bucket%s %d' % (name, _labels(key + (('le', '+Inf'),)), values[-1]))
+                    lines.append('%s_sum%s %r' % (name, _labels(key), values[-2]))
+                    lines.append('%s_count%s %d' % (name, _labels(key), values[-1]))
+            for name, series in sorted(self.counters.items()):
+                name = '%s_%s' % (self.prefix, name)
+                lines.append('# TYPE %s counter' % name)
+                for key, count in sorted(series.items()):
+                    lines.append('%s%s %d' % (name, _labels(key), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(items):
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+
+
+def get_sink(path):
+    """
+    :param path: dotted path of a sink class, or None for a NullSink
+    :returns: an instance of the sink class
+    """
+    if not path:
+        return NullSink()
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
@@ -13,7 +13,7 @@ from lazythumbs.util import compute_img, get_attr_string
 from lazythumbs.views import LazyThumbRenderer
 
 
-SUPPORTED_ACTIONS = LazyThumbRenderer().allowed_actions
+SUPPORTED_ACTIONS = LazyThumbRenderer.allowed_actions
 
 register = Library()
 logger = logging.getLogger()
@@ -1,4 +1,16 @@
-from lazythumbs.tests.test_server import  RenderTest, GetViewTest
+from lazythumbs.tests.test_server import  RenderTest, GetViewTest, TestCropResize, TestReducedDecode, DeliveryTest, ConditionalGetTest, NoopTest, StorageTest, AtomicStoreTest, WebPTest, RenderManyTest, PyramidTest
 from lazythumbs.tests.test_templatetag import LazythumbSyntaxTest, LazythumbGeometryCompileTest, LazythumbRenderTest
 from lazythumbs.tests.test_templatetag import ImgAttrsRenderTest
 from lazythumbs.tests.test_util import TestGeometry, TestComputeIMG, TestGetImgAttrs, TestGetFormat
+from lazythumbs.tests.test_locks import RenderLockTest
+from lazythumbs.tests.test_warm import WarmTest
+from lazythumbs.tests.test_executor import RenderExecutorTest
+from lazythumbs.tests.test_lru import ByteLRUTest
+from lazythumbs.tests.test_bloom import BloomFilterTest, RotatingBloomFilterTest
+from lazythumbs.tests.test_writebehind import WriteBehindTest
+from lazythumbs.tests.test_encoding import EncoderPolicyTest, RenderEncodingTest
+from lazythumbs.tests.test_eviction import EvictionIndexTest, EvictionViewTest
+from lazythumbs.tests.test_shard import ShardTest
+from lazythumbs.tests.test_metrics import TimingsTest, PrometheusSinkTest, RenderMetricsTest, ServerTimingTest
+from lazythumbs.tests.test_budget import EstimateTest, BudgetTest
+from lazythumbs.tests.test_animated import AnimatedTest
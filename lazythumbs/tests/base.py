@@ -0,0 +1,69 @@
+"""
+Fixtures shared by the tests.
+"""
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from django.test.utils import override_settings
+from mock import patch
+from PIL import Image
+
+
+class MockCache(object):
+    def __init__(self):
+        self.cache = {}
+
+    def set(self, key, value, expiration=None):
+        self.cache[key] = value
+
+    def get(self, key, default=None):
+        return self.cache.get(key)
+
+
+class MediaTestCase(TestCase):
+    """
+    Runs each test against an empty, temporary MEDIA_ROOT. Attributes of
+    lazythumbs.views patched with patch_views are restored after the test.
+    """
+    # more settings to override for each test
+    settings_overrides = {}
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        overrides = {'MEDIA_ROOT': self.media_root, 'STATIC_URL': '/static/'}
+        overrides.update(self.settings_overrides)
+        self.settings = override_settings(**overrides)
+        self.settings.enable()
+        self.patches = []
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def patch_views(self, name, value):
+        """
+        Patch an attribute of lazythumbs.views until the end of the test.
+
+        :returns: value
+        """
+        p = patch('lazythumbs.views.%s' % name, value)
+        self.patches.append(p)
+        return p.start()
+
+    def save_image(self, path, size=(100, 80), color=0, mode='RGB', **options):
+        """
+        Save an image of a single colour under MEDIA_ROOT.
+
+        :param path: where to save it, relative to MEDIA_ROOT
+        :param options: options for Image.save, eg format
+        :returns: the absolute path of the image
+        """
+        path = os.path.join(self.media_root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        Image.new(mode, size, color).save(path, **options)
+        return path
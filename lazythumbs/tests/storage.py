@@ -0,0 +1,51 @@
+"""
+A storage that keeps files in memory, standing in for remote storage in tests.
+"""
+import threading
+from datetime import datetime
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+
+
+class InMemoryStorage(Storage):
+    # shared by every instance, like files on a disk would be
+    files = {}
+    lock = threading.Lock()
+
+    def _open(self, name, mode='rb'):
+        with self.lock:
+            if name not in self.files:
+                raise IOError('no such file: %s' % name)
+            return ContentFile(self.files[name][0])
+
+    def _save(self, name, content):
+        content.seek(0)
+        with self.lock:
+            self.files[name] = (content.read(), datetime.now())
+        return name
+
+    def get_available_name(self, name, *args, **kwargs):
+        return name
+
+    def delete(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+    def size(self, name):
+        return len(self._get(name)[0])
+
+    def modified_time(self, name):
+        return self._get(name)[1]
+
+    def _get(self, name):
+        try:
+            return self.files[name]
+        except KeyError:
+            raise OSError('no such file: %s' % name)
+
+    def url(self, name):
+        return '/' + name
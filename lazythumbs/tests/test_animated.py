@@ -0,0 +1,86 @@
+import os
+from cStringIO import StringIO
+
+from django.test.client import RequestFactory
+from mock import patch
+from PIL import Image
+
+from lazythumbs.tests.base import MediaTestCase, MockCache
+from lazythumbs.views import LazyThumbRenderer
+
+
+class AnimatedTest(MediaTestCase):
+    """ Test rendering every frame of animated sources """
+
+    def setUp(self):
+        super(AnimatedTest, self).setUp()
+        os.makedirs(os.path.join(self.media_root, 'i'))
+        frames = [Image.new('RGB', (100, 80), color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+        frames[0].save(os.path.join(self.media_root, 'i', 'a.gif'), format='GIF', save_all=True,
+                       append_images=frames[1:], duration=[50, 60, 70], loop=0)
+        self.patch_views('ANIMATED', True)
+        self.patch_views('cache', MockCache())
+        self.renderer = LazyThumbRenderer()
+
+    def get(self, action='thumbnail', geometry='50', source_path='i/a.gif'):
+        request = RequestFactory().get('/lt_cache/%s/%s/%s' % (action, geometry, source_path))
+        resp = self.renderer.get(request, action, geometry, source_path)
+        self.assertEqual(resp.status_code, 200)
+        return Image.open(StringIO(resp.content))
+
+    def frames(self, img, xy=(10, 10)):
+        frames = []
+        for index in range(getattr(img, 'n_frames', 1)):
+            img.seek(index)
+            frames.append((img.size, img.convert('RGB').getpixel(xy), img.info.get('duration')))
+        return frames
+
+    def test_animated(self):
+        self.assertEqual(self.frames(self.get()), [
+            ((50, 40), (255, 0, 0), 50), ((50, 40), (0, 255, 0), 60), ((50, 40), (0, 0, 255), 70)])
+
+    def test_loop(self):
+        self.assertEqual(self.get().info.get('loop'), 0)
+
+        frames = [Image.new('RGB', (100, 80), color) for color in ((255, 0, 0), (0, 255, 0))]
+        frames[0].save(os.path.join(self.media_root, 'i', 'once.gif'), format='GIF', save_all=True,
+                       append_images=frames[1:], duration=50)
+        img = self.get(source_path='i/once.gif')
+        self.assertEqual(len(self.frames(img)), 2)
+        self.assertFalse('loop' in img.info)
+
+    def test_action_geometry(self):
+        img = self.get('matte', '60x60')
+        # 60x48 frames, matted at the top and bottom
+        self.assertEqual([frame[:2] for frame in self.frames(img, (30, 2))], [
+            ((60, 60), (0, 0, 0)), ((60, 60), (0, 0, 0)), ((60, 60), (0, 0, 0))])
+        self.assertEqual([frame[1] for frame in self.frames(img, (30, 30))], [
+            (255, 0, 0), (0, 255, 0), (0, 0, 255)])
+
+    def test_caps(self):
+        with patch('lazythumbs.views.ANIMATED_MAX_FRAMES', 2):
+            self.assertEqual(self.frames(self.get())[0][:2], ((50, 40), (255, 0, 0)))
+            self.assertEqual(len(self.frames(self.get())), 1)
+        with patch('lazythumbs.views.ANIMATED_MAX_PIXELS', 20000):
+            self.assertEqual(len(self.frames(self.get('thumbnail', '40'))), 1)
+
+    def test_opt_in(self):
+        with patch('lazythumbs.views.ANIMATED', False):
+            self.assertEqual(len(self.frames(self.get())), 1)
+
+    def test_webp(self):
+        Image.init()
+        if 'WEBP' not in Image.SAVE_ALL:  # pragma: no cover
+            return
+        frames = [Image.new('RGB', (100, 80), color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+        frames[0].save(os.path.join(self.media_root, 'i', 'a.webp'), format='WEBP', save_all=True,
+                       append_images=frames[1:], duration=[50, 60, 70], lossless=True)
+        img = self.get(source_path='i/a.webp')
+        self.assertEqual((img.format, img.n_frames, img.size), ('WEBP', 3, (50, 40)))
+
+    def test_render_many(self):
+        results = self.renderer.render_many('i/a.gif', [
+            ('thumbnail', 50, None, 'lt_cache/thumbnail/50/i/a.gif'),
+            ('resize', 30, 30, 'lt_cache/resize/30x30/i/a.gif'),
+        ])
+        self.assertEqual([Image.open(StringIO(data)).n_frames for data in results], [3, 3])
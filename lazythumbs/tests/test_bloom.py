@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+from mock import patch
+
+from lazythumbs.bloom import BloomFilter, RotatingBloomFilter, union
+from lazythumbs.tests.base import MockCache
+
+
+class BloomFilterTest(TestCase):
+    """ Test the Bloom filter """
+
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.001)
+        for i in range(1000):
+            bloom.add('i/%s.jpg' % i)
+        for i in range(1000):
+            self.assertTrue('i/%s.jpg' % i in bloom)
+        false_positives = sum(1 for i in range(10000) if 'j/%s.jpg' % i in bloom)
+        self.assertTrue(false_positives < 50)
+
+    def test_unicode(self):
+        bloom = BloomFilter(10, 0.01)
+        bloom.add(u'i/\xe9.jpg')
+        self.assertTrue(u'i/\xe9.jpg' in bloom)
+
+    def test_merge(self):
+        a = BloomFilter(100, 0.01)
+        b = BloomFilter(100, 0.01)
+        a.add('a')
+        b.add('b')
+        a.merge(b.bits)
+        self.assertTrue('a' in a)
+        self.assertTrue('b' in a)
+        self.assertRaises(ValueError, a.merge, BloomFilter(1000, 0.01).bits)
+
+    def test_union(self):
+        a = ''.join(chr(i) for i in range(19))
+        b = ''.join(chr(255 - 2 * i) for i in range(19))
+        self.assertEqual(union(a, b), ''.join(chr(ord(x) | ord(y)) for x, y in zip(a, b)))
+
+    def test_merge_racing_add(self):
+        """ A key added while the union is worked out isn't lost """
+        a = BloomFilter(100, 0.01)
+        b = BloomFilter(100, 0.01)
+        b.add('b')
+
+        def racing_union(x, y):
+            if a.version == 0:
+                a.add('a')
+            return union(x, y)
+        with patch('lazythumbs.bloom.union', racing_union):
+            a.merge(b.bits)
+        self.assertTrue('a' in a)
+        self.assertTrue('b' in a)
+
+
+class RotatingBloomFilterTest(TestCase):
+    """ Test expiring keys from a rotating Bloom filter """
+
+    def test_rotation(self):
+        bloom = RotatingBloomFilter(100, 0.01, 60)
+        with patch('lazythumbs.bloom.time.time', return_value=1000):
+            bloom.add('a')
+        with patch('lazythumbs.bloom.time.time', return_value=1029):
+            self.assertTrue('a' in bloom)
+        with patch('lazythumbs.bloom.time.time', return_value=1049):
+            self.assertTrue('a' in bloom)
+        with patch('lazythumbs.bloom.time.time', return_value=1050):
+            self.assertFalse('a' in bloom)
+
+    def test_gap(self):
+        """ Nothing survives more than one idle generation. """
+        bloom = RotatingBloomFilter(100, 0.01, 60)
+        with patch('lazythumbs.bloom.time.time', return_value=1000):
+            bloom.add('a')
+        with patch('lazythumbs.bloom.time.time', return_value=1090):
+            self.assertFalse('a' in bloom)
+
+    def test_shared(self):
+        """ Processes share what they learn through the cache. """
+        cache = MockCache()
+        one = RotatingBloomFilter(100, 0.01, 60, cache=cache, sync_interval=10)
+        two = RotatingBloomFilter(100, 0.01, 60, cache=cache, sync_interval=10)
+        with patch('lazythumbs.bloom.time.time', return_value=1000):
+            self.assertFalse('a' in two)
+            one.add('a')
+        with patch('lazythumbs.bloom.time.time', return_value=1005):
+            self.assertFalse('a' in two)
+        with patch('lazythumbs.bloom.time.time', return_value=1010):
+            self.assertTrue('a' in one)
+            self.assertTrue('a' in two)
+
+    def test_too_large_to_share(self):
+        with patch('lazythumbs.bloom.RotatingBloomFilter.MAX_SHARED_BYTES', 100):
+            bloom = RotatingBloomFilter(1000, 0.01, 60, cache=MockCache(), sync_interval=10)
+        self.assertEqual(bloom.sync_interval, None)
+        bloom.add('a')
+        self.assertEqual(bloom.cache.cache, {})
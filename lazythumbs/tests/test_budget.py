@@ -0,0 +1,81 @@
+import pickle
+from unittest import TestCase
+
+from django.test.client import RequestFactory
+from mock import patch
+
+from lazythumbs.budget import SourceTooLarge, estimate_render_bytes, image_bytes
+from lazythumbs.metrics import PrometheusSink
+from lazythumbs.tests.base import MediaTestCase, MockCache
+from lazythumbs.views import LazyThumbRenderer
+
+
+class EstimateTest(TestCase):
+    """ Test estimating the memory a render takes """
+
+    def test_image_bytes(self):
+        self.assertEqual(image_bytes('P', (100, 80)), 8000)
+        self.assertEqual(image_bytes('I;16', (100, 80)), 16000)
+        self.assertEqual(image_bytes('RGB', (100, 80)), 32000)
+
+    def test_estimate(self):
+        # source, then output and canvas
+        self.assertEqual(estimate_render_bytes('RGB', (100, 80), (50, 50)), 32000 + 2 * 10000)
+        # palette sources are converted to RGB
+        self.assertEqual(estimate_render_bytes('P', (100, 80), (50, None)), 8000 + 32000 + 2 * 8000)
+        self.assertEqual(estimate_render_bytes('L', (100, 80), (None, None)), 8000 + 2 * 32000)
+
+    def test_pickle(self):
+        e = pickle.loads(pickle.dumps(SourceTooLarge('i/p.png', 'pixels')))
+        self.assertEqual((e.source_path, e.reason), ('i/p.png', 'pixels'))
+        self.assertTrue(isinstance(e, IOError))
+
+
+class BudgetTest(MediaTestCase):
+    """ Test turning away sources that are too large to render """
+
+    def setUp(self):
+        super(BudgetTest, self).setUp()
+        self.save_image('i/p.jpg', (400, 300), format='JPEG')
+        self.save_image('i/p.png', (400, 300), format='PNG')
+        self.sink = self.patch_views('metrics', PrometheusSink())
+        self.cache = self.patch_views('cache', MockCache())
+
+    def get(self, source_path):
+        request = RequestFactory().get('/lt_cache/thumbnail/50/' + source_path)
+        renderer = LazyThumbRenderer()
+        return renderer.get(request, 'thumbnail', '50', source_path), renderer
+
+    def rejected(self):
+        return dict((dict(key)['reason'], count)
+                    for key, count in self.sink.counters.get('rejected_sources_total', {}).items())
+
+    def test_max_source_pixels(self):
+        with patch('lazythumbs.views.MAX_SOURCE_PIXELS', 20000):
+            resp, renderer = self.get('i/p.png')
+            self.assertEqual(resp.status_code, 404)
+            resp, renderer = self.get('i/p.png')
+            self.assertEqual(renderer.cache_status, 'neg')
+            # JPEGs are decoded at a reduced scale that fits
+            resp, renderer = self.get('i/p.jpg')
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.rejected(), {'pixels': 1})
+
+    def test_max_render_memory(self):
+        with patch('lazythumbs.views.MAX_RENDER_MEMORY', 100000):
+            resp, renderer = self.get('i/p.png')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.rejected(), {'memory': 1})
+
+    def test_decompression_bomb(self):
+        with patch('PIL.Image.MAX_IMAGE_PIXELS', 1000):
+            resp, renderer = self.get('i/p.png')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.rejected(), {'bomb': 1})
+
+    def test_within_budget(self):
+        with patch('lazythumbs.views.MAX_SOURCE_PIXELS', 120000):
+            with patch('lazythumbs.views.MAX_RENDER_MEMORY', 500000):
+                resp, renderer = self.get('i/p.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.rejected(), {})
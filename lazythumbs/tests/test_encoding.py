@@ -0,0 +1,79 @@
+from cStringIO import StringIO
+from unittest import TestCase
+
+from django.core.files.storage import FileSystemStorage
+from mock import patch
+from PIL import Image
+
+from lazythumbs.encoding import DEFAULT_OPTIONS, EncoderPolicy
+from lazythumbs.tests.base import MediaTestCase
+from lazythumbs.views import LazyThumbRenderer
+
+RULES = {
+    'JPEG': [
+        {'max_pixels': 100 * 100, 'quality': 60, 'strip_metadata': True},
+        {'quality': 85, 'progressive': True, 'optimize': True},
+    ],
+    '*': [{'optimize': True}],
+}
+
+
+class EncoderPolicyTest(TestCase):
+    """ Test choosing encoder options by format and size """
+
+    def test_default(self):
+        policy = EncoderPolicy()
+        self.assertEqual(policy.rule('JPEG', (100, 100)), DEFAULT_OPTIONS)
+        self.assertEqual(policy.prepare(Image.new('RGB', (10, 10)), 'PNG'), {'format': 'PNG', 'quality': 80})
+
+    def test_size_buckets(self):
+        policy = EncoderPolicy(RULES)
+        self.assertEqual(policy.prepare(Image.new('RGB', (100, 100)), 'JPEG'), {'format': 'JPEG', 'quality': 60})
+        self.assertEqual(policy.prepare(Image.new('RGB', (100, 101)), 'JPEG'),
+                         {'format': 'JPEG', 'quality': 85, 'progressive': True, 'optimize': True})
+
+    def test_fallback_format(self):
+        policy = EncoderPolicy(RULES)
+        self.assertEqual(policy.prepare(Image.new('RGB', (10, 10)), 'PNG'), {'format': 'PNG', 'optimize': True})
+
+    def test_no_rule_applies(self):
+        policy = EncoderPolicy({'JPEG': [{'max_pixels': 10, 'quality': 60}]})
+        self.assertEqual(policy.rule('JPEG', (10, 10)), DEFAULT_OPTIONS)
+
+    def test_strip_metadata(self):
+        policy = EncoderPolicy(RULES)
+        img = Image.new('P', (10, 10))
+        img.info.update({'icc_profile': 'profile', 'exif': 'exif', 'transparency': 0})
+        policy.prepare(img, 'JPEG')
+        self.assertEqual(img.info, {'transparency': 0})
+
+        img = Image.new('RGB', (200, 200))
+        img.info['icc_profile'] = 'profile'
+        policy.prepare(img, 'JPEG')
+        self.assertEqual(img.info, {'icc_profile': 'profile'})
+
+
+class RenderEncodingTest(MediaTestCase):
+    """ Test that renders are encoded according to the policy """
+
+    def setUp(self):
+        super(RenderEncodingTest, self).setUp()
+        self.save_image('p.jpg', (400, 300), (255, 0, 0), format='JPEG')
+        self.renderer = LazyThumbRenderer()
+        self.renderer.fs = FileSystemStorage(location=self.media_root)
+
+    def test_progressive(self):
+        with patch('lazythumbs.views.encoder_policy', EncoderPolicy(RULES)):
+            raw_data = self.renderer.render('thumbnail', 200, None, 'p.jpg', 'lt_cache/thumbnail/200/p.jpg')
+            self.assertTrue(Image.open(StringIO(raw_data)).info.get('progressive'))
+
+            raw_data = self.renderer.render('thumbnail', 50, None, 'p.jpg', 'lt_cache/thumbnail/50/p.jpg')
+            self.assertFalse(Image.open(StringIO(raw_data)).info.get('progressive'))
+
+    def test_bad_options(self):
+        """ Options the encoder rejects are dropped rather than failing the render """
+        policy = EncoderPolicy({'JPEG': [{'quality': 80, 'subsampling': 'bogus'}]})
+        with patch('lazythumbs.views.encoder_policy', policy):
+            with patch('lazythumbs.views.logger'):
+                raw_data = self.renderer.render('thumbnail', 50, None, 'p.jpg', 'lt_cache/thumbnail/50/p.jpg')
+        self.assertEqual(Image.open(StringIO(raw_data)).size, (50, 37))
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import time
+from cStringIO import StringIO
+from unittest import TestCase
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.client import RequestFactory
+from mock import Mock, patch
+
+from lazythumbs.eviction import EvictionIndex
+from lazythumbs.tests.base import MediaTestCase
+from lazythumbs.views import LazyThumbRenderer
+
+
+class EvictionIndexTest(TestCase):
+    """ Test tracking renders and evicting the least recently used ones """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = EvictionIndex(os.path.join(self.tmp, 'index.db'), flush_interval=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def fill(self):
+        for i, name in enumerate('abcd'):
+            self.index.touch(name, 10)
+            self.index._buffer[name] = (10, 1000 + i)
+        self.index.flush()
+
+    def test_batched_touch(self):
+        self.index.touch('a', 10)
+        self.assertEqual(self.index.usage(), (0, 0))
+        self.index.flush()
+        self.assertEqual(self.index.usage(), (1, 10))
+
+        self.index.flush_interval = 0
+        self.index.touch('b', 5)
+        self.assertEqual(self.index.usage(), (2, 15))
+
+    def test_touch_while_writing(self):
+        """ A due flush doesn't wait for another thread's write """
+        self.index.flush_interval = 0
+        with self.index._write_lock:
+            self.index.touch('a', 10)
+            self.assertEqual(self.index.usage(), (0, 0))
+        self.index.touch('b', 5)
+        self.assertEqual(self.index.usage(), (2, 15))
+
+    def test_touch_keeps_size(self):
+        self.index.touch('a', 10)
+        self.index.touch('a')
+        self.index.touch('b')
+        self.index.flush()
+        self.assertEqual(self.index.usage(), (1, 10))
+
+    def test_evict_lru(self):
+        self.fill()
+        self.index.touch('a')
+        delete = Mock()
+        self.assertEqual(self.index.evict(delete, max_bytes=30), (2, 20))
+        self.assertEqual([args[0][0] for args in delete.call_args_list], ['b', 'c'])
+        self.assertEqual(self.index.usage(), (2, 20))
+
+    def test_evict_files(self):
+        self.fill()
+        delete = Mock(side_effect=[None, OSError()])
+        self.assertEqual(self.index.evict(delete, max_files=3), (2, 20))
+        self.assertEqual(self.index.usage(), (2, 20))
+
+    def test_within_budget(self):
+        self.fill()
+        delete = Mock()
+        self.assertEqual(self.index.evict(delete, max_bytes=40, max_files=4), (0, 0))
+        self.assertFalse(delete.called)
+
+    def test_rebuild(self):
+        root = os.path.join(self.tmp, 'media')
+        os.makedirs(os.path.join(root, 'lt', 'lt_cache', 'thumbnail', '48', 'i'))
+        os.makedirs(os.path.join(root, 'i'))
+        for name in ('lt/lt_cache/thumbnail/48/i/p.jpg', 'lt/lt_cache/thumbnail/48/i/.p.jpg.tmp', 'i/p.jpg'):
+            with open(os.path.join(root, name), 'w') as f:
+                f.write('data')
+        self.index.touch('gone', 10)
+        self.index.flush()
+        self.assertEqual(self.index.rebuild(root), 1)
+        self.assertEqual(self.index.db.execute('SELECT path, size FROM renders').fetchall(),
+                         [('lt/lt_cache/thumbnail/48/i/p.jpg', 4)])
+
+
+class EvictionViewTest(MediaTestCase):
+    """ Test that renders and their accesses are recorded """
+
+    def setUp(self):
+        super(EvictionViewTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        self.index = self.patch_views(
+            'eviction_index', EvictionIndex(os.path.join(self.media_root, 'index.db'), flush_interval=60))
+        self.renderer = LazyThumbRenderer()
+
+    def get(self):
+        request = RequestFactory().get('/lt_cache/thumbnail/50/i/p.jpg')
+        with patch('lazythumbs.views.cache', Mock(get=Mock(return_value=None))):
+            return self.renderer.get(request, 'thumbnail', '50', 'i/p.jpg')
+
+    def test_touch(self):
+        resp = self.get()
+        size, rendered = self.index._buffer['lt_cache/thumbnail/50/i/p.jpg']
+        self.assertEqual(size, len(resp.content))
+
+        time.sleep(0.01)
+        self.get()
+        size, accessed = self.index._buffer['lt_cache/thumbnail/50/i/p.jpg']
+        self.assertEqual(size, len(resp.content))
+        self.assertTrue(accessed > rendered)
+
+    def test_command(self):
+        self.get()
+        stdout = StringIO()
+        call_command('lazythumbs_evict', rebuild=True, max_files=0, stdout=stdout)
+        self.assertTrue('indexed 1 renders' in stdout.getvalue())
+        self.assertTrue('evicted 1 renders' in stdout.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'lt_cache/thumbnail/50/i/p.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'i', 'p.jpg')))
+
+    def test_command_needs_index(self):
+        with patch('lazythumbs.views.eviction_index', None):
+            self.assertRaises(CommandError, call_command, 'lazythumbs_evict', max_files=0)
@@ -0,0 +1,55 @@
+import os
+import time
+from unittest import TestCase
+
+from lazythumbs.executor import QueueFull, RenderExecutor, TimeoutError
+
+
+class StubRenderer(object):
+    def render(self, action, width, height, source_path, rendered_path):
+        if action == 'sleep':
+            time.sleep(width)
+        elif action == 'die':
+            os._exit(1)
+        elif action == 'missing':
+            raise IOError('no such file: %s' % source_path)
+        return '%s:%s' % (action, rendered_path)
+
+
+class RenderExecutorTest(TestCase):
+    """ Test rendering in a bounded process pool """
+
+    def setUp(self):
+        self.executor = RenderExecutor(1, 1)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def render(self, action, width=None, timeout=5):
+        return self.executor.render(StubRenderer(), timeout, action, width, None, 'i/p.jpg', 'lt/p.jpg')
+
+    def test_render(self):
+        self.assertEqual(self.render('thumbnail'), 'thumbnail:lt/p.jpg')
+
+    def test_error(self):
+        self.assertRaises(IOError, self.render, 'missing')
+        # the slot is free again
+        self.assertEqual(self.render('thumbnail'), 'thumbnail:lt/p.jpg')
+
+    def test_backpressure(self):
+        """
+        A render that outlives its wait keeps its slot until it is done, and
+        nothing else gets in meanwhile.
+        """
+        self.assertRaises(TimeoutError, self.render, 'sleep', 0.5, 0.01)
+        self.assertRaises(QueueFull, self.render, 'thumbnail')
+        time.sleep(1)
+        self.assertEqual(self.render('thumbnail'), 'thumbnail:lt/p.jpg')
+
+    def test_dead_worker(self):
+        """
+        A render whose process died never finishes; the pool is replaced and
+        the slot it held is freed.
+        """
+        self.assertRaises(TimeoutError, self.render, 'die', None, 0.5)
+        self.assertEqual(self.render('thumbnail'), 'thumbnail:lt/p.jpg')
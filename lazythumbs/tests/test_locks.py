@@ -0,0 +1,90 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from lazythumbs.locks import RenderLock
+
+
+class RenderLockTest(TestCase):
+    """ Test coalescing renders with RenderLock """
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.lock_dir, 'sub', 'p.jpg.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_acquire_release(self):
+        lock = RenderLock('p.jpg', self.lock_path, timeout=0)
+        with lock:
+            self.assertTrue(lock.acquired)
+            self.assertFalse(lock.waited)
+            self.assertTrue(os.path.exists(self.lock_path))
+        self.assertFalse(lock.acquired)
+        self.assertFalse(os.path.exists(self.lock_path))
+
+    def test_contended_in_process(self):
+        """
+        A second lock on the same key times out while the first is held and
+        can be taken once it is released.
+        """
+        first = RenderLock('p.jpg', None, timeout=0)
+        first.acquire()
+        second = RenderLock('p.jpg', None, timeout=0.1)
+        self.assertFalse(second.acquire())
+        self.assertTrue(second.waited)
+        first.release()
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_other_keys_not_contended(self):
+        with RenderLock('p.jpg', None, timeout=0) as first:
+            with RenderLock('q.jpg', None, timeout=0) as second:
+                self.assertTrue(first.acquired)
+                self.assertTrue(second.acquired)
+
+    def test_contended_across_processes(self):
+        """
+        A lock file flocked by someone else (as another process would) keeps
+        the lock from being acquired.
+        """
+        os.makedirs(os.path.dirname(self.lock_path))
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            lock = RenderLock('p.jpg', self.lock_path, timeout=0.1)
+            self.assertFalse(lock.acquire())
+            self.assertTrue(lock.waited)
+        finally:
+            os.close(fd)
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_waiter_gets_lock(self):
+        """ A waiting thread takes the lock as soon as the holder is done. """
+        first = RenderLock('p.jpg', self.lock_path, timeout=0)
+        first.acquire()
+        result = {}
+
+        def wait():
+            with RenderLock('p.jpg', self.lock_path, timeout=5) as lock:
+                result['acquired'] = lock.acquired
+                result['waited'] = lock.waited
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.2)
+        first.release()
+        thread.join()
+        self.assertEqual(result, {'acquired': True, 'waited': True})
+
+    def test_unusable_lock_file(self):
+        """ Falls back to an in-process lock if the lock file can't be made. """
+        open(os.path.join(self.lock_dir, 'sub'), 'w').close()
+        with RenderLock('p.jpg', self.lock_path, timeout=0) as lock:
+            self.assertTrue(lock.acquired)
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from mock import patch
+
+from lazythumbs.lru import ByteLRU
+
+
+class ByteLRUTest(TestCase):
+    """ Test the in-process LRU cache of rendered images """
+
+    def test_get_set(self):
+        lru = ByteLRU(100)
+        self.assertTrue(lru.set('a', 'aaaa', 4))
+        self.assertEqual(lru.get('a'), 'aaaa')
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.stats(), {'entries': 1, 'bytes': 4, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_budget(self):
+        """ The least recently used entries are evicted to stay in budget. """
+        lru = ByteLRU(10)
+        lru.set('a', 'aaaa', 4)
+        lru.set('b', 'bbbb', 4)
+        lru.get('a')
+        lru.set('c', 'cccc', 4)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 'aaaa')
+        self.assertEqual(lru.get('c'), 'cccc')
+        self.assertEqual(lru.size, 8)
+        self.assertEqual(lru.evictions, 1)
+
+    def test_replace(self):
+        lru = ByteLRU(10)
+        lru.set('a', 'aaaa', 4)
+        lru.set('a', 'aa', 2)
+        self.assertEqual(lru.get('a'), 'aa')
+        self.assertEqual(lru.size, 2)
+
+    def test_entry_cap(self):
+        lru = ByteLRU(100, 5)
+        self.assertFalse(lru.set('a', 'aaaaaa', 6))
+        self.assertEqual(len(lru), 0)
+
+    def test_ttl(self):
+        lru = ByteLRU(100, ttl=10)
+        with patch('lazythumbs.lru.time.time', return_value=1000):
+            lru.set('a', 'aaaa', 4)
+        with patch('lazythumbs.lru.time.time', return_value=1009):
+            self.assertEqual(lru.get('a'), 'aaaa')
+        with patch('lazythumbs.lru.time.time', return_value=1010):
+            self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.size, 0)
+        self.assertEqual(len(lru), 0)
+
+    def test_delete(self):
+        lru = ByteLRU(100)
+        lru.set('a', 'aaaa', 4)
+        lru.delete('a')
+        lru.delete('b')
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.size, 0)
@@ -0,0 +1,136 @@
+from unittest import TestCase
+
+from django.test.client import RequestFactory
+from mock import patch
+
+from lazythumbs.metrics import NullSink, PrometheusSink, Timings, get_sink
+from lazythumbs.tests.base import MediaTestCase, MockCache
+from lazythumbs.views import LazyThumbRenderer, metrics_view
+
+
+class TimingsTest(TestCase):
+    """ Test timing the stages of a request """
+
+    def test_nested(self):
+        timings = Timings()
+        with patch('lazythumbs.metrics.time.time', side_effect=[0, 1, 3, 4, 10, 11]):
+            with timings.stage('transform'):
+                with timings.stage('decode'):
+                    pass
+            with timings.stage('decode'):
+                pass
+        self.assertEqual(timings.items(), [('decode', 3), ('transform', 2)])
+
+
+class PrometheusSinkTest(TestCase):
+    """ Test rendering metrics in the Prometheus text format """
+
+    def test_render(self):
+        sink = PrometheusSink(buckets=(0.1, 1.0))
+        sink.observe('stage_seconds', 0.5, stage='decode', action='thumbnail')
+        sink.observe('stage_seconds', 0.05, stage='decode', action='thumbnail')
+        sink.increment('requests_total', status=200, cache='hit')
+        sink.increment('requests_total', status=200, cache='hit')
+        self.assertEqual(sink.render().splitlines(), [
+            '# TYPE lazythumbs_stage_seconds histogram',
+            'lazythumbs_stage_seconds_bucket{action="thumbnail",stage="decode",le="0.1"} 1',
+            'lazythumbs_stage_seconds_bucket{action="thumbnail",stage="decode",le="1.0"} 2',
+            'lazythumbs_stage_seconds_bucket{action="thumbnail",stage="decode",le="+Inf"} 2',
+            'lazythumbs_stage_seconds_sum{action="thumbnail",stage="decode"} 0.55',
+            'lazythumbs_stage_seconds_count{action="thumbnail",stage="decode"} 2',
+            '# TYPE lazythumbs_requests_total counter',
+            'lazythumbs_requests_total{cache="hit",status="200"} 2',
+        ])
+
+    def test_get_sink(self):
+        self.assertTrue(isinstance(get_sink(None), NullSink))
+        self.assertTrue(isinstance(get_sink('lazythumbs.metrics.PrometheusSink'), PrometheusSink))
+
+
+class RenderMetricsTest(MediaTestCase):
+    """ Test the metrics reported by the view """
+
+    def setUp(self):
+        super(RenderMetricsTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        self.sink = self.patch_views('metrics', PrometheusSink())
+        self.patch_views('cache', MockCache())
+
+    def get(self, source_path='i/p.jpg'):
+        request = RequestFactory().get('/lt_cache/thumbnail/50/' + source_path)
+        return LazyThumbRenderer().get(request, 'thumbnail', '50', source_path)
+
+    def test_stages(self):
+        self.get()
+        self.get()
+        self.get('i/q.jpg')
+        stages = dict((dict(key)['stage'], values[-1]) for key, values in self.sink.histograms['stage_seconds'].items())
+        self.assertEqual(stages, {
+            'negative_cache': 3, 'storage_read': 3, 'decode': 2, 'transform': 2, 'encode': 1, 'storage_write': 1})
+        requests = dict(((dict(key)['cache'], dict(key)['status']), count)
+                        for key, count in self.sink.counters['requests_total'].items())
+        self.assertEqual(requests, {('miss', 200): 1, ('hit', 200): 1, ('miss', 404): 1})
+
+    def test_output_format(self):
+        """ Requests are labelled with the format they were answered in """
+        request = RequestFactory().get('/lt_cache/thumbnail/50/i/p.jpg', HTTP_ACCEPT='image/webp,*/*')
+        with patch('lazythumbs.views.WEBP', True):
+            resp = LazyThumbRenderer().get(request, 'thumbnail', '50', 'i/p.jpg')
+        self.assertEqual(resp['Content-Type'], 'image/webp')
+        self.assertEqual(self.sink.counters['requests_total'].keys(), [
+            (('action', 'thumbnail'), ('cache', 'miss'), ('format', 'WEBP'), ('status', 200))])
+
+    def test_unknown_action(self):
+        request = RequestFactory().get('/lt_cache/bogus/50/i/p.jpg')
+        LazyThumbRenderer().get(request, 'bogus', '50', 'i/p.jpg')
+        self.assertEqual(self.sink.counters['requests_total'].keys(), [
+            (('action', 'unknown'), ('cache', 'none'), ('format', 'JPEG'), ('status', 404))])
+
+    def test_view(self):
+        self.get()
+        resp = metrics_view(RequestFactory().get('/lt_metrics'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('lazythumbs_requests_total{action="thumbnail",cache="miss",format="JPEG",status="200"} 1'
+                        in resp.content)
+
+        with patch('lazythumbs.views.metrics', NullSink()):
+            self.assertEqual(metrics_view(RequestFactory().get('/lt_metrics')).status_code, 404)
+
+
+class ServerTimingTest(MediaTestCase):
+    """ Test describing how a response was made in its headers """
+
+    def setUp(self):
+        super(ServerTimingTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        self.patch_views('SERVER_TIMING', True)
+        self.patch_views('cache', MockCache())
+
+    def get(self, source_path='i/p.jpg'):
+        request = RequestFactory().get('/lt_cache/thumbnail/50/' + source_path)
+        return LazyThumbRenderer().get(request, 'thumbnail', '50', source_path)
+
+    def stages(self, resp):
+        return [timing.split(';')[0] for timing in resp['Server-Timing'].split(', ')]
+
+    def test_headers(self):
+        resp = self.get()
+        self.assertEqual(resp['X-Lazythumbs-Cache'], 'miss')
+        self.assertEqual(self.stages(resp), [
+            'negative_cache', 'storage_read', 'decode', 'transform', 'encode', 'storage_write', 'total'])
+
+        resp = self.get()
+        self.assertEqual(resp['X-Lazythumbs-Cache'], 'hit')
+        self.assertEqual(self.stages(resp), ['negative_cache', 'storage_read', 'total'])
+
+        self.get('i/q.jpg')
+        resp = self.get('i/q.jpg')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp['X-Lazythumbs-Cache'], 'neg')
+        self.assertEqual(self.stages(resp), ['negative_cache', 'total'])
+
+    def test_opt_in(self):
+        with patch('lazythumbs.views.SERVER_TIMING', False):
+            resp = self.get()
+        self.assertFalse(resp.has_header('Server-Timing'))
+        self.assertFalse(resp.has_header('X-Lazythumbs-Cache'))
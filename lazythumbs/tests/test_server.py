@@ -2,37 +2,41 @@ import errno
 import os
 import shutil
 import tempfile
+import threading
+from cStringIO import StringIO
 from unittest import TestCase
 
 from mock import Mock, patch
-
+from PIL import Image, ImageChops
+
+from lazythumbs.bloom import RotatingBloomFilter
+from lazythumbs.executor import QueueFull
+from lazythumbs.lru import ByteLRU
+from lazythumbs.tests.base import MediaTestCase, MockCache
+from lazythumbs.tests.storage import InMemoryStorage
+from lazythumbs.writebehind import WriteBehind
 from lazythumbs.views import LazyThumbRenderer, action
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from lazythumbs.urls import urlpatterns
 from django.core.urlresolvers import reverse, resolve
 
 
 TEST_IMG_GIF = os.path.join(os.path.dirname(__file__), "testdata", "testimage.gif")
 
-class MockCache(object):
-    def __init__(self):
-        self.cache = {}
-
-    def set(self, key, value, expiration=None):
-        self.cache[key] = value
-
-    def get(self, key, default=None):
-        return self.cache.get(key)
-
-
 class MockImg(object):
     def __init__(self, width=1000, height=1000):
         self.called = []
         self.size = (width, height)
         self.mode = "RGB"
+        self.info = {}
 
-    def resize(self, size, _):
+    def resize(self, size, _, box=None):
         self.called.append('resize')
         self.size = size
+        self.box = box
         return self
 
     def crop(self, dimensions):
@@ -52,6 +56,51 @@ class TestMatte(TestCase):
         self.assertRaises(ValueError, renderer.matte, 200, 200)
 
 
+class TestCropResize(TestCase):
+    """ Test cropping as part of the resample """
+
+    def setUp(self):
+        self.img = Image.linear_gradient('L').resize((400, 300)).convert('RGB')
+
+    def test_resize_matches_crop_then_resize(self):
+        renderer = LazyThumbRenderer()
+        img = renderer.resize(width=100, height=100, img=self.img)
+        expected = self.img.resize((133, 100), Image.ANTIALIAS).crop((16, 0, 116, 100))
+        self.assertEqual(img.size, (100, 100))
+        difference = ImageChops.difference(img, expected).getextrema()
+        self.assertTrue(max(high for low, high in difference) <= 8)
+
+    def test_without_resize_box(self):
+        renderer = LazyThumbRenderer()
+        with patch('lazythumbs.views.RESIZE_BOX', False):
+            img = renderer.crop_resize(self.img, (100, 0, 300, 300), (100, 150))
+        self.assertEqual(img.size, (100, 150))
+
+    def test_mresize_pads(self):
+        renderer = LazyThumbRenderer()
+        img = renderer.mresize(width=200, height=200, img=self.img.resize((300, 400)))
+        self.assertEqual(img.size, (200, 200))
+        img = renderer.mresize(width=200, height=300, img=self.img.resize((300, 400)))
+        self.assertEqual(img.size, (200, 300))
+        self.assertEqual(img.getpixel((100, 0)), (0, 0, 0))
+        self.assertEqual(img.getpixel((100, 299)), (0, 0, 0))
+
+    def test_aresize_mattes_only_padding(self):
+        renderer = LazyThumbRenderer()
+        with patch('lazythumbs.views.MATTE_BACKGROUND_COLOR', (255, 0, 0)):
+            img = renderer.aresize(width=200, height=100, img=self.img.convert('L'))
+            self.assertEqual((img.size, img.mode), ((200, 100), 'RGB'))
+            img = renderer.aresize_no_crop(width=200, height=200, img=self.img)
+        self.assertEqual(img.size, (200, 200))
+        self.assertEqual(img.getpixel((100, 0)), (255, 0, 0))
+
+    def test_aresize_scaled_to_nothing(self):
+        """ A source too thin to keep a pixel at the target's scale can't be rendered """
+        renderer = LazyThumbRenderer()
+        self.assertRaises(ValueError, renderer.aresize, width=23, height=13, img=self.img.resize((27, 493)))
+        self.assertRaises(ValueError, renderer.aresize_no_crop, width=100, height=99, img=self.img.resize((5000, 20)))
+
+
 class TestScale(TestCase):
 
     def test_maximum_width_and_height(self):
@@ -64,6 +113,82 @@ class TestScale(TestCase):
         self.assertRaises(ValueError, renderer.scale, 200, 200)
 
 
+class TestReducedDecode(MediaTestCase):
+    """ Test decoding sources at a reduced scale for downscaling actions """
+
+    def setUp(self):
+        super(TestReducedDecode, self).setUp()
+        self.save_image('big.jpg', (1600, 1200), (255, 0, 0), format='JPEG')
+        self.renderer = LazyThumbRenderer()
+
+    def test_jpeg_draft(self):
+        """
+        A JPEG is decoded at the largest DCT scale that keeps it at least
+        twice the target size.
+        """
+        img = self.renderer.get_pil_from_path('big.jpg', 150, None)
+        self.assertEqual(img.size, (400, 300))
+
+    def test_no_target(self):
+        img = self.renderer.get_pil_from_path('big.jpg')
+        self.assertEqual(img.size, (1600, 1200))
+
+    def test_decode_no_target(self):
+        """ A JPEG headed for no target is budgeted and decoded at full size """
+        img = Image.open(os.path.join(self.media_root, 'big.jpg'))
+        with patch.object(self.renderer, 'reduce_for_target') as reduce_for_target:
+            with patch.object(self.renderer, 'check_budget') as check_budget:
+                img = self.renderer.decode(img, 'big.jpg')
+        self.assertFalse(reduce_for_target.called)
+        check_budget.assert_called_once_with(img, 'big.jpg', None, None)
+        self.assertEqual(img.size, (1600, 1200))
+
+    def test_target_near_source(self):
+        img = self.renderer.get_pil_from_path('big.jpg', 1000, 1000)
+        self.assertEqual(img.size, (1600, 1200))
+
+    def test_disabled(self):
+        with patch('lazythumbs.views.REDUCING_GAP', None):
+            img = self.renderer.get_pil_from_path('big.jpg', 150, None)
+        self.assertEqual(img.size, (1600, 1200))
+
+    def test_thumbnail_from_draft(self):
+        img = self.renderer.thumbnail(width=150, img_path='big.jpg')
+        self.assertEqual(img.size, (150, 112))
+
+    def test_thumbnail_sized_from_source(self):
+        """
+        The missing dimension comes from the source's size, not from the
+        draft's, which is rounded up.
+        """
+        for size, width, expected in (((4000, 3001), 333, (333, 249)), ((5001, 333), 150, (150, 9))):
+            Image.new('RGB', size).save(os.path.join(self.media_root, 'odd.jpg'), format='JPEG')
+            img = self.renderer.thumbnail(width=width, img_path='odd.jpg')
+            self.assertEqual(img.size, expected)
+
+    def test_reduce(self):
+        """
+        Formats without draft support are reduced by an integer factor when
+        Image.reduce() is available.
+        """
+        mock_img = Mock()
+        mock_img.format = 'PNG'
+        mock_img.mode = 'RGB'
+        mock_img.size = (1000, 1000)
+        img = self.renderer.reduce_for_target(mock_img, 150, 150)
+        mock_img.reduce.assert_called_once_with(3)
+        self.assertEqual(img, mock_img.reduce.return_value)
+
+    def test_reduce_palette(self):
+        mock_img = Mock()
+        mock_img.format = 'GIF'
+        mock_img.mode = 'P'
+        mock_img.size = (1000, 1000)
+        img = self.renderer.reduce_for_target(mock_img, 150, 150)
+        self.assertFalse(mock_img.reduce.called)
+        self.assertEqual(img, mock_img)
+
+
 class RenderTest(TestCase):
     """ test image rendering process """
 
@@ -80,6 +205,24 @@ class RenderTest(TestCase):
         renderer = MyRenderer()
         self.assertTrue('myaction' in renderer.allowed_actions)
 
+    def test_action_registry(self):
+        """ Actions are listed on the class, and overriding one can drop it """
+        class MyRenderer(LazyThumbRenderer):
+            def scale(self, *args, **kwargs):  # pragma: no cover
+                pass
+
+        self.assertTrue('thumbnail' in LazyThumbRenderer.allowed_actions)
+        self.assertTrue('scale' in LazyThumbRenderer.allowed_actions)
+        self.assertFalse('scale' in MyRenderer.allowed_actions)
+        self.assertFalse('get' in MyRenderer.allowed_actions)
+
+    def test_shared_storage(self):
+        self.assertTrue(LazyThumbRenderer().fs is LazyThumbRenderer().fs)
+        renderer = LazyThumbRenderer()
+        renderer.fs = storage = Mock()
+        self.assertTrue(renderer.fs is storage)
+        self.assertFalse(LazyThumbRenderer().fs is storage)
+
     def test_thumbnail_noop(self):
         """
         Test that no image operations occur if the desired w/h match image's
@@ -142,10 +285,10 @@ class RenderTest(TestCase):
         renderer = LazyThumbRenderer()
         mock_img = MockImg()
         img = renderer.resize(width=48, height=50, img=mock_img)
-        self.assertEqual(img.size[1], 50)
-        self.assertEqual(len(mock_img.called), 2)
-        self.assertTrue('crop' in mock_img.called)
-        self.assertTrue('resize' in mock_img.called)
+        self.assertEqual(img.size, (48, 50))
+        # thumbnails to 50x50 and crops a pixel off each side in one resample
+        self.assertEqual(mock_img.called, ['resize'])
+        self.assertEqual(mock_img.box, (20, 0, 980, 1000))
 
     def test_resize_no_img(self):
         renderer = LazyThumbRenderer()
@@ -171,15 +314,17 @@ class RenderTest(TestCase):
         mock_img = MockImg(width=1500, height=1000)
         mock_Image = Mock()
 
-        # aresize 1500x1000 => 750x400 should thumbnail to 750x500 and then
-        # paste into the center of a new image, losing some top/bottom content.
+        # aresize 1500x1000 => 750x400 should thumbnail to 750x500 and
+        # center-crop, losing some top/bottom content. Only the kept part of
+        # the source is resampled, and there's nothing to matte.
         with patch('lazythumbs.views.Image', mock_Image):
             img = renderer.aresize(width=750, height=400, img=mock_img)
 
         self.assertEqual(mock_img.called, ['resize'])
-        self.assertEqual(img, mock_Image.new.return_value)
-        self.assertEqual(mock_Image.new.call_args[1]['size'], (750, 400))
-        img.paste.assert_called_once_with(mock_img, (0, -50))
+        self.assertEqual(mock_img.box, (0, 100, 1500, 900))
+        self.assertEqual(img, mock_img)
+        self.assertEqual(img.size, (750, 400))
+        self.assertFalse(mock_Image.new.called)
 
     def test_aresize_height(self):
         """
@@ -189,15 +334,16 @@ class RenderTest(TestCase):
         mock_img = MockImg(width=2000, height=1000)
         mock_Image = Mock()
 
-        # aresize 2000x1000 => 1000x800 should thumbnail to 1600x800 and then
-        # paste into the center of a new image, losing some left/right content.
+        # aresize 2000x1000 => 1000x800 should thumbnail to 1600x800 and
+        # center-crop, losing some left/right content.
         with patch('lazythumbs.views.Image', mock_Image):
             img = renderer.aresize(width=1000, height=800, img=mock_img)
 
         self.assertEqual(mock_img.called, ['resize'])
-        self.assertEqual(img, mock_Image.new.return_value)
-        self.assertEqual(mock_Image.new.call_args[1]['size'], (1000, 800))
-        img.paste.assert_called_once_with(mock_img, (-300, 0))
+        self.assertEqual(mock_img.box, (375, 0, 1625, 1000))
+        self.assertEqual(img, mock_img)
+        self.assertEqual(img.size, (1000, 800))
+        self.assertFalse(mock_Image.new.called)
 
     def test_aresize_portrait(self):
         """
@@ -361,6 +507,7 @@ class GetViewTest(TestCase):
         self.mock_img = Mock()
         self.mock_Image.open = Mock(return_value=self.mock_img)
         self.mock_img.size = [1,1]
+        self.mock_img.info = {}
 
     def test_img_404_warm_cache(self):
         """
@@ -401,10 +548,14 @@ class GetViewTest(TestCase):
         """
         req = Mock()
         req.path = "/lt_cache/thumbnail/48/i/p.jpg"
-        self.renderer.fs.save = Mock()
-        with patch('lazythumbs.views.Image', self.mock_Image):
-            with patch('lazythumbs.views.cache', MockCache()) as mc:
-                resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+        media_root = tempfile.mkdtemp()
+        self.renderer.fs = FileSystemStorage(location=media_root)
+        try:
+            with patch('lazythumbs.views.Image', self.mock_Image):
+                with patch('lazythumbs.views.cache', MockCache()) as mc:
+                    resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+        finally:
+            shutil.rmtree(media_root)
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp['Content-Type'], 'image/jpeg')
@@ -416,21 +567,100 @@ class GetViewTest(TestCase):
         cached = mc.cache[key]
         self.assertEqual(cached, False)
 
-    def test_no_img_should_404(self):
+    def test_coalesced_render(self):
         """
-        When save fails with EEXIST error, it will try to read the file again
-        But if it still can't be read, make sure it returns a 404 instead of 0-byte image.
+        A request that waited on another request rendering the same path
+        serves that request's output instead of rendering again.
         """
         req = Mock()
         req.path = "/lt_cache/thumbnail/48/i/p.jpg"
-        self.renderer.fs.save = Mock()
-        err = OSError()
-        err.errno = errno.EEXIST
-        self.renderer.fs.save.side_effect = err
-        with patch('lazythumbs.views.Image', self.mock_Image):
+        self.renderer.fs = FileSystemStorage()
+        self.renderer.fs.open = Mock(side_effect=[IOError(), Mock(read=Mock(return_value='data'))])
+        self.renderer.render = Mock()
+        lock = Mock(waited=True, acquired=True)
+        lock.__enter__ = Mock(return_value=lock)
+        lock.__exit__ = Mock(return_value=False)
+        self.renderer.render_lock = Mock(return_value=lock)
+        with patch('lazythumbs.views.cache', MockCache()):
+            resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'data')
+        self.assertFalse(self.renderer.render.called)
+
+    def test_coalesced_404(self):
+        """
+        A request that waited on another request which found no source 404s
+        without trying again.
+        """
+        req = Mock()
+        req.path = "/lt_cache/thumbnail/48/i/p.jpg"
+        self.renderer.render = Mock()
+        lock = Mock(waited=True, acquired=True)
+        lock.__enter__ = Mock(return_value=lock)
+        lock.__exit__ = Mock(return_value=False)
+        self.renderer.render_lock = Mock(return_value=lock)
+        with patch('lazythumbs.views.cache', self.mc_factory(None)) as mc:
+            mc.get.side_effect = [None, 1]
+            resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+        self.assertEqual(resp.status_code, 404)
+        self.assertFalse(self.renderer.render.called)
+
+    def test_executor_busy(self):
+        """ A full render executor results in a quick 503. """
+        req = Mock()
+        req.path = "/lt_cache/thumbnail/48/i/p.jpg"
+        executor = Mock()
+        executor.render.side_effect = QueueFull()
+        with patch('lazythumbs.views.render_executor', executor):
+            with patch('lazythumbs.views.cache', MockCache()) as mc:
+                resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp['Retry-After'], '2')
+        self.assertEqual(mc.cache, {})
+
+    def test_executor_render(self):
+        req = Mock()
+        req.path = "/lt_cache/thumbnail/48/i/p.jpg"
+        executor = Mock()
+        executor.render.return_value = 'data'
+        with patch('lazythumbs.views.render_executor', executor):
             with patch('lazythumbs.views.cache', MockCache()):
                 resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
-        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'data')
+        executor.render.assert_called_once_with(
+            self.renderer, 10, 'thumbnail', 48, None, 'i/p', 'lt_cache/thumbnail/48/i/p.jpg')
+
+    @override_settings(STATIC_URL='/static/')
+    def test_missing_source_filter(self):
+        """
+        Once a source is known to be missing, any geometry of it 404s without
+        a cache lookup.
+        """
+        req = Mock()
+        req.path = "/lt_cache/thumbnail/48/i/p.jpg"
+        with patch('lazythumbs.views.missing_sources', RotatingBloomFilter(100, 0.001, 60)) as missing:
+            with patch('lazythumbs.views.cache', MockCache()):
+                resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+            self.assertEqual(resp.status_code, 404)
+            self.assertTrue('i/p' in missing)
+
+            req.path = "/lt_cache/resize/10/i/p.jpg"
+            with patch('lazythumbs.views.cache') as mc:
+                resp = self.renderer.get(req, 'resize', '10', 'i/p')
+            self.assertEqual(resp.status_code, 404)
+            self.assertFalse(mc.get.called)
+
+    def test_missing_source_filter_bad_image(self):
+        """ Sources that exist but can't be read aren't taken for missing. """
+        req = Mock()
+        req.path = "/lt_cache/thumbnail/48/i/p.jpg"
+        self.renderer.render = Mock(side_effect=IOError('cannot identify image file'))
+        with patch('lazythumbs.views.missing_sources', RotatingBloomFilter(100, 0.001, 60)) as missing:
+            with patch('lazythumbs.views.cache', MockCache()):
+                resp = self.renderer.get(req, 'thumbnail', '48', 'i/p')
+            self.assertEqual(resp.status_code, 404)
+            self.assertFalse('i/p' in missing)
 
     def test_naughty_paths_root(self):
         resp = self.renderer.get(None, 'thumbnail', '48', '/')
@@ -449,6 +679,547 @@ class GetViewTest(TestCase):
         self.assertEqual(resp.status_code, 404)
 
 
+class DeliveryTest(MediaTestCase):
+    """ Test the ways an already rendered image can be delivered """
+
+    def setUp(self):
+        super(DeliveryTest, self).setUp()
+        self.renderer = LazyThumbRenderer()
+        self.renderer.fs = FileSystemStorage(location=self.media_root)
+        self.rendered_path = 'lt_cache/thumbnail/48/i/p.jpg'
+        self.renderer.fs.save(self.rendered_path, ContentFile('data'))
+        self.request = RequestFactory().get('/' + self.rendered_path)
+
+    def respond(self, delivery, rendered_path=None):
+        with patch('lazythumbs.views.DELIVERY', delivery):
+            return self.renderer.cached_response(
+                self.request, rendered_path or self.rendered_path, 'JPEG')
+
+    def test_read(self):
+        resp = self.respond('read')
+        self.assertEqual(resp.content, 'data')
+        self.assertEqual(resp['Content-Type'], 'image/jpeg')
+        self.assertTrue('Cache-Control' in resp)
+
+    def test_stream(self):
+        resp = self.respond('stream')
+        self.assertEqual(''.join(resp), 'data')
+        self.assertEqual(resp['Content-Length'], '4')
+        self.assertEqual(resp['Content-Type'], 'image/jpeg')
+        self.assertTrue('Cache-Control' in resp)
+
+    def test_x_sendfile(self):
+        resp = self.respond('x-sendfile')
+        self.assertEqual(resp.content, '')
+        self.assertEqual(resp['X-Sendfile'], os.path.join(self.media_root, self.rendered_path))
+        self.assertTrue('Cache-Control' in resp)
+
+    def test_x_sendfile_remote(self):
+        """ Renders in a storage without local paths are streamed instead """
+        self.renderer.fs = InMemoryStorage()
+        self.renderer.fs.save(self.rendered_path, ContentFile('data'))
+        try:
+            resp = self.respond('x-sendfile')
+            self.assertEqual(''.join(resp), 'data')
+            self.assertFalse(resp.has_header('X-Sendfile'))
+            self.assertRaises(IOError, self.respond, 'x-sendfile', 'lt_cache/thumbnail/48/i/q.jpg')
+        finally:
+            InMemoryStorage.files.clear()
+
+    def test_x_accel_redirect(self):
+        resp = self.respond('x-accel-redirect')
+        self.assertEqual(resp.content, '')
+        self.assertEqual(resp['X-Accel-Redirect'], '/lt_internal/' + self.rendered_path)
+
+    def test_missing(self):
+        for delivery in ('read', 'stream', 'x-sendfile', 'x-accel-redirect'):
+            self.assertRaises(IOError, self.respond, delivery, 'lt_cache/thumbnail/48/i/q.jpg')
+
+    def test_view_offloads_hit(self):
+        """ The view never reads a cached render when it can offload it. """
+        self.renderer.fs.open = Mock()
+        with patch('lazythumbs.views.DELIVERY', 'x-accel-redirect'):
+            with patch('lazythumbs.views.cache', MockCache()):
+                resp = self.renderer.get(self.request, 'thumbnail', '48', 'i/p.jpg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('X-Accel-Redirect' in resp)
+        self.assertFalse(self.renderer.fs.open.called)
+
+
+class ConditionalGetTest(MediaTestCase):
+    """ Test validators and 304 responses for rendered images """
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.renderer = LazyThumbRenderer()
+        self.renderer.fs = FileSystemStorage(location=self.media_root)
+        self.rendered_path = 'lt_cache/thumbnail/48/i/p.jpg'
+        self.renderer.fs.save(self.rendered_path, ContentFile('data'))
+        full_path = os.path.join(self.media_root, self.rendered_path)
+        os.utime(full_path, (1000000000, 1000000000))
+        self.etag = '"3b9aca00-4"'
+        self.last_modified = 'Sun, 09 Sep 2001 01:46:40 GMT'
+
+    def get(self, **headers):
+        request = RequestFactory().get('/' + self.rendered_path, **headers)
+        with patch('lazythumbs.views.cache', MockCache()):
+            return self.renderer.get(request, 'thumbnail', '48', 'i/p.jpg')
+
+    def test_validators(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['ETag'], self.etag)
+        self.assertEqual(resp['Last-Modified'], self.last_modified)
+
+    def test_if_none_match(self):
+        self.renderer.fs.open = Mock()
+        resp = self.get(HTTP_IF_NONE_MATCH='"other", %s' % self.etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, '')
+        self.assertEqual(resp['ETag'], self.etag)
+        self.assertTrue('Cache-Control' in resp)
+        self.assertFalse(self.renderer.fs.open.called)
+
+    def test_if_none_match_weak(self):
+        resp = self.get(HTTP_IF_NONE_MATCH='W/%s' % self.etag)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_if_none_match_stale(self):
+        resp = self.get(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=self.last_modified)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'data')
+
+    def test_if_modified_since(self):
+        resp = self.get(HTTP_IF_MODIFIED_SINCE=self.last_modified)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_if_modified_since_stale(self):
+        resp = self.get(HTTP_IF_MODIFIED_SINCE='Sat, 08 Sep 2001 01:46:40 GMT')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_fresh_render(self):
+        """ A newly rendered image carries validators too. """
+        self.renderer.fs.delete(self.rendered_path)
+
+        def render(action, width, height, source_path, rendered_path):
+            self.renderer.fs.save(rendered_path, ContentFile('new'))
+            return 'new'
+
+        self.renderer.render = Mock(side_effect=render)
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'new')
+        self.assertTrue(resp['ETag'].endswith('-3"'))
+
+    def test_memory_cache(self):
+        """
+        Rendered images are kept in memory and served from there without
+        touching the django cache or the filesystem.
+        """
+        with patch('lazythumbs.views.memory_cache', ByteLRU(1000)) as lru:
+            self.get()
+            self.assertEqual(lru.get(self.rendered_path), ('data', self.etag, 1000000000))
+            self.renderer.fs = Mock()
+            with patch('lazythumbs.views.cache') as cache:
+                resp = self.get()
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.content, 'data')
+                self.assertEqual(resp['ETag'], self.etag)
+                resp = self.get(HTTP_IF_NONE_MATCH=self.etag)
+                self.assertEqual(resp.status_code, 304)
+            self.assertFalse(cache.get.called)
+            self.assertFalse(self.renderer.fs.method_calls)
+
+    def test_disabled(self):
+        with patch('lazythumbs.views.CONDITIONAL_GET', False):
+            resp = self.get(HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse('ETag' in resp)
+
+
+class NoopTest(MediaTestCase):
+    """ Test serving renders that would not change their source """
+
+    def setUp(self):
+        super(NoopTest, self).setUp()
+        self.source = self.save_image('i/p.jpg', format='JPEG')
+        self.renderer = LazyThumbRenderer()
+        self.renderer.fs = FileSystemStorage(location=self.media_root)
+
+    def get(self, action, geometry, source_path='i/p.jpg', noop_response='serve', cache=None, **headers):
+        request = RequestFactory().get('/lt_cache/%s/%s/%s' % (action, geometry, source_path), **headers)
+        with patch('lazythumbs.views.NOOP_RESPONSE', noop_response):
+            with patch('lazythumbs.views.cache', cache or MockCache()):
+                return self.renderer.get(request, action, geometry, source_path)
+
+    def test_is_noop(self):
+        img = Mock(size=(100, 80), mode='RGB')
+        noop = lambda a, w, h: self.renderer.is_noop(a, w, h, img)
+        self.assertTrue(noop('thumbnail', 100, None))
+        self.assertTrue(noop('thumbnail', None, 200))
+        self.assertFalse(noop('thumbnail', 50, None))
+        self.assertFalse(noop('thumbnail', 50, 50))
+        self.assertTrue(noop('resize', 100, 100))
+        self.assertFalse(noop('resize', 100, 50))
+        self.assertTrue(noop('mresize', 100, 80))
+        self.assertFalse(noop('mresize', 100, 100))
+        self.assertTrue(noop('aresize', 100, 80))
+        self.assertFalse(noop('aresize', 100, 100))
+        self.assertTrue(noop('aresize_no_crop', 100, 80))
+        self.assertTrue(noop('scale', 200, 200))
+        self.assertFalse(noop('scale', 200, 50))
+        self.assertTrue(noop('matte', 100, 80))
+        self.assertFalse(noop('matte', 200, 200))
+        self.assertFalse(noop('unknown', 100, 80))
+        img.mode = 'P'
+        self.assertFalse(noop('scale', 200, 200))
+        self.assertFalse(noop('matte', 100, 80))
+
+    def test_thumbnail_is_noop_agrees_with_thumbnail(self):
+        img = Image.new('RGB', (100, 80))
+        for width, height in ((100, None), (99, None), (3, None), (None, 80), (None, 79), (None, 3)):
+            noop = self.renderer.is_noop('thumbnail', width, height, img)
+            self.assertEqual(noop, self.renderer.thumbnail(width, height, img=img) is img)
+
+    def test_serve(self):
+        resp = self.get('thumbnail', '200')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, open(self.source, 'rb').read())
+        self.assertTrue('ETag' in resp)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'lt_cache')))
+
+    def test_serve_not_modified(self):
+        etag = self.get('thumbnail', '200')['ETag']
+        resp = self.get('thumbnail', '200', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_serve_stream(self):
+        with patch('lazythumbs.views.DELIVERY', 'stream'):
+            resp = self.get('thumbnail', '200')
+        self.assertEqual(''.join(resp), open(self.source, 'rb').read())
+
+    def test_serve_x_sendfile(self):
+        with patch('lazythumbs.views.DELIVERY', 'x-sendfile'):
+            resp = self.get('thumbnail', '200')
+        self.assertEqual(resp['X-Sendfile'], self.source)
+
+    def test_redirect(self):
+        resp = self.get('resize', '200x200', noop_response='redirect')
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp['Location'], 'http://media.example.com/media/i/p.jpg')
+
+    def test_remembered(self):
+        """ A no-op is remembered in cache and the source isn't probed again. """
+        cache = MockCache()
+        self.get('thumbnail', '200', cache=cache)
+        self.assertEqual(cache.cache.values(), [2])
+        self.renderer.probe = Mock()
+        resp = self.get('thumbnail', '200', cache=cache)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(self.renderer.probe.called)
+
+    def test_render(self):
+        resp = self.get('thumbnail', '50')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'lt_cache/thumbnail/50/i/p.jpg')))
+
+    def test_format_change(self):
+        """ A no-op that changes format is still rendered. """
+        os.rename(self.source, os.path.join(self.media_root, 'i', 'p.png'))
+        resp = self.get('thumbnail', '200', source_path='i/p.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'lt_cache/thumbnail/200/i/p.png')))
+
+    def test_missing(self):
+        resp = self.get('thumbnail', '200', source_path='i/q.jpg')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_disabled(self):
+        resp = self.get('thumbnail', '200', noop_response=None)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'lt_cache/thumbnail/200/i/p.jpg')))
+
+
+class StorageTest(MediaTestCase):
+    """ Test rendering to configurable storage, now or in the background """
+
+    def setUp(self):
+        super(StorageTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        InMemoryStorage.files.clear()
+        self.patch_views('STORAGE', 'lazythumbs.tests.storage.InMemoryStorage')
+        self.renderer = LazyThumbRenderer()
+        self.rendered_path = 'lt_cache/thumbnail/50/i/p.jpg'
+
+    def tearDown(self):
+        super(StorageTest, self).tearDown()
+        InMemoryStorage.files.clear()
+
+    def get(self):
+        request = RequestFactory().get('/' + self.rendered_path)
+        with patch('lazythumbs.views.cache', MockCache()):
+            return self.renderer.get(request, 'thumbnail', '50', 'i/p.jpg')
+
+    def test_storage_class(self):
+        self.assertTrue(isinstance(self.renderer.fs, InMemoryStorage))
+
+    def test_render(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(InMemoryStorage.files[self.rendered_path][0], resp.content)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'lt_cache')))
+
+        self.renderer.render = Mock()
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('ETag' in resp)
+        self.assertFalse(self.renderer.render.called)
+
+    def test_write_behind(self):
+        """
+        The response doesn't wait for the save, and until the save is done
+        the image is served from what is waiting to be saved.
+        """
+        saving = threading.Event()
+        store = self.renderer.store
+        self.renderer.store = lambda *args: saving.wait(5) and store(*args)
+        with patch('lazythumbs.views.write_behind', WriteBehind(10)) as write_behind:
+            resp = self.get()
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(self.rendered_path in InMemoryStorage.files)
+
+            self.renderer.render = Mock()
+            self.assertEqual(self.get().content, resp.content)
+            self.assertFalse(self.renderer.render.called)
+
+            saving.set()
+            write_behind.join()
+        self.assertEqual(InMemoryStorage.files[self.rendered_path][0], resp.content)
+
+
+class AtomicStoreTest(MediaTestCase):
+    """ Test that renders reach the filesystem whole or not at all """
+
+    def setUp(self):
+        super(AtomicStoreTest, self).setUp()
+        self.renderer = LazyThumbRenderer()
+        self.rendered_path = 'lt_cache/thumbnail/50/i/p.jpg'
+        self.path = os.path.join(self.media_root, self.rendered_path)
+
+    def test_store(self):
+        self.renderer.store(self.rendered_path, 'data')
+        self.assertEqual(open(self.path).read(), 'data')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['p.jpg'])
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+
+    def test_replace(self):
+        """ A second render of the same image replaces the first in place """
+        self.renderer.store(self.rendered_path, 'old')
+        self.renderer.store(self.rendered_path, 'new')
+        self.assertEqual(open(self.path).read(), 'new')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['p.jpg'])
+
+    def test_failed_write(self):
+        """ A failed write leaves neither a partial image nor a temp file """
+        self.renderer.store(self.rendered_path, 'old')
+        with patch('lazythumbs.views.os.rename', Mock(side_effect=OSError(errno.EXDEV, 'no'))):
+            self.assertRaises(OSError, self.renderer.store, self.rendered_path, 'new')
+        self.assertEqual(open(self.path).read(), 'old')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['p.jpg'])
+
+    def test_encode_to_file(self):
+        """ Renders are encoded straight into the file, not an in-memory buffer """
+        img = Image.new('RGB', (40, 30), (255, 0, 0))
+        with patch('lazythumbs.views.StringIO', Mock(side_effect=AssertionError)):
+            raw_data = self.renderer.encode_and_store(img, 'JPEG', self.rendered_path)
+        self.assertEqual(open(self.path).read(), raw_data)
+        self.assertEqual(Image.open(self.path).size, (40, 30))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['p.jpg'])
+
+        # options the policy gets wrong are dropped without leaving their output behind
+        with patch('lazythumbs.views.encoder_policy.prepare', Mock(return_value={'format': 'JPEG', 'quality': 'x'})):
+            raw_data = self.renderer.encode_and_store(img, 'JPEG', self.rendered_path)
+        self.assertEqual(open(self.path).read(), raw_data)
+        self.assertEqual(Image.open(StringIO(raw_data)).size, (40, 30))
+
+
+class WebPTest(MediaTestCase):
+    """ Test serving WebP renders to clients that accept them """
+
+    def setUp(self):
+        super(WebPTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        self.save_image('i/p.gif', mode='P', format='GIF')
+        self.renderer = LazyThumbRenderer()
+        self.patch_views('WEBP', True)
+
+    def get(self, source_path='i/p.jpg', accept='image/webp,*/*'):
+        request = RequestFactory().get('/lt_cache/thumbnail/50/' + source_path, HTTP_ACCEPT=accept)
+        with patch('lazythumbs.views.cache', MockCache()):
+            return self.renderer.get(request, 'thumbnail', '50', source_path)
+
+    def test_webp(self):
+        resp = self.get()
+        self.assertEqual(resp['Content-Type'], 'image/webp')
+        self.assertEqual(resp['Vary'], 'Accept')
+        rendered = os.path.join(self.media_root, 'lt_cache/thumbnail/50/i/p.jpg.webp')
+        self.assertEqual(Image.open(rendered).format, 'WEBP')
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'lt_cache/thumbnail/50/i/p.jpg')))
+
+        self.renderer.render = Mock()
+        self.assertEqual(self.get().content, resp.content)
+        self.assertFalse(self.renderer.render.called)
+
+    def test_not_accepted(self):
+        for accept in ('image/jpeg,*/*', 'image/webp;q=0,*/*', ''):
+            resp = self.get(accept=accept)
+            self.assertEqual(resp['Content-Type'], 'image/jpeg')
+            self.assertEqual(resp['Vary'], 'Accept')
+
+    def test_not_negotiated(self):
+        resp = self.get('i/p.gif')
+        self.assertEqual(resp['Content-Type'], 'image/gif')
+        self.assertFalse(resp.has_header('Vary'))
+
+        with patch('lazythumbs.views.WEBP', False):
+            resp = self.get()
+        self.assertEqual(resp['Content-Type'], 'image/jpeg')
+        self.assertFalse(resp.has_header('Vary'))
+
+    def test_conditional_get(self):
+        etag = self.get()['ETag']
+        request = RequestFactory().get(
+            '/lt_cache/thumbnail/50/i/p.jpg', HTTP_ACCEPT='image/webp', HTTP_IF_NONE_MATCH=etag)
+        with patch('lazythumbs.views.cache', MockCache()):
+            resp = self.renderer.get(request, 'thumbnail', '50', 'i/p.jpg')
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['Vary'], 'Accept')
+
+
+class RenderManyTest(MediaTestCase):
+    """ Test rendering several geometries of a source from one decode """
+
+    def setUp(self):
+        super(RenderManyTest, self).setUp()
+        self.save_image('i/p.jpg', (1600, 1200), (255, 0, 0), format='JPEG')
+        self.renderer = LazyThumbRenderer()
+
+    def rendered(self, rendered_path):
+        return Image.open(os.path.join(self.media_root, rendered_path))
+
+    def test_render_many(self):
+        self.renderer.get_pil_from_path = Mock()
+        results = self.renderer.render_many('i/p.jpg', [
+            ('thumbnail', 100, None, 'lt_cache/thumbnail/100/i/p.jpg'),
+            ('matte', 200, 200, 'lt_cache/matte/200x200/i/p.jpg'),
+            ('resize', 300, 100, 'lt_cache/resize/300x100/i/p.png'),
+            ('thumbnail', 100, 100, 'lt_cache/thumbnail/100x100/i/p.jpg'),
+        ])
+        self.assertFalse(self.renderer.get_pil_from_path.called)
+        self.assertEqual(self.rendered('lt_cache/thumbnail/100/i/p.jpg').size, (100, 75))
+        self.assertEqual(self.rendered('lt_cache/matte/200x200/i/p.jpg').size, (200, 200))
+        self.assertEqual(self.rendered('lt_cache/resize/300x100/i/p.png').format, 'PNG')
+        self.assertEqual(results[1], open(os.path.join(self.media_root, 'lt_cache/matte/200x200/i/p.jpg')).read())
+        self.assertTrue(isinstance(results[3], ValueError))
+
+    def test_decode_scale(self):
+        """ The source is decoded large enough for the largest render """
+        img = self.renderer.probe('i/p.jpg')
+        self.renderer.probe = Mock(return_value=img)
+        self.renderer.render_many('i/p.jpg', [
+            ('thumbnail', 100, None, 'lt_cache/thumbnail/100/i/p.jpg'),
+            ('thumbnail', 300, None, 'lt_cache/thumbnail/300/i/p.jpg'),
+        ])
+        self.assertEqual(img.size, (800, 600))
+        self.assertEqual(self.rendered('lt_cache/thumbnail/300/i/p.jpg').size, (300, 225))
+
+    def test_missing_source(self):
+        self.assertRaises(IOError, self.renderer.render_many, 'i/q.jpg', [
+            ('thumbnail', 100, None, 'lt_cache/thumbnail/100/i/q.jpg')])
+
+    def test_ladder(self):
+        """ A render on the ladder renders the rest of the ladder with it """
+        self.renderer.fs.save('lt_cache/thumbnail/400/i/p.jpg', ContentFile('data'))
+        request = RequestFactory().get('/lt_cache/thumbnail/200/i/p.jpg')
+        with patch('lazythumbs.views.RENDER_LADDER', {'thumbnail': ['100', '200', '400']}):
+            with patch('lazythumbs.views.cache', MockCache()):
+                resp = self.renderer.get(request, 'thumbnail', '200', 'i/p.jpg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(StringIO(resp.content)).size, (200, 150))
+        self.assertEqual(self.rendered('lt_cache/thumbnail/100/i/p.jpg').size, (100, 75))
+        self.assertEqual(open(os.path.join(self.media_root, 'lt_cache/thumbnail/400/i/p.jpg')).read(), 'data')
+
+    def test_off_ladder(self):
+        with patch('lazythumbs.views.RENDER_LADDER', {'thumbnail': ['100', '200']}):
+            self.assertEqual(self.renderer.ladder_siblings(
+                'thumbnail', '300', 'i/p.jpg', 'lt_cache/thumbnail/300/i/p.jpg'), [])
+            self.assertEqual(self.renderer.ladder_siblings(
+                'resize', '100x100', 'i/p.jpg', 'lt_cache/resize/100x100/i/p.jpg'), [])
+            self.assertEqual(self.renderer.ladder_siblings(
+                'thumbnail', '200', 'i/p.jpg', 'lt/lt_cache/thumbnail/200/i/p.jpg.webp'),
+                [('thumbnail', 100, None, 'lt/lt_cache/thumbnail/100/i/p.jpg.webp')])
+
+
+class PyramidTest(MediaTestCase):
+    """ Test rendering from larger renders of the same source """
+
+    def setUp(self):
+        super(PyramidTest, self).setUp()
+        self.save_image('i/p.jpg', (1600, 1200), (255, 0, 0), format='JPEG')
+        self.renderer = LazyThumbRenderer()
+        self.patch_views('PYRAMID', True)
+        self.cache = self.patch_views('cache', MockCache())
+        self.renderer.render('thumbnail', 800, None, 'i/p.jpg', 'lt_cache/thumbnail/800/i/p.jpg')
+
+    def render(self, action, width, height):
+        geometry = '%sx%s' % (width, height) if height else str(width)
+        rendered_path = 'lt_cache/%s/%s/i/p.jpg' % (action, geometry)
+        return Image.open(StringIO(self.renderer.render(action, width, height, 'i/p.jpg', rendered_path)))
+
+    def test_index(self):
+        self.assertEqual(self.cache.cache.values(), [{'lt_cache/thumbnail/800/i/p.jpg': ((800, 600), (1600, 1200))}])
+        self.render('resize', 100, 100)
+        self.assertEqual(len(self.cache.cache.values()[0]), 1)
+
+    def test_from_level(self):
+        self.renderer.get_pil_from_path = Mock(side_effect=AssertionError('decoded source'))
+        self.assertEqual(self.render('thumbnail', 400, None).size, (400, 300))
+        self.assertEqual(self.render('resize', 200, 200).size, (200, 200))
+        # renders of a level don't become levels
+        self.assertEqual(len(self.cache.cache.values()[0]), 1)
+
+    def test_sized_from_source(self):
+        """
+        Thumbnails of a level take their missing dimension from the source,
+        not from the level, whose own was rounded down.
+        """
+        Image.new('RGB', (6000, 4000)).save(os.path.join(self.media_root, 'i', 'p.jpg'), format='JPEG')
+        self.cache.cache.clear()
+        self.renderer.render('thumbnail', 1024, None, 'i/p.jpg', 'lt_cache/thumbnail/1024/i/p.jpg')
+        self.renderer.get_pil_from_path = Mock(side_effect=AssertionError('decoded source'))
+        self.assertEqual(self.render('thumbnail', 150, None).size, (150, 100))
+        self.assertEqual(self.render('thumbnail', 450, None).size, (450, 300))
+
+    def test_margin(self):
+        """ Renders too close to the size of every level use the source """
+        self.renderer.get_pil_from_path = Mock(wraps=self.renderer.get_pil_from_path)
+        self.assertEqual(self.render('thumbnail', 500, None).size, (500, 375))
+        self.assertTrue(self.renderer.get_pil_from_path.called)
+
+    def test_render_many(self):
+        self.renderer.probe = Mock(side_effect=AssertionError('decoded source'))
+        results = self.renderer.render_many('i/p.jpg', [
+            ('thumbnail', 100, None, 'lt_cache/thumbnail/100/i/p.jpg'),
+            ('matte', 300, 300, 'lt_cache/matte/300x300/i/p.jpg'),
+        ])
+        self.assertEqual(Image.open(StringIO(results[1])).size, (300, 300))
+
+    def test_missing_level(self):
+        os.unlink(os.path.join(self.media_root, 'lt_cache/thumbnail/800/i/p.jpg'))
+        self.assertEqual(self.render('thumbnail', 100, None).size, (100, 75))
+        self.assertEqual(self.cache.cache.values()[0].keys(), ['lt_cache/thumbnail/100/i/p.jpg'])
+
+
 class TestOddFiles(TestCase):
 
     def test_extensionless_gif(self):
@@ -0,0 +1,88 @@
+import os
+from cStringIO import StringIO
+from hashlib import md5
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.client import RequestFactory
+from mock import patch
+
+from lazythumbs.tests.base import MediaTestCase, MockCache
+from lazythumbs.views import LazyThumbRenderer
+
+
+class ShardTest(MediaTestCase):
+    """ Test storing renders in a hashed directory tree """
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self.save_image('i/p.jpg', format='JPEG')
+        self.patch_views('SHARD_DEPTH', 2)
+        self.renderer = LazyThumbRenderer()
+        self.rendered_path = 'lt/lt_cache/thumbnail/50/i/p.jpg'
+        hashed = md5(self.rendered_path).hexdigest()
+        self.name = 'lt/lt_cache/%s/%s/%s.jpg' % (hashed[:2], hashed[2:4], hashed)
+
+    def get(self):
+        request = RequestFactory().get('/' + self.rendered_path)
+        with patch('lazythumbs.views.cache', MockCache()):
+            return self.renderer.get(request, 'thumbnail', '50', 'i/p.jpg')
+
+    def test_storage_name(self):
+        self.assertEqual(self.renderer.storage_name(self.rendered_path), self.name)
+        self.assertEqual(self.renderer.storage_name(self.rendered_path, 0), self.rendered_path)
+        self.assertEqual(self.renderer.storage_name(u'lt_cache/thumbnail/50/i/\xe9.jpg.webp', 1)[-5:], '.webp')
+
+    def test_get(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(open(os.path.join(self.media_root, self.name)).read(), resp.content)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'lt', 'lt_cache', 'thumbnail')))
+
+        with patch('lazythumbs.views.DELIVERY', 'x-accel-redirect'):
+            resp = self.get()
+        self.assertEqual(resp['X-Accel-Redirect'], '/lt_internal/' + self.name)
+
+    def test_migrate(self):
+        with patch('lazythumbs.views.SHARD_DEPTH', 0):
+            self.get()
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.rendered_path)))
+
+        stdout = StringIO()
+        call_command('lazythumbs_shard', dry_run=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'would move 1 renders\n')
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.rendered_path)))
+
+        stdout = StringIO()
+        call_command('lazythumbs_shard', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'moved 1 renders\n')
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.name)))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'lt', 'lt_cache')), [self.name.split('/')[2]])
+
+        self.renderer.render = None
+        self.assertEqual(self.get().status_code, 200)
+
+        stdout = StringIO()
+        call_command('lazythumbs_shard', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'moved 0 renders\n')
+
+    def test_migrate_depth(self):
+        """ Renders sharded at another depth are moved by their hash """
+        with patch('lazythumbs.views.SHARD_DEPTH', 1):
+            self.get()
+        hashed = self.name.split('/')[-1]
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'lt', 'lt_cache', hashed[:2], hashed)))
+
+        stdout = StringIO()
+        call_command('lazythumbs_shard', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'moved 1 renders\n')
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.name)))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'lt', 'lt_cache', hashed[:2])), [hashed[2:4]])
+
+        self.renderer.render = None
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_migrate_needs_depth(self):
+        with patch('lazythumbs.views.SHARD_DEPTH', 0):
+            self.assertRaises(CommandError, call_command, 'lazythumbs_shard')
+
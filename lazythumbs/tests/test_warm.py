@@ -0,0 +1,87 @@
+import json
+import os
+from cStringIO import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from PIL import Image
+
+from lazythumbs.management.commands.lazythumbs_warm import find_sources
+from lazythumbs.tests.base import MediaTestCase
+
+
+class WarmTest(MediaTestCase):
+    """ Test the lazythumbs_warm management command """
+    settings_overrides = {'LAZYTHUMBS_USE_X_FOR_DIMENSIONS': True}
+
+    def setUp(self):
+        super(WarmTest, self).setUp()
+        for name in ('photos/one.jpg', 'photos/a/two.jpg'):
+            self.save_image(name, (400, 300), format='JPEG')
+        with open(os.path.join(self.media_root, 'photos', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        self.manifest = os.path.join(self.media_root, 'manifest.json')
+        with open(self.manifest, 'w') as f:
+            json.dump([['thumbnail', '100'], ['resize', '50x50']], f)
+
+    def warm(self, *patterns, **options):
+        stdout, stderr = StringIO(), StringIO()
+        options.setdefault('manifest', self.manifest)
+        options.setdefault('processes', 0)
+        call_command('lazythumbs_warm', *patterns, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def rendered(self, path):
+        return os.path.exists(os.path.join(self.media_root, 'media', 'lt', 'lt_cache', path))
+
+    def test_find_sources(self):
+        self.assertEqual(find_sources(self.media_root, ['photos/*.jpg']), ['photos/a/two.jpg', 'photos/one.jpg'])
+        self.assertEqual(find_sources(self.media_root, ['photos/a/*']), ['photos/a/two.jpg'])
+        self.assertEqual(find_sources(self.media_root, ['nothing/*']), [])
+
+    def test_warm(self):
+        out, err = self.warm('photos/*.jpg')
+        self.assertTrue('4 renders to do, 0 already rendered' in out)
+        self.assertTrue('rendered 4, skipped 0, failed 0' in out)
+        self.assertEqual(err, '')
+        self.assertTrue(self.rendered('thumbnail/100/photos/one.jpg'))
+        self.assertTrue(self.rendered('resize/50x50/photos/a/two.jpg'))
+        self.assertEqual(Image.open(os.path.join(
+            self.media_root, 'media/lt/lt_cache/thumbnail/100/photos/one.jpg')).size, (100, 75))
+
+    def test_resume(self):
+        """ Existing renders are skipped on a second run. """
+        self.warm('photos/one.jpg')
+        out, _ = self.warm('photos/*.jpg')
+        self.assertTrue('2 renders to do, 2 already rendered' in out)
+        self.assertTrue('rendered 2, skipped 2, failed 0' in out)
+
+    def test_force(self):
+        self.warm('photos/one.jpg')
+        out, _ = self.warm('photos/one.jpg', force=True)
+        self.assertTrue('rendered 2, skipped 0, failed 0' in out)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'media/lt/lt_cache/thumbnail/100/photos')), ['one.jpg'])
+
+    def test_failures(self):
+        out, err = self.warm('photos/*')
+        self.assertTrue('rendered 4, skipped 0, failed 2' in out)
+        self.assertTrue('photos/notes.txt' in err)
+
+    def test_pool(self):
+        out, _ = self.warm('photos/*.jpg', processes=2)
+        self.assertTrue('rendered 4, skipped 0, failed 0' in out)
+
+    def test_manifest_setting(self):
+        with override_settings(LAZYTHUMBS_WARM_MANIFEST=[['scale', '10']]):
+            out, _ = self.warm('photos/one.jpg', manifest=None)
+        self.assertTrue('rendered 1, skipped 0, failed 0' in out)
+        self.assertTrue(self.rendered('scale/10x10/photos/one.jpg'))
+
+    def test_bad_manifest(self):
+        with open(self.manifest, 'w') as f:
+            json.dump([['explode', '100']], f)
+        self.assertRaises(CommandError, self.warm, 'photos/*.jpg')
+        with open(self.manifest, 'w') as f:
+            json.dump([['resize', 'big']], f)
+        self.assertRaises(CommandError, self.warm, 'photos/*.jpg')
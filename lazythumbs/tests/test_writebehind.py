@@ -0,0 +1,49 @@
+import threading
+import time
+from unittest import TestCase
+
+from lazythumbs.writebehind import WriteBehind
+
+
+class WriteBehindTest(TestCase):
+    """ Test saving rendered images in the background """
+
+    def setUp(self):
+        self.saved = {}
+        self.release = threading.Event()
+
+    def slow_save(self, name, data):
+        self.release.wait(5)
+        self.saved[name] = data
+
+    def test_save(self):
+        write_behind = WriteBehind(10)
+        write_behind.submit(self.slow_save, 'a', 'aaaa')
+        # submit returned before the save finished
+        self.assertEqual(self.saved, {})
+        self.assertEqual(write_behind.pending('a'), 'aaaa')
+        self.release.set()
+        write_behind.join()
+        self.assertEqual(self.saved, {'a': 'aaaa'})
+        self.assertEqual(write_behind.pending('a'), None)
+
+    def test_full(self):
+        """ With the queue full, saves happen right away. """
+        write_behind = WriteBehind(1)
+        write_behind.submit(self.slow_save, 'a', 'aaaa')
+        while not write_behind.queue.empty():
+            time.sleep(0.01)
+        write_behind.submit(self.slow_save, 'b', 'bbbb')
+        self.release.set()
+        write_behind.submit(self.slow_save, 'c', 'cccc')
+        self.assertEqual(self.saved.get('c'), 'cccc')
+        write_behind.join()
+        self.assertEqual(sorted(self.saved), ['a', 'b', 'c'])
+
+    def test_failed_save(self):
+        def broken_save(name, data):
+            raise IOError('disk full')
+        write_behind = WriteBehind(10)
+        write_behind.submit(broken_save, 'a', 'aaaa')
+        write_behind.join()
+        self.assertEqual(write_behind.pending('a'), None)
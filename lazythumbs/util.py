@@ -221,6 +221,15 @@ def get_img_attrs(thing, action, width='', height=''):
     return compute_img(thing, action, geometry)
 
 
+def get_rendered_path(source_path, action, width, height):
+    """ the path, relative to MEDIA_ROOT, an image of source_path is rendered to
+        when it is requested through the lazythumb template tag
+    """
+    url = _construct_lt_img_url(
+        MAPPED_URLS[settings.MEDIA_URL], action, build_geometry(action, width, height), source_path)
+    return urlparse(url).path.lstrip('/')
+
+
 def get_format(file_path):
     """ This gets a PIL image format string from a file name
         This should be exposed from PIL but isn't so i've copied PIL code here
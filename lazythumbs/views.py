@@ -1,25 +1,216 @@
 from cStringIO import StringIO
 from hashlib import md5
 import errno
+import inspect
 import logging
 import os
 import re
-import types
+import tempfile
+import time
+from wsgiref.util import FileWrapper
 
 from django.conf import settings
 from django.core.cache import cache
-from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import get_storage_class
 from django.core.files.base import ContentFile
 from django.core.exceptions import SuspiciousOperation
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.utils.cache import patch_vary_headers
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # Django < 1.5 streams iterators given to HttpResponse
+    StreamingHttpResponse = HttpResponse
+try:
+    from django.http import FileResponse
+except ImportError:  # Django < 1.8
+    FileResponse = None
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.generic.base import View
 from PIL import Image
 
+from lazythumbs.bloom import RotatingBloomFilter
+from lazythumbs.budget import SourceTooLarge, estimate_render_bytes
+from lazythumbs.encoding import EncoderPolicy
+from lazythumbs.eviction import EvictionIndex
+from lazythumbs.executor import QueueFull, RenderExecutor, TimeoutError
+from lazythumbs.locks import RenderLock
+from lazythumbs.lru import ByteLRU
+from lazythumbs.metrics import Timings, get_sink
 from lazythumbs.util import geometry_parse, get_format
+from lazythumbs.writebehind import WriteBehind
 
 logger = logging.getLogger('lazythumbs')
 
+# Storage class rendered images are saved to and read from
+STORAGE = getattr(settings, 'LAZYTHUMBS_STORAGE', 'django.core.files.storage.FileSystemStorage')
+# Store renders in a tree of SHARD_DEPTH levels of up to 256 directories below
+# lt_cache, named after the md5 of their url path, instead of at their url
+# path, so that no directory grows too large. Urls stay the same. 0 stores
+# renders at their url path; manage.py lazythumbs_shard moves them.
+SHARD_DEPTH = getattr(settings, 'LAZYTHUMBS_SHARD_DEPTH', 0)
 MATTE_BACKGROUND_COLOR = getattr(settings, 'LAZYTHUMBS_MATTE_BACKGROUND_COLOR', (0, 0, 0))
+# How much larger than the target geometry a source is decoded before the
+# final resample. JPEG sources use draft mode (DCT scaling), other formats use
+# Image.reduce() where available. A false value always decodes at full size.
+REDUCING_GAP = getattr(settings, 'LAZYTHUMBS_REDUCING_GAP', 2.0)
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'I', 'F')
+# the info key under which a decoded image keeps the size of the source it
+# stands in for, so that renders are sized from the source and not from a
+# reduced decode (see source_size)
+SOURCE_SIZE_INFO = 'lazythumbs.source_size'
+# Sources are turned away with a 404, cached like any other, instead of being
+# decoded when they would decode to more than MAX_SOURCE_PIXELS pixels or
+# their render is estimated to take more than MAX_RENDER_MEMORY bytes. JPEGs
+# are judged by their reduced decode (see REDUCING_GAP). None disables either.
+MAX_SOURCE_PIXELS = getattr(settings, 'LAZYTHUMBS_MAX_SOURCE_PIXELS', None)
+MAX_RENDER_MEMORY = getattr(settings, 'LAZYTHUMBS_MAX_RENDER_MEMORY', None)
+# raised by Pillow 5+ for images over twice Image.MAX_IMAGE_PIXELS
+DECOMPRESSION_BOMB = getattr(Image, 'DecompressionBombError', ())
+# Image.resize() can resample just a box of the source from Pillow 4.3 on;
+# before that the box is cropped out first.
+RESIZE_BOX = 'box' in inspect.getargspec(Image.Image.resize)[0]
+# Image.save options by output format and size, see EncoderPolicy. Outputs
+# without a rule are saved with quality 80.
+encoder_policy = EncoderPolicy(getattr(settings, 'LAZYTHUMBS_ENCODER_POLICY', None))
+# Serve WebP renders of JPEG and PNG images to clients whose Accept header
+# includes image/webp, stored next to the requested render with a .webp
+# suffix. Needs a Pillow built with WebP support.
+WEBP = getattr(settings, 'LAZYTHUMBS_WEBP', False)
+if WEBP:
+    # loading every PIL plugin is slow, so only done when it matters
+    Image.init()
+    WEBP = 'WEBP' in Image.SAVE
+WEBP_FORMATS = ('JPEG', 'PNG')
+# Render every frame of animated GIF and WebP sources, keeping them
+# animated, as long as they have at most ANIMATED_MAX_FRAMES frames and at
+# most ANIMATED_MAX_PIXELS pixels over all of them. Larger ones, and every
+# animated source when ANIMATED is off, are rendered from their first frame.
+ANIMATED = getattr(settings, 'LAZYTHUMBS_ANIMATED', False)
+ANIMATED_MAX_FRAMES = getattr(settings, 'LAZYTHUMBS_ANIMATED_MAX_FRAMES', 100)
+ANIMATED_MAX_PIXELS = getattr(settings, 'LAZYTHUMBS_ANIMATED_MAX_PIXELS', 50000000)
+ANIMATED_FORMATS = ('GIF', 'WEBP')
+# Dictionary of action to a list of url geometries, eg
+# {'thumbnail': ['320', '640', '1024']}. When one of them is rendered, the
+# others that aren't rendered yet are rendered from the same decode.
+RENDER_LADDER = getattr(settings, 'LAZYTHUMBS_RENDER_LADDER', {})
+# Render from an already rendered thumbnail of the source instead of the
+# source itself when the thumbnail is at least PYRAMID_MARGIN times the size
+# of the new render. Thumbnails rendered from their source are indexed per
+# source in the django cache. Only PYRAMID_ACTIONS, which all work on the
+# whole image, are rendered this way.
+PYRAMID = getattr(settings, 'LAZYTHUMBS_PYRAMID', False)
+PYRAMID_MARGIN = getattr(settings, 'LAZYTHUMBS_PYRAMID_MARGIN', 2.0)
+PYRAMID_ACTIONS = ('thumbnail', 'resize', 'mresize', 'aresize', 'aresize_no_crop', 'matte', 'scale')
+# Seconds a request waits for another request that is already rendering the
+# same image before giving up and rendering it itself. 0 disables waiting.
+RENDER_LOCK_TIMEOUT = getattr(settings, 'LAZYTHUMBS_RENDER_LOCK_TIMEOUT', 10)
+# Directory holding the lock files that coalesce renders across processes.
+# None coalesces renders within each process only.
+LOCK_DIR = getattr(settings, 'LAZYTHUMBS_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'lazythumbs-locks'))
+# How already rendered images are delivered: 'read', 'stream', 'x-sendfile'
+# or 'x-accel-redirect'. See LazyThumbRenderer.cached_response.
+DELIVERY = getattr(settings, 'LAZYTHUMBS_DELIVERY', 'read')
+# nginx internal location that maps to the root of the render storage
+X_ACCEL_REDIRECT_PREFIX = getattr(settings, 'LAZYTHUMBS_X_ACCEL_REDIRECT_PREFIX', '/lt_internal/')
+STREAM_BLOCK_SIZE = 64 * 1024
+# Send ETag/Last-Modified for rendered images and answer conditional requests
+# with 304 Not Modified.
+CONDITIONAL_GET = getattr(settings, 'LAZYTHUMBS_CONDITIONAL_GET', True)
+# What to do when a render would not change its source (eg a thumbnail wider
+# than the source): 'serve' the source file, 'redirect' to the source's url,
+# or None to render and store a copy like any other image. Relies on probing
+# the source's header for each request without a cached result.
+NOOP_RESPONSE = getattr(settings, 'LAZYTHUMBS_NOOP_RESPONSE', None)
+# Render in a pool of this many processes instead of the request thread. At
+# most RENDER_QUEUE_SIZE renders run or wait at once; requests beyond that, or
+# waiting longer than RENDER_WAIT_TIMEOUT seconds, get a 503 with Retry-After.
+RENDER_PROCESSES = getattr(settings, 'LAZYTHUMBS_RENDER_PROCESSES', 0)
+RENDER_QUEUE_SIZE = getattr(settings, 'LAZYTHUMBS_RENDER_QUEUE_SIZE', RENDER_PROCESSES * 4)
+RENDER_WAIT_TIMEOUT = getattr(settings, 'LAZYTHUMBS_RENDER_WAIT_TIMEOUT', 10)
+RETRY_AFTER = getattr(settings, 'LAZYTHUMBS_RETRY_AFTER', 2)
+
+render_executor = None
+if RENDER_PROCESSES:
+    render_executor = RenderExecutor(RENDER_PROCESSES, RENDER_QUEUE_SIZE)
+
+# Keep up to MEMORY_CACHE_SIZE bytes of rendered images in each process,
+# checked before the django cache or the filesystem. Only images up to
+# MEMORY_CACHE_MAX_ENTRY bytes are kept, for at most MEMORY_CACHE_TTL seconds.
+MEMORY_CACHE_SIZE = getattr(settings, 'LAZYTHUMBS_MEMORY_CACHE_SIZE', 0)
+MEMORY_CACHE_MAX_ENTRY = getattr(settings, 'LAZYTHUMBS_MEMORY_CACHE_MAX_ENTRY', 256 * 1024)
+MEMORY_CACHE_TTL = getattr(settings, 'LAZYTHUMBS_MEMORY_CACHE_TTL', 300)
+
+memory_cache = None
+if MEMORY_CACHE_SIZE:
+    memory_cache = ByteLRU(MEMORY_CACHE_SIZE, MEMORY_CACHE_MAX_ENTRY, MEMORY_CACHE_TTL)
+
+# Remember up to MISSING_FILTER_CAPACITY missing source paths in a rotating
+# Bloom filter, so they 404 for any action and geometry without a cache round
+# trip. A source is remembered for between half and all of
+# MISSING_FILTER_WINDOW seconds, and about MISSING_FILTER_ERROR_RATE of
+# existing sources are wrongly taken for missing ones. Processes share what
+# they learn through the django cache every MISSING_FILTER_SYNC_INTERVAL
+# seconds; None keeps the filter to each process.
+MISSING_FILTER_CAPACITY = getattr(settings, 'LAZYTHUMBS_MISSING_FILTER_CAPACITY', 0)
+MISSING_FILTER_ERROR_RATE = getattr(settings, 'LAZYTHUMBS_MISSING_FILTER_ERROR_RATE', 0.0001)
+MISSING_FILTER_WINDOW = getattr(settings, 'LAZYTHUMBS_MISSING_FILTER_WINDOW', settings.LAZYTHUMBS_404_CACHE_TIMEOUT)
+MISSING_FILTER_SYNC_INTERVAL = getattr(settings, 'LAZYTHUMBS_MISSING_FILTER_SYNC_INTERVAL', 30)
+
+missing_sources = None
+if MISSING_FILTER_CAPACITY:
+    missing_sources = RotatingBloomFilter(
+        MISSING_FILTER_CAPACITY, MISSING_FILTER_ERROR_RATE, MISSING_FILTER_WINDOW,
+        cache=cache, sync_interval=MISSING_FILTER_SYNC_INTERVAL)
+
+# Save rendered images on a background thread through a queue of up to
+# WRITE_BEHIND_QUEUE_SIZE images instead of before responding. 0 saves them
+# before responding.
+WRITE_BEHIND_QUEUE_SIZE = getattr(settings, 'LAZYTHUMBS_WRITE_BEHIND_QUEUE_SIZE', 0)
+
+write_behind = None
+if WRITE_BEHIND_QUEUE_SIZE:
+    write_behind = WriteBehind(WRITE_BEHIND_QUEUE_SIZE)
+
+# Track renders and their last access in a sqlite index at EVICTION_INDEX,
+# writing accesses to it every EVICTION_FLUSH_INTERVAL seconds. Least recently
+# used renders are deleted once there are more than CACHE_MAX_BYTES bytes or
+# CACHE_MAX_FILES of them, by manage.py lazythumbs_evict or, with an
+# EVICTION_INTERVAL, every that many seconds on a thread in each process.
+EVICTION_INDEX = getattr(settings, 'LAZYTHUMBS_EVICTION_INDEX', None)
+EVICTION_FLUSH_INTERVAL = getattr(settings, 'LAZYTHUMBS_EVICTION_FLUSH_INTERVAL', 10)
+EVICTION_INTERVAL = getattr(settings, 'LAZYTHUMBS_EVICTION_INTERVAL', None)
+CACHE_MAX_BYTES = getattr(settings, 'LAZYTHUMBS_CACHE_MAX_BYTES', None)
+CACHE_MAX_FILES = getattr(settings, 'LAZYTHUMBS_CACHE_MAX_FILES', None)
+
+eviction_index = None
+if EVICTION_INDEX:
+    eviction_index = EvictionIndex(EVICTION_INDEX, EVICTION_FLUSH_INTERVAL, CACHE_MAX_BYTES, CACHE_MAX_FILES)
+
+# Dotted path of the class stage timings and request counts are reported to,
+# eg 'lazythumbs.metrics.PrometheusSink'. None discards them.
+metrics = get_sink(getattr(settings, 'LAZYTHUMBS_METRICS_SINK', None))
+
+# Add Server-Timing and X-Lazythumbs-Cache headers telling how each response
+# was made.
+SERVER_TIMING = getattr(settings, 'LAZYTHUMBS_SERVER_TIMING', False)
+
+
+# (STORAGE, MEDIA_ROOT) -> the storage shared by every renderer
+_storages = {}
+
+
+def render_storage():
+    """
+    :returns: the STORAGE instance shared by every renderer in this process,
+        built when first needed. MEDIA_ROOT is part of its key so that
+        overriding it, eg in tests, gets a storage rooted there.
+    """
+    key = (STORAGE, settings.MEDIA_ROOT)
+    storage = _storages.get(key)
+    if storage is None:
+        storage = _storages[key] = get_storage_class(STORAGE)()
+    return storage
+
 
 def action(fun):
     """
@@ -31,6 +222,18 @@ def action(fun):
     return fun
 
 
+class ActionRegistry(type):
+    """
+    Metaclass listing the actions of a renderer class, including those it
+    inherits, in its allowed_actions when the class is created, so nothing
+    has to look for them per request.
+    """
+    def __new__(mcs, name, bases, attrs):
+        cls = super(ActionRegistry, mcs).__new__(mcs, name, bases, attrs)
+        cls.allowed_actions = [a for a in dir(cls) if getattr(getattr(cls, a, None), 'is_action', False)]
+        return cls
+
+
 class LazyThumbRenderer(View):
     """
     Perform requested image render operations and handle fs logic and caching
@@ -40,19 +243,35 @@ class LazyThumbRenderer(View):
     image transformations simply by subclassing this view and adding "action_"
     methods that return raw image data as a string.
     """
+    __metaclass__ = ActionRegistry
+
     def __init__(self):
-        self.fs = FileSystemStorage()
-        self.allowed_actions = [a.__name__
-            for a in (getattr(self, a, None) for a in dir(self))
-            if type(a) == types.MethodType and getattr(a, 'is_action', False)
-        ]
+        self.timings = Timings()
+        # 'hit', 'miss', 'neg' or 'noop' once get knows
+        self.cache_status = None
+        # PIL image format string of the response once get knows, eg 'WEBP'
+        # for a negotiated request for a JPEG
+        self.img_format = None
+
+    @property
+    def fs(self):
+        """
+        The storage rendered images are saved to and read from: the one
+        shared by every renderer, unless one was assigned to this renderer.
+        """
+        return self.__dict__.get('_fs') or render_storage()
 
+    @fs.setter
+    def fs(self, storage):
+        self._fs = storage
 
     def get(self, request, action, geometry, source_path):
         """
         Perform action routing and handle sanitizing url input. Handles caching the path to a rendered image to
         django.cache and saves the new image on the filesystem. 404s are cached to
-        save time the next time the missing image is requested.
+        save time the next time the missing image is requested. How long each
+        stage took and how the request ended are reported to the metrics sink,
+        and with SERVER_TIMING to the client too.
 
         :param request: HttpRequest
         :param action: some action, eg thumbnail or resize
@@ -60,6 +279,21 @@ class LazyThumbRenderer(View):
         :param source_path: the fs path to the image to be manipulated
         :returns: an HttpResponse with an image/{format} content_type
         """
+        self.timings = Timings()
+        self.cache_status = None
+        self.img_format = None
+        status = 500
+        start = time.time()
+        try:
+            resp = self._get(request, action, geometry, source_path)
+            status = resp.status_code
+            if SERVER_TIMING:
+                self.timing_headers(resp, time.time() - start)
+            return resp
+        finally:
+            self.report(action, self.img_format or get_format(source_path), status)
+
+    def _get(self, request, action, geometry, source_path):
 
         # reject naughty paths and actions
         if source_path.startswith('/'):
@@ -82,78 +316,616 @@ class LazyThumbRenderer(View):
         height = int(height) if height is not None else None
 
         rendered_path = request.path[1:]
+        requested_format = img_format = get_format(rendered_path)
+
+        negotiated = WEBP and img_format in WEBP_FORMATS
+        if negotiated and self.accepts(request, 'image/webp'):
+            rendered_path, img_format = rendered_path + '.webp', 'WEBP'
+        self.img_format = img_format
+
+        if memory_cache is not None:
+            cached = memory_cache.get(rendered_path)
+            if cached is not None:
+                self.touch(rendered_path)
+                self.cache_status = 'hit'
+                return self.vary(self.memory_response(request, rendered_path, *cached), negotiated)
 
         cache_key = self.cache_key(source_path, action, width, height)
-        was_404 = cache.get(cache_key)
+        with self.timings.stage('negative_cache'):
+            missing = missing_sources is not None and source_path in missing_sources
+            was_404 = None if missing else cache.get(cache_key)
 
-        if was_404 == 1:
+        if missing or was_404 == 1:
+            self.cache_status = 'neg'
             return self.four_oh_four()
 
-        img_format = get_format(rendered_path)
-        # TODO this tangled mess of try/except is hideous... but such is
-        # filesystem io? No it can be cleaned up by splitting it out
+        if NOOP_RESPONSE and was_404 != 0:
+            # a quick look at the source's header tells whether this render
+            # would just copy it; if so it is never rendered at all.
+            try:
+                if was_404 == 2 or self.probe_noop(action, width, height, source_path, requested_format):
+                    resp = self.noop_response(request, source_path, requested_format)
+                    cache.set(cache_key, 2, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+                    self.cache_status = 'noop'
+                    self.img_format = requested_format
+                    return resp
+            except (IOError, SuspiciousOperation):
+                # missing sources are left to the usual 404 handling
+                pass
+
+        etag, last_modified = None, None
+        if CONDITIONAL_GET:
+            etag, last_modified = self.validators(rendered_path)
+            if etag and self.not_modified(request, etag, last_modified):
+                cache.set(cache_key, 0, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+                self.touch(rendered_path)
+                self.cache_status = 'hit'
+                return self.vary(self.three_oh_four(etag, last_modified), negotiated)
+
+        raw_data = None
         try:
             # does rendered file already exist?
-            raw_data = self.fs.open(rendered_path).read()
+            with self.timings.stage('storage_read'):
+                resp = self.cached_response(request, rendered_path, img_format)
+            self.touch(rendered_path)
+            self.cache_status = 'hit'
         except IOError as e:
             if was_404 == 0:
                 # then it *was* here last time. if was_404 had been None then
                 # it makes sense for rendered image to not exist yet: we
                 # probably haven't seen it, or it dropped out of cache.
                 logger.info('rendered image previously on fs missing. regenerating')
-            try:
+
+            # only one request renders a given path at a time; everyone else
+            # waits here for its output.
+            with self.render_lock(rendered_path) as lock:
+                resp = None
+                if lock.waited:
+                    if cache.get(cache_key) == 1:
+                        self.cache_status = 'neg'
+                        return self.four_oh_four()
+                    try:
+                        with self.timings.stage('storage_read'):
+                            resp = self.cached_response(request, rendered_path, img_format)
+                        self.cache_status = 'hit'
+                    except IOError:
+                        pass
+                if not lock.acquired:
+                    logger.warning('timed out waiting for render of %s, rendering anyway' % rendered_path)
+
+                if resp is None:
+                    args = (action, width, height, source_path, rendered_path)
+                    siblings = self.ladder_siblings(action, geometry, source_path, rendered_path)
+                    if siblings:
+                        args += (siblings,)
+                    self.cache_status = 'miss'
+                    try:
+                        raw_data = self.run_render(*args)
+                    except (QueueFull, TimeoutError), e:
+                        logger.warning('render executor busy, sending 503 for %s: %r' % (rendered_path, e))
+                        return self.five_oh_three()
+                    except (IOError, SuspiciousOperation, ValueError), e:
+                        # we've now failed to find a rendered path as well as the
+                        # original source path. this is a 404.
+                        logger.info('404: %s' % e)
+                        cache.set(cache_key, 1, settings.LAZYTHUMBS_404_CACHE_TIMEOUT)
+                        if missing_sources is not None and getattr(e, 'errno', None) == errno.ENOENT:
+                            missing_sources.add(source_path)
+                        return self.four_oh_four()
+                    resp = self.two_hundred(raw_data, img_format)
+
+            if CONDITIONAL_GET:
+                etag, last_modified = self.validators(rendered_path)
+
+        if etag:
+            resp['ETag'] = etag
+            resp['Last-Modified'] = http_date(last_modified)
+
+        if memory_cache is not None:
+            if raw_data is None and DELIVERY == 'read':
+                raw_data = resp.content
+            if raw_data:
+                memory_cache.set(rendered_path, (raw_data, etag, last_modified), len(raw_data))
+
+        cache.set(cache_key, 0, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+
+        return self.vary(resp, negotiated)
+
+    def run_render(self, *args):
+        """
+        Call render with args, in the render executor's process pool if one is
+        configured and in this thread otherwise.
+
+        :raises QueueFull: if the executor has no room for another render
+        :raises TimeoutError: if the executor took longer than
+            RENDER_WAIT_TIMEOUT to render
+        """
+        if render_executor is None:
+            return self.render(*args)
+        with self.timings.stage('executor'):
+            return render_executor.render(self, RENDER_WAIT_TIMEOUT, *args)
+
+    def timing_headers(self, resp, total):
+        """
+        Describe how a response was made in a Server-Timing header, with the
+        milliseconds spent in each stage, and an X-Lazythumbs-Cache header of
+        'hit', 'miss', 'neg' or 'noop'.
+
+        :param resp: the response to add the headers to
+        :param total: seconds spent handling the request
+        """
+        durations = ['%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in self.timings.items()]
+        durations.append('total;dur=%.1f' % (total * 1000))
+        resp['Server-Timing'] = ', '.join(durations)
+        if self.cache_status:
+            resp['X-Lazythumbs-Cache'] = self.cache_status
+
+    def report(self, action, img_format, status):
+        """
+        Send the stage timings and outcome of a request to the metrics sink.
+
+        :param action: the requested action
+        :param img_format: PIL image format string of the response
+        :param status: the response's status code
+        """
+        labels = {
+            'action': action if action in self.allowed_actions else 'unknown',
+            'format': img_format,
+        }
+        for stage, seconds in self.timings.items():
+            metrics.observe('stage_seconds', seconds, stage=stage, **labels)
+        metrics.increment('requests_total', cache=self.cache_status or 'none', status=status, **labels)
+
+    def render(self, action, width, height, source_path, rendered_path, siblings=()):
+        """
+        Run an action against a source image, encode the result and save it to
+        the filesystem at rendered_path.
+
+        :param action: some action, eg thumbnail or resize
+        :param width: integer width in pixels or None
+        :param height: integer height in pixels or None
+        :param source_path: the fs path to the image to be manipulated
+        :param rendered_path: the fs path the result is saved to
+        :param siblings: more (action, width, height, rendered_path) renders
+            of the same source to do from the same decode, see render_many.
+            Their failures are only logged.
+        :raises IOError: if the source image is not found
+        :returns: the encoded image data as a string
+        """
+        if siblings:
+            results = self.render_many(source_path, [(action, width, height, rendered_path)] + list(siblings))
+            for (_, _, _, sibling_path), result in zip(siblings, results[1:]):
+                if isinstance(result, Exception):
+                    logger.warning('unable to render %s: %s' % (sibling_path, result))
+            if isinstance(results[0], Exception):
+                raise results[0]
+            return results[0]
+
+        raw_data = self.render_animated(action, width, height, source_path, rendered_path)
+        if raw_data is not None:
+            return raw_data
+
+        level = self.pyramid_level(source_path, [(action, width, height)])
+        with self.timings.stage('transform'):
+            if level is not None:
+                pil_img = getattr(self, action)(width=width, height=height, img=level)
+            else:
                 pil_img = getattr(self, action)(
                     width=width,
                     height=height,
                     img_path=source_path
                 )
-                # this code from sorl-thumbnail
-                buf = StringIO()
-                # TODO we need a better way of choosing options based on size and format
-                params = {
-                    'format': get_format(rendered_path),
-                    'quality': 80,
-                }
+        if level is None:
+            self.index_level(source_path, action, rendered_path, pil_img)
+        return self.encode_and_store(pil_img, get_format(rendered_path), rendered_path)
 
-                if params['format'] == "JPEG" and pil_img.mode == 'P':
-                    # Cannot save mode 'P' image as JPEG without converting first
-                    # (This can happen if we have a GIF file without an extension and don't scale it)
-                    pil_img = pil_img.convert()
+    def render_many(self, source_path, renders):
+        """
+        Render several actions and geometries of one source, decoding it only
+        once. The source is decoded at a scale that suits the largest render
+        (see reduce_for_target) and every action works on a copy of it.
 
+        :param source_path: the fs path to the image to be manipulated
+        :param renders: a list of (action, width, height, rendered_path) tuples
+        :raises IOError: if the source image is not found
+        :returns: a list with, for each render, the encoded image data as a
+            string or the exception the render failed with
+        """
+        if ANIMATED and getattr(self.probe(source_path), 'is_animated', False):
+            # every frame is decoded for each render anyway
+            results = []
+            for action, width, height, rendered_path in renders:
                 try:
-                    pil_img.save(buf, **params)
-                except IOError as e:
-                    logger.exception("pil_img.save(%r)" % params)
-                    # TODO reevaluate this except when we make options smarter
-                    logger.info("Failed to create new image %s . Trying without options" % rendered_path)
-                    pil_img.save(buf, format=img_format)
-                raw_data = buf.getvalue()
+                    results.append(self.render(action, width, height, source_path, rendered_path))
+                except (IOError, SuspiciousOperation, ValueError) as e:
+                    results.append(e)
+            return results
+
+        img = self.pyramid_level(source_path, renders)
+        from_source = img is None
+        with self.timings.stage('decode'):
+            if from_source:
+                img = self.probe(source_path)
+                # the decode has to be large enough for every render
+                img = self.decode(img, source_path, *(self.decode_target(img.size, renders) or (None, None)))
+            else:
+                img.load()
+
+        results = []
+        for action, width, height, rendered_path in renders:
+            try:
+                with self.timings.stage('transform'):
+                    # actions may change the image they are given
+                    pil_img = getattr(self, action)(width=width, height=height, img=img.copy())
+                raw_data = self.encode_and_store(pil_img, get_format(rendered_path), rendered_path)
+            except (IOError, SuspiciousOperation, ValueError) as e:
+                results.append(e)
+            else:
+                results.append(raw_data)
+                if from_source:
+                    self.index_level(source_path, action, rendered_path, pil_img)
+        return results
+
+    def render_animated(self, action, width, height, source_path, rendered_path):
+        """
+        Render every frame of an animated source with an action and encode
+        them as an animation, keeping the source's frame durations and loop
+        count. Frames are decoded and transformed one at a time, so only the
+        transformed frames are held at once.
+
+        :param action: some action, eg thumbnail or resize
+        :param width: integer width in pixels or None
+        :param height: integer height in pixels or None
+        :param source_path: the fs path to the image to be manipulated
+        :param rendered_path: the fs path the result is saved to
+        :raises IOError: if the source image is not found
+        :returns: the encoded image data as a string, or None if the source
+            isn't animated, the render can't be, ANIMATED is off or the
+            source is over ANIMATED_MAX_FRAMES or ANIMATED_MAX_PIXELS
+        """
+        img_format = get_format(rendered_path)
+        if not ANIMATED or img_format not in ANIMATED_FORMATS:
+            return None
+        with self.timings.stage('decode'):
+            source = self.probe(source_path)
+            if not getattr(source, 'is_animated', False) or img_format not in Image.SAVE_ALL:
+                return None
+            frame_count = source.n_frames
+        if frame_count > ANIMATED_MAX_FRAMES or frame_count * source.size[0] * source.size[1] > ANIMATED_MAX_PIXELS:
+            logger.info('%s: %d frames of %dx%d, rendering the first only' % ((source_path, frame_count) + source.size))
+            return None
+        self.check_budget(source, source_path, width, height)
+
+        has_alpha = 'transparency' in source.info or source.mode in ('RGBA', 'LA', 'PA')
+        frames, durations = [], []
+        for index in range(frame_count):
+            with self.timings.stage('decode'):
+                source.seek(index)
+                frame = source.convert('RGBA' if has_alpha else 'RGB')
+            with self.timings.stage('transform'):
+                frames.append(getattr(self, action)(width=width, height=height, img=frame))
+            durations.append(source.info.get('duration', 100))
+
+        extra = {}
+        if 'loop' in source.info:
+            # a source without a loop count plays once
+            extra['loop'] = source.info['loop']
+        return self.encode_and_store(frames[0], img_format, rendered_path, save_all=True, append_images=frames[1:],
+                                     duration=durations, **extra)
+
+    def decode_target(self, size, renders):
+        """
+        Work out how large an image of the given size has to be decoded for
+        every one of renders, filling in missing dimensions from its aspect
+        ratio.
+
+        :param size: (width, height) of the image
+        :param renders: a list of tuples starting with action, width, height
+        :returns: (width, height), or None if some render needs the full size
+        """
+        source_width, source_height = size
+        target_width = target_height = 0
+        for render in renders:
+            width, height = render[1:3]
+            if not (width or height):
+                return None
+            target_width = max(target_width, width or source_width * height // source_height)
+            target_height = max(target_height, height or source_height * width // source_width)
+        return target_width, target_height
+
+    def pyramid_key(self, source_path):
+        # levels are indexed as rendered_path -> (size, source size)
+        return 'lazythumbs:pyramid2:%s' % md5(source_path).hexdigest()
+
+    def pyramid_level(self, source_path, renders):
+        """
+        Find the smallest indexed thumbnail of a source that every one of
+        renders can be rendered from, being at least PYRAMID_MARGIN times
+        their size, and open it. Thumbnails that are gone from the render
+        storage are dropped from the index. The level keeps the size of the
+        source, so that renders are sized as if they were made from it (see
+        source_size).
+
+        :param source_path: the fs path to the source image
+        :param renders: a list of tuples starting with action, width, height
+        :returns: a PIL Image object, or None to render from the source
+        """
+        if not PYRAMID or any(render[0] not in PYRAMID_ACTIONS for render in renders):
+            return None
+        key = self.pyramid_key(source_path)
+        levels = cache.get(key)
+        if not levels:
+            return None
+        for level_path, (size, source_size) in sorted(levels.items(), key=lambda item: item[1][0][0] * item[1][0][1]):
+            target = self.decode_target(size, renders)
+            if target is None or size[0] < target[0] * PYRAMID_MARGIN or size[1] < target[1] * PYRAMID_MARGIN:
+                continue
+            try:
+                img = Image.open(StringIO(self.read_render(level_path)))
+            except IOError:
+                logger.info('pyramid level %s is gone, dropping it' % level_path)
+                del levels[level_path]
+                cache.set(key, levels, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+                continue
+            logger.debug('rendering %s from %s' % (source_path, level_path))
+            img.info[SOURCE_SIZE_INFO] = source_size
+            return self.reduce_for_target(img, *target)
+        return None
+
+    def index_level(self, source_path, action, rendered_path, pil_img):
+        """
+        Add a thumbnail rendered from its source to the source's pyramid.
+        """
+        if not PYRAMID or action != 'thumbnail':
+            return
+        key = self.pyramid_key(source_path)
+        levels = cache.get(key) or {}
+        levels[rendered_path] = (pil_img.size, self.source_size(pil_img))
+        cache.set(key, levels, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+
+    def read_render(self, rendered_path):
+        """
+        :raises IOError: if there is no such render
+        :returns: the encoded data of a render, including one still waiting
+            to be saved by the write-behind thread
+        """
+        if write_behind is not None:
+            raw_data = write_behind.pending(rendered_path)
+            if raw_data is not None:
+                return raw_data
+        return self.fs.open(self.storage_name(rendered_path)).read()
+
+    def encode_and_store(self, pil_img, img_format, rendered_path, **extra):
+        """
+        Encode a rendered image and save it to the render storage. On a local
+        filesystem without write-behind the encoder writes straight into the
+        temporary file that is renamed into place, and the data is read back
+        from it once, rather than copied out of an in-memory buffer and then
+        written; so a render holds about one copy of its output at a time.
+
+        :param pil_img: a PIL Image object
+        :param img_format: PIL image format string to encode as
+        :param rendered_path: the fs path the result is saved to
+        :param extra: more Image.save options, see encode
+        :returns: the encoded image data as a string
+        """
+        path = None
+        if write_behind is None:
+            try:
+                path = self.fs.path(self.storage_name(rendered_path))
+            except NotImplementedError:
+                pass
+        if path is None:
+            # the storage or the write-behind queue needs the data in memory
+            with self.timings.stage('encode'):
+                raw_data = self.encode(pil_img, img_format, rendered_path, **extra)
+            self.persist(rendered_path, raw_data)
+            return raw_data
+
+        def write(f):
+            with self.timings.stage('encode'):
+                self.encode(pil_img, img_format, rendered_path, fp=f, **extra)
+            f.seek(0)
+            return f.read()
+
+        with self.timings.stage('storage_write'):
+            raw_data = self.write_atomic(path, write)
+        self.touch(rendered_path, len(raw_data))
+        return raw_data
+
+    def encode(self, pil_img, img_format, rendered_path, fp=None, **extra):
+        """
+        Encode a rendered image according to the encoder policy.
+
+        :param pil_img: a PIL Image object
+        :param img_format: PIL image format string to encode as
+        :param rendered_path: the fs path the result is for, for logging
+        :param fp: a file to encode into, rather than returning the data
+        :param extra: more Image.save options that are always used, eg the
+            frames of an animation
+        :returns: the encoded image data as a string, or None if fp was given
+        """
+        # this code from sorl-thumbnail
+        buf = fp or StringIO()
+
+        if img_format == "JPEG" and pil_img.mode == 'P':
+            # Cannot save mode 'P' image as JPEG without converting first
+            # (This can happen if we have a GIF file without an extension and don't scale it)
+            pil_img = pil_img.convert()
+        elif img_format == 'WEBP' and pil_img.mode not in ('RGB', 'RGBA'):
+            has_alpha = pil_img.mode in ('LA', 'PA') or 'transparency' in pil_img.info
+            pil_img = pil_img.convert('RGBA' if has_alpha else 'RGB')
+
+        params = encoder_policy.prepare(pil_img, img_format)
+        params.update(extra)
+        try:
+            pil_img.save(buf, **params)
+        except (IOError, TypeError, ValueError) as e:
+            # options from the policy may not suit this image or Pillow
+            logger.exception("pil_img.save(%r)" % params)
+            logger.info("Failed to create new image %s . Trying without options" % rendered_path)
+            if fp is not None:
+                fp.seek(0)
+                fp.truncate()
+            else:
                 buf.close()
-                try:
-                    self.fs.save(rendered_path, ContentFile(raw_data))
-                except OSError as e:
-                    if e.errno == errno.EEXIST:
-                        # possible race condition, another WSGI worker wrote file or directory first
-                        # try to read again
-                        try:
-                            raw_data = self.fs.open(rendered_path).read()
-                        except Exception as e:
-                            logger.exception("Unable to read image file, returning 404: %s" % e)
-                            return self.four_oh_four()
-                    else:
-                        logger.exception("Saving converted image: %s" % e)
-                        raise
-
-            except (IOError, SuspiciousOperation, ValueError), e:
-                # we've now failed to find a rendered path as well as the
-                # original source path. this is a 404.
-                logger.info('404: %s' % e)
-                cache.set(cache_key, 1, settings.LAZYTHUMBS_404_CACHE_TIMEOUT)
-                return self.four_oh_four()
+                buf = StringIO()
+            pil_img.save(buf, format=img_format, **extra)
+        if fp is not None:
+            return None
+        raw_data = buf.getvalue()
+        buf.close()
+        return raw_data
+
+    def persist(self, rendered_path, raw_data):
+        """
+        Save encoded image data now, or queue it for the write-behind thread
+        if there is one.
+        """
+        with self.timings.stage('storage_write'):
+            if write_behind is not None:
+                write_behind.submit(self.store, rendered_path, raw_data)
+            else:
+                self.store(rendered_path, raw_data)
+        self.touch(rendered_path, len(raw_data))
 
-        cache.set(cache_key, 0, settings.LAZYTHUMBS_CACHE_TIMEOUT)
+    def touch(self, rendered_path, size=None):
+        """
+        Record an access to a render in the eviction index, if there is one.
+
+        :param rendered_path: the fs path of the render
+        :param size: its size in bytes if it was just rendered
+        """
+        if eviction_index is None:
+            return
+        eviction_index.touch(self.storage_name(rendered_path), size)
+        if EVICTION_INTERVAL:
+            eviction_index.start(self.fs.delete, EVICTION_INTERVAL)
+
+    def ladder_siblings(self, action, geometry, source_path, rendered_path):
+        """
+        Find the renders on RENDER_LADDER that accompany a render and don't
+        exist yet.
+
+        :param action: some action, eg thumbnail or resize
+        :param geometry: the geometry from the url, eg '48' or '48x48'
+        :param source_path: the fs path to the source image
+        :param rendered_path: the fs path of the requested render
+        :returns: a list of (action, width, height, rendered_path) tuples,
+            empty unless geometry is on action's ladder
+        """
+        ladder = RENDER_LADDER.get(action)
+        if not ladder:
+            return []
+        requested = geometry_parse(action, geometry, ValueError)
+        geometries = []
+        for step in ladder:
+            try:
+                geometries.append((step, geometry_parse(action, step, ValueError)))
+            except ValueError:
+                logger.warning('bad geometry %s in render ladder for %s' % (step, action))
+        if requested not in [size for step, size in geometries]:
+            return []
+
+        head, marker, tail = rendered_path.partition('lt_cache/%s/%s/' % (action, geometry))
+        if not marker:
+            return []
+        siblings = []
+        for step, (width, height) in geometries:
+            if (width, height) == requested:
+                continue
+            sibling_path = '%slt_cache/%s/%s/%s' % (head, action, step, tail)
+            if write_behind is not None and write_behind.pending(sibling_path) is not None:
+                continue
+            if not self.fs.exists(self.storage_name(sibling_path)):
+                siblings.append((action, width, height, sibling_path))
+        return siblings
+
+    def store(self, rendered_path, raw_data):
+        """
+        Save encoded image data to the render storage. When the storage is on
+        the local filesystem the data is written to a temporary file in the
+        destination directory and renamed into place, so readers (including a
+        web server serving lt_cache directly) never see a partly written image
+        and concurrent renders of the same image simply replace each other.
+
+        :param rendered_path: the path the image is saved under
+        :param raw_data: the encoded image data as a string
+        """
+        name = self.storage_name(rendered_path)
+        try:
+            path = self.fs.path(name)
+        except NotImplementedError:
+            # not a local filesystem, atomicity is up to the storage
+            self.fs.save(name, ContentFile(raw_data))
+            return
+        self.write_atomic(path, lambda f: f.write(raw_data))
+
+    def write_atomic(self, path, write):
+        """
+        Write a file through a temporary file in its directory that is renamed
+        into place once it is complete, see store.
+
+        :param path: the local filesystem path of the file
+        :param write: a function that writes the file's contents to the open
+            temporary file
+        :returns: what write returned
+        """
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                result = write(f)
+            # mkstemp creates files readable only by us
+            os.chmod(tmp_path, getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None) or 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return result
+
+    def storage_name(self, rendered_path, depth=None):
+        """
+        Map the url path of a render to the name it is stored under, which
+        with SHARD_DEPTH 2 turns lt_cache/thumbnail/48/i/p.jpg into
+        lt_cache/3f/a2/3fa2<...>.jpg.
 
-        return self.two_hundred(raw_data, img_format)
+        :param rendered_path: the url path of the render, without the leading slash
+        :param depth: number of directory levels, defaults to SHARD_DEPTH
+        :returns: a name in the render storage
+        """
+        depth = SHARD_DEPTH if depth is None else depth
+        if not depth:
+            return rendered_path
+        head, marker, tail = rendered_path.partition('lt_cache/')
+        if not marker:
+            head = ''
+        key = rendered_path.encode('utf-8') if isinstance(rendered_path, unicode) else rendered_path
+        hashed = md5(key).hexdigest()
+        shards = [hashed[i * 2:i * 2 + 2] for i in range(depth)]
+        return '%slt_cache/%s/%s%s' % (head, '/'.join(shards), hashed, os.path.splitext(rendered_path)[1])
+
+    def render_lock(self, rendered_path):
+        """
+        Build the lock that coalesces concurrent renders of rendered_path. The
+        lock file lives in LOCK_DIR so that every worker process on the host
+        (or every host, if LOCK_DIR is shared) agrees on it.
+
+        :param rendered_path: the fs path of the rendered image
+        :returns: a RenderLock
+        """
+        lock_path = None
+        if LOCK_DIR:
+            lock_path = os.path.join(LOCK_DIR, '%s.lock' % md5(rendered_path).hexdigest())
+        return RenderLock(rendered_path, lock_path, RENDER_LOCK_TIMEOUT)
 
     @action
     def resize(self, *args, **kwargs):
@@ -198,7 +970,7 @@ class LazyThumbRenderer(View):
         """
         if not (img or img_path):
             raise ValueError('unable to find img given args')
-        img = img or self.get_pil_from_path(img_path)
+        img = img or self.get_pil_from_path(img_path, width, height)
 
         source_width = img.size[0]
         source_height = img.size[1]
@@ -210,22 +982,21 @@ class LazyThumbRenderer(View):
         ):
             return img
 
-        img = self.thumbnail(
-            width = width if source_width < source_height else None,
-            height = height if source_height <= source_width else None,
-            img = img
+        scaled = self.thumbnail_size(
+            width if source_width < source_height else None,
+            height if source_height <= source_width else None,
+            img.size
         )
 
-        # see if we even have to crop
+        # center crop the thumbnail, resampling only what is kept of it
+        offset = (-((scaled[0] - width) / 2), -((scaled[1] - height) / 2))
+        img, (x, y) = self.place(img, scaled, offset, (width, height))
+
+        # see if we even have to pad
         if img.size == (width, height):
             return img
 
-        left = (img.size[0] - width) / 2
-        top = (img.size[1] - height) / 2
-        right = left + width
-        bottom = top + height
-
-        return img.crop((left, top, right, bottom))
+        return img.crop((-x, -y, width - x, height - y))
 
     @action
     def aresize(self, width, height, img_path=None, img=None, crop_img=True):
@@ -247,7 +1018,7 @@ class LazyThumbRenderer(View):
         :returns: a PIL Image object
         """
 
-        img = img or self.get_pil_from_path(img_path)
+        img = img or self.get_pil_from_path(img_path, width, height)
         if not img:
             raise ValueError('unable to find img given args')
 
@@ -294,27 +1065,22 @@ class LazyThumbRenderer(View):
             else:
                 target_width, target_height = None, height
 
-        # We never expand images. Resize only if the target is smaller.
-        if ((target_width and target_width < source_width) or
-                (target_height and target_height < source_height)):
-            img = self.thumbnail(
-                width = target_width,
-                height = target_height,
-                img = img
-            )
+        # We never expand images, thumbnail_size only ever shrinks them.
+        scaled = self.thumbnail_size(target_width, target_height, img.size)
 
         # see if we even have to crop
+        if scaled == (width, height):
+            return self.place(img, scaled, (0, 0), scaled)[0]
+
+        # Center the scaled image on the target, resampling only the part of
+        # it that lands inside the target. If that leaves no room for matte
+        # it is the result; otherwise paste it over the matte background.
+        offset = ((width - scaled[0]) / 2, (height - scaled[1]) / 2)
+        img, position = self.place(img, scaled, offset, (width, height))
         if img.size == (width, height):
-            return img
-
-        # Create a new image of the target size, and paste the resized image
-        # into it. This effectively mattes if necessary by pasting over the
-        # matte background color, and it crops if necessary by pasting outside
-        # the result image bounds.
-        offset_x = (width - img.size[0]) / 2
-        offset_y = (height - img.size[1]) / 2
+            return img if img.mode == 'RGB' else img.convert('RGB')
         result = Image.new(mode='RGB', size=(width, height), color=MATTE_BACKGROUND_COLOR)
-        result.paste(img, (offset_x, offset_y))
+        result.paste(img, position)
         return result
 
     @action
@@ -350,10 +1116,14 @@ class LazyThumbRenderer(View):
 
         if not (img or img_path):
             raise ValueError('unable to find img given args')
-        img = img or self.get_pil_from_path(img_path)
+        img = img or self.get_pil_from_path(img_path, width, height)
 
-        new_img = Image.new('RGB', (width, height), MATTE_BACKGROUND_COLOR)
         img.thumbnail((width, height), Image.ANTIALIAS)
+        if img.size == (width, height) and img.mode == 'RGB':
+            # nothing to matte
+            return img
+
+        new_img = Image.new('RGB', (width, height), MATTE_BACKGROUND_COLOR)
         pos = ((width - img.size[0]) / 2, (height - img.size[1]) / 2)
         new_img.paste(img, pos)
 
@@ -373,13 +1143,29 @@ class LazyThumbRenderer(View):
         """
         if not (img or img_path):
             raise ValueError('unable to find img given args')
-        img = img or self.get_pil_from_path(img_path)
+        img = img or self.get_pil_from_path(img_path, width, height)
 
         if (width and height) or (width is None and height is None):
             raise ValueError('thumbnail requires width XOR height; got (%s, %s)' % (width, height))
 
-        source_width = img.size[0]
-        source_height = img.size[1]
+        source_size = self.source_size(img)
+        size = self.thumbnail_size(width, height, source_size)
+        if size == source_size:
+            return img
+
+        return self.scale(size[0], size[1], img=img)
+
+    def thumbnail_size(self, width, height, size):
+        """
+        Work out the size of a thumbnail of an image.
+
+        :param width: desired width in pixels. mutually exclusive with height.
+        :param height: desired height in pixels. mutually exclusive with width
+        :param size: (width, height) of the image
+        :returns: (width, height) of the thumbnail; the image's own size if
+            the thumbnail would not be smaller
+        """
+        source_width, source_height = size
         scale = lambda a,b,c: int(int(a) * float(b) / float(c))
 
         # we are guaranteed to have either height or width which lets us take
@@ -388,9 +1174,60 @@ class LazyThumbRenderer(View):
         height = height or scale(source_height, width, source_width)
 
         if width >= source_width or height >= source_height:
-            return img
+            return size
+        return width, height
+
+    def place(self, img, scaled, offset, size):
+        """
+        Plan placing img, scaled to `scaled`, at offset on a canvas of size,
+        and resample just the part of it that lands on the canvas, in one
+        pass. Nothing is resampled only to be cropped away afterwards.
 
-        return self.scale(width, height, img=img)
+        :param img: a PIL Image object
+        :param scaled: (width, height) img is scaled to
+        :param offset: (x, y) of the scaled image on the canvas; negative
+            where it is cropped
+        :param size: (width, height) of the canvas
+        :raises ValueError: if scaled has no area
+        :returns: the resampled part of img and its (x, y) on the canvas
+        """
+        if not (scaled[0] and scaled[1]):
+            raise ValueError('cannot scale %dx%d to %dx%d' % (img.size + tuple(scaled)))
+        source_width, source_height = img.size
+        x, y = offset
+        left, top = max(0, -x), max(0, -y)
+        right, bottom = min(scaled[0], size[0] - x), min(scaled[1], size[1] - y)
+        x_ratio = float(source_width) / scaled[0]
+        y_ratio = float(source_height) / scaled[1]
+        box = (left * x_ratio, top * y_ratio, right * x_ratio, bottom * y_ratio)
+        return self.crop_resize(img, box, (right - left, bottom - top)), (x + left, y + top)
+
+    def crop_resize(self, img, box, size):
+        """
+        Resample a box of an image to size. Where Pillow supports it the box
+        is handed to Image.resize() rather than cropped out first, so there
+        is no intermediate image.
+
+        :param img: a PIL Image object
+        :param box: (left, top, right, bottom) of the source, may be fractional
+        :param size: (width, height) of the result
+        :returns: a PIL Image object
+        """
+        whole = box == (0, 0) + img.size
+        if (box[2] - box[0], box[3] - box[1]) == size:
+            # no scaling, at most cropping
+            return img if whole else img.crop(tuple(int(round(c)) for c in box))
+
+        # PIL is really bad at scaling GIFs. This helps a little with the quality.
+        # (http://python.6.n6.nabble.com/Poor-Image-Quality-When-Resizing-a-GIF-tp2099779.html)
+        if img.mode == "P":
+            img = img.convert(mode="RGB", dither=Image.NONE)
+
+        if whole:
+            return img.resize(size, Image.ANTIALIAS)
+        if RESIZE_BOX:
+            return img.resize(size, Image.ANTIALIAS, box)
+        return img.crop(tuple(int(round(c)) for c in box)).resize(size, Image.ANTIALIAS)
 
     @action
     def scale(self, width, height, img_path=None, img=None):
@@ -405,7 +1242,7 @@ class LazyThumbRenderer(View):
         """
         if not (img or img_path):
             raise ValueError('unable to find img given args')
-        img = img or self.get_pil_from_path(img_path)
+        img = img or self.get_pil_from_path(img_path, width, height)
 
         if width > img.size[0]:
             width = img.size[0]
@@ -420,23 +1257,204 @@ class LazyThumbRenderer(View):
 
         return img.resize((width, height), Image.ANTIALIAS)
 
-    def get_pil_from_path(self, img_path):
+    def get_pil_from_path(self, img_path, width=None, height=None):
         """
         given some path relative to MEDIA_ROOT, create a PIL Image and
-        return it.
+        return it. When a target width and/or height is given the source may
+        be decoded at a reduced scale (see reduce_for_target).
 
         :param img_path: a path to an image file relative to MEDIA_ROOT
+        :param width: target width in pixels the image is headed for (optional)
+        :param height: target height in pixels the image is headed for (optional)
         :raises IOError: if image is not found
+        :raises SourceTooLarge: if the image is over budget, see check_budget
         :return: PIL.Image
         """
+        with self.timings.stage('decode'):
+            return self.decode(self.probe(img_path), img_path, width, height)
+
+    def decode(self, img, img_path, width=None, height=None):
+        """
+        Decode an opened image, at a reduced scale if a target width and/or
+        height is given, once it's known to be within budget. The image keeps
+        the size it was opened at, see source_size.
+
+        :param img: a PIL Image object that has not been loaded yet
+        :param img_path: a path to the image file relative to MEDIA_ROOT
+        :param width: target width in pixels the image is headed for (optional)
+        :param height: target height in pixels the image is headed for (optional)
+        :raises SourceTooLarge: if the image is over budget, see check_budget
+        :return: PIL.Image
+        """
+        img.info.setdefault(SOURCE_SIZE_INFO, img.size)
+        shrink = width or height
+        if shrink and img.format == 'JPEG':
+            # draft mode shrinks the decode itself, so only what is left of
+            # it counts against the budget
+            img = self.reduce_for_target(img, width, height)
+            shrink = False
+        self.check_budget(img, img_path, width, height)
+        if shrink:
+            img = self.reduce_for_target(img, width, height)
+        img.load()
+        return img
+
+    def source_size(self, img):
+        """
+        :param img: a PIL Image object
+        :returns: (width, height) of the source img was decoded from, which is
+            larger than img when it was decoded at a reduced scale
+        """
+        return img.info.get(SOURCE_SIZE_INFO, img.size)
+
+    def check_budget(self, img, img_path, width=None, height=None):
+        """
+        Turn away an image, opened but not decoded yet, that would decode to
+        more than MAX_SOURCE_PIXELS pixels or whose render is estimated to
+        take more than MAX_RENDER_MEMORY bytes.
+
+        :param img: a PIL Image object that has not been loaded yet
+        :param img_path: a path to the image file relative to MEDIA_ROOT
+        :param width: target width in pixels or None
+        :param height: target height in pixels or None
+        :raises SourceTooLarge: if the image is over budget
+        """
+        if MAX_SOURCE_PIXELS and img.size[0] * img.size[1] > MAX_SOURCE_PIXELS:
+            self.reject(img_path, 'pixels')
+        if MAX_RENDER_MEMORY and estimate_render_bytes(img.mode, img.size, (width, height)) > MAX_RENDER_MEMORY:
+            self.reject(img_path, 'memory')
+
+    def reject(self, img_path, reason):
+        """
+        Log and count a source that is too large to render, so offending
+        images can be found.
+
+        :param img_path: a path to the image file relative to MEDIA_ROOT
+        :param reason: 'pixels', 'memory' or 'bomb'
+        :raises SourceTooLarge: always
+        """
+        logger.warning('%s: too large to render (%s)' % (img_path, reason))
+        metrics.increment('rejected_sources_total', reason=reason)
+        raise SourceTooLarge(img_path, reason)
+
+    def source_fs_path(self, img_path):
+        """
+        Map a source path from a url to a path on the filesystem, under
+        STATIC_ROOT if it starts with STATIC_URL and MEDIA_ROOT otherwise.
+
+        :param img_path: a path to an image file relative to MEDIA_ROOT
+        :returns: an absolute path
+        """
         static_url = settings.STATIC_URL.lstrip('/')
 
         if img_path.lstrip('/').startswith(static_url):
-            path = os.path.join(settings.STATIC_ROOT, img_path.replace(static_url, ''))
-        else:
-            path = os.path.join(settings.MEDIA_ROOT, img_path)
+            return os.path.join(settings.STATIC_ROOT, img_path.replace(static_url, ''))
+        return os.path.join(settings.MEDIA_ROOT, img_path)
+
+    def probe(self, img_path):
+        """
+        Open a source image without decoding it. Only the header is read, so
+        size, mode and format are available but pixel data is not.
+
+        :param img_path: a path to an image file relative to MEDIA_ROOT
+        :raises IOError: if image is not found
+        :raises SourceTooLarge: if Pillow takes the image for a decompression bomb
+        :return: PIL.Image
+        """
+        try:
+            return Image.open(self.source_fs_path(img_path))
+        except DECOMPRESSION_BOMB:
+            self.reject(img_path, 'bomb')
+
+    def probe_noop(self, action, width, height, source_path, img_format):
+        """
+        Probe a source and decide whether rendering it would be a no-op,
+        which requires the output format to be the source's format as well.
+
+        :param img_format: PIL image format string of the rendered image
+        :raises IOError: if the source image is not found
+        :returns: True if rendering would not change the source
+        """
+        source = self.probe(source_path)
+        return source.format == img_format and self.is_noop(action, width, height, source)
+
+    def is_noop(self, action, width, height, img):
+        """
+        Decide from a probed source whether an action would hand the source
+        back untouched. Each action can answer this for itself with a
+        `<action>_is_noop(width, height, img)` method; actions without one
+        are never no-ops.
+
+        :param action: some action, eg thumbnail or resize
+        :param width: integer width in pixels or None
+        :param height: integer height in pixels or None
+        :param img: a probed PIL Image object
+        :returns: True if rendering would not change the source
+        """
+        check = getattr(self, '%s_is_noop' % action, None)
+        return bool(check and check(width, height, img))
+
+    def thumbnail_is_noop(self, width, height, img):
+        if (width and height) or (width is None and height is None):
+            return False
+        return self.thumbnail_size(width, height, img.size) == img.size
+
+    def resize_is_noop(self, width, height, img):
+        return width >= img.size[0] and height >= img.size[1]
+
+    def mresize_is_noop(self, width, height, img):
+        return img.size == (width, height)
+
+    def aresize_is_noop(self, width, height, img):
+        return img.size == (width, height)
+
+    def aresize_no_crop_is_noop(self, width, height, img):
+        return img.size == (width, height)
 
-        return Image.open(path)
+    def scale_is_noop(self, width, height, img):
+        return width >= img.size[0] and height >= img.size[1] and img.mode != 'P'
+
+    def matte_is_noop(self, width, height, img):
+        return img.size == (width, height) and img.mode == 'RGB'
+
+    def reduce_for_target(self, img, width, height):
+        """
+        Cheaply shrink a freshly opened image towards a target geometry before
+        any action resamples it. The result is never smaller than
+        REDUCING_GAP times the target in either dimension, so the final
+        ANTIALIAS resample still has enough pixels to work with. JPEGs are
+        decoded in draft mode (DCT scaling by 1/2, 1/4 or 1/8) and never
+        decoded at full size; other formats use Image.reduce() when the
+        installed Pillow provides it.
+
+        :param img: a PIL Image object that has not been loaded yet
+        :param width: target width in pixels or None
+        :param height: target height in pixels or None
+        :returns: a PIL Image object
+        """
+        if not REDUCING_GAP or not (width or height):
+            return img
+
+        source_width, source_height = img.size
+        # fill in a missing dimension from the source aspect ratio
+        width = width or max(1, source_width * height // source_height)
+        height = height or max(1, source_height * width // source_width)
+
+        min_width = int(width * REDUCING_GAP)
+        min_height = int(height * REDUCING_GAP)
+        if min_width >= source_width or min_height >= source_height:
+            return img
+
+        if img.format == 'JPEG':
+            img.draft(img.mode, (min_width, min_height))
+            return img
+
+        factor = min(source_width // min_width, source_height // min_height)
+        # Image.reduce() is only available from Pillow 7 and only handles
+        # some modes; palette images in particular are left alone.
+        if factor > 1 and hasattr(img, 'reduce') and img.mode in REDUCIBLE_MODES:
+            return img.reduce(factor)
+        return img
 
     def cache_key(self, img_path, action, width, height):
         """
@@ -464,6 +1482,35 @@ class LazyThumbRenderer(View):
         hashed = md5('%s:%s:%s:%s' % (img_path, action, width, height))
         return hashed.hexdigest()
 
+    def accepts(self, request, media_type):
+        """
+        :param request: HttpRequest
+        :param media_type: eg 'image/webp'
+        :returns: whether the request's Accept header explicitly lists
+            media_type with a non-zero quality
+        """
+        for accepted in request.META.get('HTTP_ACCEPT', '').split(','):
+            params = [param.strip() for param in accepted.split(';')]
+            if params[0].lower() != media_type:
+                continue
+            for param in params[1:]:
+                if param.startswith('q='):
+                    try:
+                        return float(param[2:]) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def vary(self, resp, negotiated):
+        """
+        Mark a response as depending on the Accept header if its format was
+        negotiated.
+        """
+        if negotiated:
+            patch_vary_headers(resp, ('Accept',))
+        return resp
+
     def two_hundred(self, img_data, img_format):
         """
         Generate a 200 image response with raw image data, Cache-Control set,
@@ -475,6 +1522,222 @@ class LazyThumbRenderer(View):
         resp['Cache-Control'] = 'public,max-age=%s' % settings.LAZYTHUMBS_CACHE_TIMEOUT
         return resp
 
+    def three_oh_four(self, etag, last_modified):
+        """
+        Generate a bodyless 304 response carrying the validators and
+        Cache-Control header of the unchanged image.
+
+        :param etag: ETag of the rendered image
+        :param last_modified: modification time of the rendered image as a timestamp
+        """
+        resp = HttpResponseNotModified()
+        resp['ETag'] = etag
+        resp['Last-Modified'] = http_date(last_modified)
+        resp['Cache-Control'] = 'public,max-age=%s' % settings.LAZYTHUMBS_CACHE_TIMEOUT
+        return resp
+
+    def validators(self, rendered_path):
+        """
+        Compute validators for a rendered image from its modification time and
+        size, the same way nginx builds its ETags. Only stats the file; the
+        image itself is never opened.
+
+        :param rendered_path: the fs path of the rendered image
+        :returns: an (etag, last_modified timestamp) tuple, or (None, None) if
+            there is no rendered image at rendered_path
+        """
+        name = self.storage_name(rendered_path)
+        try:
+            stat = os.stat(self.fs.path(name))
+            mtime, size = stat.st_mtime, stat.st_size
+        except NotImplementedError:
+            # storage without local paths
+            try:
+                mtime = time.mktime(self.fs.modified_time(name).timetuple())
+                size = self.fs.size(name)
+            except (NotImplementedError, EnvironmentError):
+                return None, None
+        except (EnvironmentError, SuspiciousOperation):
+            return None, None
+        return self.make_validators(mtime, size)
+
+    def make_validators(self, mtime, size):
+        """
+        :param mtime: modification time of a file as a timestamp
+        :param size: size of a file in bytes
+        :returns: an (etag, last_modified timestamp) tuple
+        """
+        mtime = int(mtime)
+        return '"%x-%x"' % (mtime, size), mtime
+
+    def not_modified(self, request, etag, last_modified):
+        """
+        Decide whether a conditional request can be answered with a 304. As
+        per RFC 7232, If-Modified-Since is only considered when there is no
+        If-None-Match header.
+
+        :param request: HttpRequest
+        :param etag: ETag of the rendered image
+        :param last_modified: modification time of the rendered image as a timestamp
+        :returns: True if the client's copy is current
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            # If-None-Match uses the weak comparison function
+            tags = [t.strip() for t in if_none_match.split(',')]
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+            return '*' in tags or etag in tags
+
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            if_modified_since = parse_http_date_safe(if_modified_since)
+            return if_modified_since is not None and last_modified <= if_modified_since
+
+        return False
+
+    def cached_response(self, request, rendered_path, img_format):
+        """
+        Generate a 200 response for an image that has already been rendered
+        to the filesystem, delivered according to DELIVERY:
+
+        'read' reads the image into memory and responds with its data.
+        'stream' streams the file, letting the WSGI server's
+        wsgi.file_wrapper (sendfile) take over where Django supports it.
+        'x-sendfile' and 'x-accel-redirect' only check that the file exists
+        and leave sending it to Apache/lighttpd or nginx. 'x-sendfile' needs
+        a path on the local filesystem, so with a storage that has none the
+        image is streamed instead.
+
+        :param request: HttpRequest
+        :param rendered_path: the fs path of the rendered image
+        :param img_format: PIL image format string of the rendered image
+        :raises IOError: if there is no rendered image at rendered_path
+        """
+        if write_behind is not None:
+            raw_data = write_behind.pending(rendered_path)
+            if raw_data is not None:
+                return self.two_hundred(raw_data, img_format)
+
+        name = self.storage_name(rendered_path)
+        delivery = DELIVERY
+        if delivery == 'x-sendfile':
+            try:
+                path = self.fs.path(name)
+            except NotImplementedError:
+                delivery = 'stream'
+
+        if delivery == 'stream':
+            img_file = self.fs.open(name)
+            return self.stream_response(request, img_file, self.fs.size(name), img_format)
+
+        if delivery in ('x-sendfile', 'x-accel-redirect'):
+            if not self.fs.exists(name):
+                raise IOError('no rendered image at %s' % rendered_path)
+            resp = self.two_hundred('', img_format)
+            if delivery == 'x-sendfile':
+                resp['X-Sendfile'] = path
+            else:
+                resp['X-Accel-Redirect'] = '%s/%s' % (X_ACCEL_REDIRECT_PREFIX.rstrip('/'), name)
+            return resp
+
+        return self.two_hundred(self.fs.open(name).read(), img_format)
+
+    def memory_response(self, request, rendered_path, raw_data, etag, last_modified):
+        """
+        Generate a response for a rendered image found in the in-process
+        memory cache.
+
+        :param request: HttpRequest
+        :param rendered_path: the fs path of the rendered image
+        :param raw_data: the rendered image data as a string
+        :param etag: ETag of the rendered image or None
+        :param last_modified: modification time of the rendered image as a timestamp or None
+        """
+        if etag and CONDITIONAL_GET:
+            if self.not_modified(request, etag, last_modified):
+                return self.three_oh_four(etag, last_modified)
+        resp = self.two_hundred(raw_data, get_format(rendered_path))
+        if etag and CONDITIONAL_GET:
+            resp['ETag'] = etag
+            resp['Last-Modified'] = http_date(last_modified)
+        return resp
+
+    def stream_response(self, request, img_file, size, img_format):
+        """
+        Generate a 200 response that streams an open image file.
+
+        :param request: HttpRequest
+        :param img_file: a file object open for reading
+        :param size: size of the file in bytes
+        :param img_format: PIL image format string of the image
+        """
+        content_type = 'image/%s' % img_format.lower()
+        if FileResponse is not None:
+            resp = FileResponse(img_file, content_type=content_type)
+        else:
+            file_wrapper = getattr(request, 'META', {}).get('wsgi.file_wrapper', FileWrapper)
+            resp = StreamingHttpResponse(file_wrapper(img_file, STREAM_BLOCK_SIZE), content_type=content_type)
+        resp['Content-Length'] = str(size)
+        resp['Cache-Control'] = 'public,max-age=%s' % settings.LAZYTHUMBS_CACHE_TIMEOUT
+        return resp
+
+    def noop_response(self, request, source_path, img_format):
+        """
+        Generate a response for a render that would not change the source
+        image, without decoding or copying it: either a redirect to the
+        source's own url or the source file itself, delivered like a cached
+        render where possible ('x-accel-redirect' streams instead since the
+        source may live outside the render storage).
+
+        :param request: HttpRequest
+        :param source_path: the fs path to the source image
+        :param img_format: PIL image format string of the source image
+        :raises IOError: if the source image is not found
+        """
+        if NOOP_RESPONSE == 'redirect':
+            static_url = settings.STATIC_URL.lstrip('/')
+            if source_path.lstrip('/').startswith(static_url):
+                url = '/' + source_path.lstrip('/')
+            else:
+                url = settings.MEDIA_URL + source_path
+            resp = HttpResponseRedirect(url)
+            resp['Cache-Control'] = 'public,max-age=%s' % settings.LAZYTHUMBS_CACHE_TIMEOUT
+            return resp
+
+        path = self.source_fs_path(source_path)
+        stat = os.stat(path)
+
+        etag, last_modified = None, None
+        if CONDITIONAL_GET:
+            etag, last_modified = self.make_validators(stat.st_mtime, stat.st_size)
+            if self.not_modified(request, etag, last_modified):
+                return self.three_oh_four(etag, last_modified)
+
+        if DELIVERY == 'x-sendfile':
+            resp = self.two_hundred('', img_format)
+            resp['X-Sendfile'] = path
+        elif DELIVERY == 'read':
+            with open(path, 'rb') as f:
+                resp = self.two_hundred(f.read(), img_format)
+        else:
+            resp = self.stream_response(request, open(path, 'rb'), stat.st_size, img_format)
+
+        if etag:
+            resp['ETag'] = etag
+            resp['Last-Modified'] = http_date(last_modified)
+        return resp
+
+    def five_oh_three(self):
+        """
+        Generate a 503 response telling the client to come back in RETRY_AFTER
+        seconds. Sent instead of queueing yet another render behind a busy
+        render executor.
+        """
+        resp = HttpResponse(status=503, content_type='image/jpeg')
+        resp['Retry-After'] = str(RETRY_AFTER)
+        resp['Cache-Control'] = 'no-cache'
+        return resp
+
     def four_oh_four(self):
         """
         Generate a 404 response with an image/jpeg content_type. Sets a
@@ -484,3 +1747,13 @@ class LazyThumbRenderer(View):
         resp = HttpResponse(status=404, content_type='image/jpeg')
         resp['Cache-Control'] = 'public,max-age=%s' % settings.LAZYTHUMBS_404_CACHE_TIMEOUT
         return resp
+
+
+def metrics_view(request):
+    """
+    Expose this process's metrics in the Prometheus text format. Only
+    available with a sink that can render them, like PrometheusSink.
+    """
+    if not hasattr(metrics, 'render'):
+        return HttpResponse(status=404)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,78 @@
+"""
+Persist rendered images on a background thread so that responses don't wait
+on slow storage.
+"""
+import logging
+import os
+import threading
+from Queue import Queue, Full
+
+logger = logging.getLogger('lazythumbs')
+
+
+class WriteBehind(object):
+    """
+    A bounded queue of saves worked off by a daemon thread. Until an image is
+    saved its data stays available through `pending`, so requests for it
+    don't have to render it again. When the queue is full, submit saves
+    synchronously instead, which slows submitters down to the pace of the
+    storage.
+
+    The thread is started on first use, and again in a process forked from
+    one that already had it.
+    """
+    def __init__(self, queue_size):
+        self.queue = Queue(queue_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+    def submit(self, save, name, data):
+        """
+        Queue save(name, data) to run in the background.
+
+        :param save: a callable persisting data under name
+        :param name: the name data is saved under
+        :param data: the data to save as a string
+        """
+        with self._lock:
+            self._pending[name] = data
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='lazythumbs-write-behind')
+                self._thread.daemon = True
+                self._thread.start()
+                self._thread_pid = os.getpid()
+        try:
+            self.queue.put_nowait((save, name, data))
+        except Full:
+            logger.info('write-behind queue full, saving %s synchronously' % name)
+            self._save(save, name, data)
+
+    def pending(self, name):
+        """
+        :returns: the data of a submitted save that hasn't finished yet, or None
+        """
+        return self._pending.get(name)
+
+    def join(self):
+        """ Block until every submitted save has finished. """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            save, name, data = self.queue.get()
+            try:
+                self._save(save, name, data)
+            finally:
+                self.queue.task_done()
+
+    def _save(self, save, name, data):
+        try:
+            save(name, data)
+        except Exception:
+            logger.exception('unable to save %s' % name)
+        finally:
+            with self._lock:
+                if self._pending.get(name) is data:
+                    del self._pending[name]